@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+
+# An in-process stand in for the parts of Organizations, GuardDuty, STS, EC2 and SES the
+# enable code uses, so its throughput can be measured without touching AWS. It also fakes the
+# CloudFormation and S3 calls of scripts/deploy_splunk.py.
+#
+# FakeAWS holds the state of a simulated organization. FakeAWS.session() returns an object
+# that quacks like a boto3 Session, for guardduty_common._client_session.
+
+from botocore.exceptions import ClientError
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import re
+import threading
+import time
+import uuid
+
+# The first of the fake account ids. The Master (and payer) account is FIRST_ACCOUNT_ID,
+# the children follow it.
+FIRST_ACCOUNT_ID = 100000000000
+
+# Regions the fake describe_regions returns, in order. --regions takes the first N.
+ALL_REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'sa-east-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1', 'eu-south-1',
+    'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2',
+    'ap-south-1', 'me-south-1', 'af-south-1',
+]
+
+# Page size limits of the real APIs
+LIST_ACCOUNTS_MAX = 20
+LIST_MEMBERS_MAX = 50
+GET_MEMBERS_MAX = 50
+STACK_EVENTS_PAGE_SIZE = 100
+
+
+class FakeAWS(object):
+    '''
+    A simulated organization of `accounts` accounts (one in every suspended_every is
+    SUSPENDED) in `regions` regions. Every API call sleeps `latency` seconds. Invitations show
+    up in the child propagation_delay seconds after invite_members. If throttle_rate is set,
+    each account may make that many calls per second to each service in each region, and
+    calls over it fail with ThrottlingException. Stack operations take stack_delay seconds.
+    '''
+
+    def __init__(self, accounts=2000, regions=20, latency=0.0, propagation_delay=0.0,
+                 throttle_rate=None, suspended_every=50, stack_delay=0.0):
+        self.latency = latency
+        self.propagation_delay = propagation_delay
+        self.throttle_rate = throttle_rate
+        self.stack_delay = stack_delay
+        self.regions = ALL_REGIONS[:regions]
+        self.master_id = str(FIRST_ACCOUNT_ID)
+        self.accounts = {}
+        for i in range(accounts + 1):
+            account_id = str(FIRST_ACCOUNT_ID + i)
+            self.accounts[account_id] = {
+                'Id': account_id,
+                'Arn': f"arn:aws:organizations::{self.master_id}:account/o-fake/{account_id}",
+                'Email': f"aws+{account_id}@example.com",
+                'Name': f"account-{i}",
+                'Status': 'SUSPENDED' if i and i % suspended_every == 0 else 'ACTIVE',
+                'JoinedMethod': 'CREATED',
+                'JoinedTimestamp': datetime(2019, 1, 1, tzinfo=timezone.utc),
+            }
+        self.account_ids = sorted(self.accounts)
+
+        self.lock = threading.Lock()
+        # (account_id, region) => detector id
+        self.detectors = {}
+        # region => {member account_id => member}, members of the Master's detector
+        self.members = {}
+        # (account_id, region) => (invitation, time.monotonic() it becomes visible)
+        self.invitations = {}
+        self.emails = 0
+        # Accounts whose accept_invitation is denied, as if their accept role lacked the permission
+        self.denied_accounts = set()
+        # (region, stack id) => stack, and (region, stack name) => stack id of the live stack
+        self.stacks = {}
+        self.stack_ids = {}
+        # (region, bucket, key) => body
+        self.objects = {}
+        # list_accounts page tokens from before the last expire_page_tokens() are rejected
+        self.page_token_generation = 0
+        # (service, operation) => count
+        self.calls = Counter()
+        self.throttles = Counter()
+        # (account_id, service, region) => [tokens, last refill]
+        self.buckets = {}
+
+    def session(self):
+        return(FakeSession(self))
+
+    def expire_page_tokens(self):
+        '''Make every list_accounts NextToken handed out so far invalid, as if it had timed out'''
+        with self.lock:
+            self.page_token_generation += 1
+
+    def call(self, account_id, service, region, operation):
+        '''Account for one API call: count it, throttle it, and wait out its latency'''
+        with self.lock:
+            self.calls[(service, operation)] += 1
+            throttled = self.throttle_rate and not self._take_token(account_id, service, region)
+            if throttled:
+                self.throttles[(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def _take_token(self, account_id, service, region):
+        # Called with self.lock held
+        now = time.monotonic()
+        bucket = self.buckets.setdefault((account_id, service, region), [self.throttle_rate, now])
+        bucket[0] = min(self.throttle_rate, bucket[0] + (now - bucket[1]) * self.throttle_rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return(False)
+        bucket[0] -= 1
+        return(True)
+
+
+class FakeSession(object):
+    '''Just enough of boto3.session.Session for guardduty_common.get_client()'''
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def client(self, service, region_name=None, config=None, aws_access_key_id=None, **kwargs):
+        # get_client() passes role credentials from the fake assume_role, whose AccessKeyId is
+        # the account id. Without credentials the client belongs to the Master account.
+        account_id = aws_access_key_id or self.aws.master_id
+        return(CLIENT_CLASSES[service](self.aws, account_id, region_name or 'us-east-1'))
+
+    def get_available_regions(self, service):
+        return(list(self.aws.regions))
+
+
+class FakeMeta(object):
+
+    def __init__(self, client):
+        self.region_name = client.region
+        self.service_model = type('ServiceModel', (object,), {'service_name': client.service})()
+        self.method_to_api_mapping = {name: name for name in client.operations}
+
+
+class FakeClient(object):
+    service = None
+    operations = ()
+
+    def __init__(self, aws, account_id, region):
+        self.aws = aws
+        self.account_id = account_id
+        self.region = region
+        self.meta = FakeMeta(self)
+
+    def _call(self, operation):
+        self.aws.call(self.account_id, self.service, self.region, operation)
+
+    @staticmethod
+    def _error(code, operation, message=""):
+        return(ClientError({'Error': {'Code': code, 'Message': message}}, operation))
+
+
+class FakeSTS(FakeClient):
+    service = 'sts'
+    operations = ('get_caller_identity', 'assume_role')
+
+    def get_caller_identity(self):
+        self._call('get_caller_identity')
+        return({'Account': self.account_id, 'Arn': f"arn:aws:iam::{self.account_id}:user/benchmark"})
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self._call('assume_role')
+        account_id = RoleArn.split(':')[4]
+        if account_id not in self.aws.accounts:
+            raise self._error('AccessDenied', 'assume_role')
+        return({'Credentials': {
+            'AccessKeyId': account_id,
+            'SecretAccessKey': 'fake',
+            'SessionToken': 'fake',
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+        }})
+
+
+class FakeOrganizations(FakeClient):
+    service = 'organizations'
+    operations = ('describe_organization', 'describe_account', 'list_accounts')
+
+    def describe_organization(self):
+        self._call('describe_organization')
+        return({'Organization': {'Id': 'o-fake', 'MasterAccountId': self.aws.master_id}})
+
+    def describe_account(self, AccountId):
+        self._call('describe_account')
+        if AccountId not in self.aws.accounts:
+            raise self._error('AccountNotFoundException', 'describe_account')
+        return({'Account': dict(self.aws.accounts[AccountId])})
+
+    def list_accounts(self, MaxResults=LIST_ACCOUNTS_MAX, NextToken=None):
+        self._call('list_accounts')
+        start = 0
+        if NextToken is not None:
+            generation, start = (int(n) for n in NextToken.split(":"))
+            if generation != self.aws.page_token_generation:
+                raise self._error('InvalidInputException', 'list_accounts', "You specified an invalid value for nextToken.")
+        end = start + min(MaxResults, LIST_ACCOUNTS_MAX)
+        response = {'Accounts': [dict(self.aws.accounts[a]) for a in self.aws.account_ids[start:end]]}
+        if end < len(self.aws.account_ids):
+            response['NextToken'] = f"{self.aws.page_token_generation}:{end}"
+        return(response)
+
+
+class FakeEC2(FakeClient):
+    service = 'ec2'
+    operations = ('describe_regions',)
+
+    def describe_regions(self, **kwargs):
+        self._call('describe_regions')
+        return({'Regions': [{'RegionName': r, 'Endpoint': f"ec2.{r}.amazonaws.com"} for r in self.aws.regions]})
+
+
+class FakeSES(FakeClient):
+    service = 'ses'
+    operations = ('send_email',)
+
+    def send_email(self, **kwargs):
+        self._call('send_email')
+        with self.aws.lock:
+            self.aws.emails += 1
+        return({'MessageId': f"fake-{self.aws.emails}"})
+
+
+class FakeGuardDuty(FakeClient):
+    service = 'guardduty'
+    operations = (
+        'list_detectors', 'create_detector', 'get_members', 'list_members', 'create_members',
+        'invite_members', 'list_invitations', 'accept_invitation',
+    )
+
+    def list_detectors(self, **kwargs):
+        self._call('list_detectors')
+        detector_id = self.aws.detectors.get((self.account_id, self.region))
+        return({'DetectorIds': [detector_id] if detector_id else []})
+
+    def create_detector(self, Enable, **kwargs):
+        self._call('create_detector')
+        with self.aws.lock:
+            detector_id = self.aws.detectors.setdefault((self.account_id, self.region), f"fake{self.account_id}{self.region}")
+        return({'DetectorId': detector_id})
+
+    def _my_members(self):
+        return(self.aws.members.setdefault(self.region, {}) if self.account_id == self.aws.master_id else {})
+
+    def get_members(self, DetectorId, AccountIds):
+        self._call('get_members')
+        if len(AccountIds) > GET_MEMBERS_MAX:
+            raise self._error('BadRequestException', 'get_members', "Too many account ids")
+        with self.aws.lock:
+            members = self._my_members()
+            return({
+                'Members': [dict(members[a]) for a in AccountIds if a in members],
+                'UnprocessedAccounts': [{'AccountId': a, 'Result': "The request is rejected because the input detectorId is not owned by the current account."}
+                                        for a in AccountIds if a not in members],
+            })
+
+    def list_members(self, DetectorId, MaxResults=LIST_MEMBERS_MAX, NextToken=None, **kwargs):
+        self._call('list_members')
+        with self.aws.lock:
+            members = sorted(self._my_members().values(), key=lambda m: m['AccountId'])
+        start = int(NextToken or 0)
+        end = start + min(MaxResults, LIST_MEMBERS_MAX)
+        response = {'Members': [dict(m) for m in members[start:end]]}
+        if end < len(members):
+            response['NextToken'] = str(end)
+        return(response)
+
+    def create_members(self, DetectorId, AccountDetails):
+        self._call('create_members')
+        with self.aws.lock:
+            members = self._my_members()
+            unprocessed = []
+            for details in AccountDetails:
+                if details['AccountId'] == self.account_id:
+                    # Like GuardDuty, the Master can't be a member of its own detector
+                    unprocessed.append({'AccountId': details['AccountId'],
+                                        'Result': "The request is rejected because the current account cannot invite itself."})
+                    continue
+                members.setdefault(details['AccountId'], {
+                    'AccountId': details['AccountId'],
+                    'DetectorId': DetectorId,
+                    'MasterId': self.account_id,
+                    'Email': details['Email'],
+                    'RelationshipStatus': 'Created',
+                })
+        return({'UnprocessedAccounts': unprocessed})
+
+    def invite_members(self, DetectorId, AccountIds, **kwargs):
+        self._call('invite_members')
+        visible_at = time.monotonic() + self.aws.propagation_delay
+        unprocessed = []
+        with self.aws.lock:
+            members = self._my_members()
+            for account_id in AccountIds:
+                if account_id not in members:
+                    unprocessed.append({'AccountId': account_id, 'Result': "Not a member"})
+                    continue
+                if members[account_id]['RelationshipStatus'] != 'Enabled':
+                    members[account_id]['RelationshipStatus'] = 'Invited'
+                invitation = {
+                    'AccountId': self.account_id,
+                    'InvitationId': f"inv{account_id}{self.region}",
+                    'RelationshipStatus': 'Invited',
+                    'InvitedAt': datetime.now(timezone.utc).isoformat(),
+                }
+                self.aws.invitations[(account_id, self.region)] = (invitation, visible_at)
+        return({'UnprocessedAccounts': unprocessed})
+
+    def list_invitations(self, MaxResults=50, NextToken=None):
+        self._call('list_invitations')
+        with self.aws.lock:
+            pending = self.aws.invitations.get((self.account_id, self.region))
+        if pending is None or pending[1] > time.monotonic():
+            return({'Invitations': []})
+        return({'Invitations': [dict(pending[0])]})
+
+    def accept_invitation(self, DetectorId, InvitationId, MasterId):
+        self._call('accept_invitation')
+        if self.account_id in self.aws.denied_accounts:
+            raise self._error('AccessDeniedException', 'accept_invitation')
+        with self.aws.lock:
+            pending = self.aws.invitations.get((self.account_id, self.region))
+            if pending is None or pending[0]['InvitationId'] != InvitationId:
+                raise self._error('BadRequestException', 'accept_invitation', "No such invitation")
+            del self.aws.invitations[(self.account_id, self.region)]
+            member = self.aws.members.get(self.region, {}).get(self.account_id)
+            if member is not None:
+                member['RelationshipStatus'] = 'Enabled'
+        return({})
+
+
+class FakeS3(FakeClient):
+    service = 's3'
+    operations = ('put_object',)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('put_object')
+        with self.aws.lock:
+            self.aws.objects[(self.region, Bucket, Key)] = Body
+        return({'ETag': '"fake"'})
+
+
+class FakeCloudFormation(FakeClient):
+    '''
+    Stacks go through the real *_IN_PROGRESS statuses and reach the final one stack_delay
+    seconds later, with an event for each. A change set that changes nothing fails the way the
+    real one does.
+    '''
+    service = 'cloudformation'
+    operations = (
+        'validate_template', 'describe_stacks', 'describe_stack_events', 'create_stack',
+        'create_change_set', 'describe_change_set', 'execute_change_set', 'delete_change_set',
+        'update_termination_protection', 'delete_stack',
+    )
+
+    def _stack(self, operation, name_or_id):
+        # Called with self.aws.lock held
+        stack_id = name_or_id if name_or_id.startswith('arn:') else self.aws.stack_ids.get((self.region, name_or_id))
+        stack = self.aws.stacks.get((self.region, stack_id))
+        if stack is None:
+            raise self._error('ValidationError', operation, f"Stack with id {name_or_id} does not exist")
+        if stack['StackStatus'].endswith('_IN_PROGRESS') and time.monotonic() >= stack['done_at']:
+            stack['StackStatus'] = stack['next_status']
+            self._event(stack, stack['StackStatus'])
+            if stack['StackStatus'] == 'DELETE_COMPLETE':
+                del self.aws.stack_ids[(self.region, stack['StackName'])]
+        return(stack)
+
+    def _event(self, stack, status):
+        stack['events'].insert(0, {
+            'EventId': str(uuid.uuid4()),
+            'StackId': stack['StackId'],
+            'StackName': stack['StackName'],
+            'LogicalResourceId': stack['StackName'],
+            'ResourceType': 'AWS::CloudFormation::Stack',
+            'ResourceStatus': status,
+            'Timestamp': datetime.now(timezone.utc),
+        })
+
+    def _start(self, stack, status, next_status):
+        stack['StackStatus'] = status
+        stack['next_status'] = next_status
+        stack['done_at'] = time.monotonic() + self.aws.stack_delay
+        self._event(stack, status)
+
+    @staticmethod
+    def _public(stack):
+        return({k: v for k, v in stack.items() if k[0].isupper()})
+
+    def validate_template(self, TemplateBody):
+        self._call('validate_template')
+        # Good enough for our templates: the parameters are the keys indented under Parameters:
+        section = TemplateBody.split("\nParameters:", 1)[-1].split("\nConditions:", 1)[0].split("\nResources:", 1)[0]
+        return({'Parameters': [{'ParameterKey': k} for k in re.findall(r"^  (\w+):", section, re.M)]})
+
+    def describe_stacks(self, StackName):
+        self._call('describe_stacks')
+        with self.aws.lock:
+            return({'Stacks': [self._public(self._stack('describe_stacks', StackName))]})
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self._call('describe_stack_events')
+        start = int(NextToken or 0)
+        end = start + STACK_EVENTS_PAGE_SIZE
+        with self.aws.lock:
+            events = self._stack('describe_stack_events', StackName)['events']
+            response = {'StackEvents': [dict(e) for e in events[start:end]]}
+            if end < len(events):
+                response['NextToken'] = str(end)
+        return(response)
+
+    def create_stack(self, StackName, TemplateBody, Parameters=(), Capabilities=(), EnableTerminationProtection=False, **kwargs):
+        self._call('create_stack')
+        with self.aws.lock:
+            if (self.region, StackName) in self.aws.stack_ids:
+                raise self._error('AlreadyExistsException', 'create_stack', f"Stack [{StackName}] already exists")
+            stack_id = f"arn:aws:cloudformation:{self.region}:{self.account_id}:stack/{StackName}/{uuid.uuid4()}"
+            stack = {
+                'StackId': stack_id,
+                'StackName': StackName,
+                'Parameters': [{'ParameterKey': p['ParameterKey'], 'ParameterValue': p['ParameterValue']} for p in Parameters],
+                'EnableTerminationProtection': EnableTerminationProtection,
+                'template': TemplateBody,
+                'events': [],
+                'change_sets': {},
+            }
+            self._start(stack, 'CREATE_IN_PROGRESS', 'CREATE_COMPLETE')
+            self.aws.stacks[(self.region, stack_id)] = stack
+            self.aws.stack_ids[(self.region, StackName)] = stack_id
+        return({'StackId': stack_id})
+
+    def create_change_set(self, StackName, ChangeSetName, TemplateBody, Parameters=(), ChangeSetType='UPDATE', **kwargs):
+        self._call('create_change_set')
+        with self.aws.lock:
+            stack = self._stack('create_change_set', StackName)
+            current = {p['ParameterKey']: p['ParameterValue'] for p in stack['Parameters']}
+            parameters = dict(current)
+            for p in Parameters:
+                if not p.get('UsePreviousValue'):
+                    parameters[p['ParameterKey']] = p['ParameterValue']
+            change_set = {
+                'ChangeSetName': ChangeSetName,
+                'StackId': stack['StackId'],
+                'Status': 'CREATE_COMPLETE',
+                'Changes': [],
+                'parameters': parameters,
+                'template': TemplateBody,
+            }
+            if parameters == current and TemplateBody == stack['template']:
+                change_set['Status'] = 'FAILED'
+                change_set['StatusReason'] = "The submitted information didn't contain changes. Submit different information to create a change set."
+            else:
+                change_set['Changes'].append({'Type': 'Resource', 'ResourceChange': {
+                    'Action': 'Modify', 'LogicalResourceId': 'GuardDuty2SplunkLambdaFunction', 'ResourceType': 'AWS::Lambda::Function'}})
+            stack['change_sets'][ChangeSetName] = change_set
+        return({'Id': f"{stack['StackId']}/changeSet/{ChangeSetName}", 'StackId': stack['StackId']})
+
+    def describe_change_set(self, StackName, ChangeSetName):
+        self._call('describe_change_set')
+        with self.aws.lock:
+            change_set = self._stack('describe_change_set', StackName)['change_sets'].get(ChangeSetName)
+            if change_set is None:
+                raise self._error('ChangeSetNotFound', 'describe_change_set', f"ChangeSet [{ChangeSetName}] does not exist")
+            return(self._public(change_set))
+
+    def execute_change_set(self, StackName, ChangeSetName):
+        self._call('execute_change_set')
+        with self.aws.lock:
+            stack = self._stack('execute_change_set', StackName)
+            change_set = stack['change_sets'].pop(ChangeSetName)
+            stack['Parameters'] = [{'ParameterKey': k, 'ParameterValue': v} for k, v in sorted(change_set['parameters'].items())]
+            stack['template'] = change_set['template']
+            self._start(stack, 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE')
+        return({})
+
+    def delete_change_set(self, StackName, ChangeSetName):
+        self._call('delete_change_set')
+        with self.aws.lock:
+            self._stack('delete_change_set', StackName)['change_sets'].pop(ChangeSetName, None)
+        return({})
+
+    def update_termination_protection(self, StackName, EnableTerminationProtection):
+        self._call('update_termination_protection')
+        with self.aws.lock:
+            self._stack('update_termination_protection', StackName)['EnableTerminationProtection'] = EnableTerminationProtection
+        return({})
+
+    def delete_stack(self, StackName, **kwargs):
+        self._call('delete_stack')
+        with self.aws.lock:
+            stack = self._stack('delete_stack', StackName)
+            if stack['EnableTerminationProtection']:
+                raise self._error('ValidationError', 'delete_stack', f"Stack [{stack['StackName']}] cannot be deleted while TerminationProtection is enabled")
+            self._start(stack, 'DELETE_IN_PROGRESS', 'DELETE_COMPLETE')
+        return({})
+
+
+CLIENT_CLASSES = {
+    'sts': FakeSTS,
+    'organizations': FakeOrganizations,
+    'ec2': FakeEC2,
+    'ses': FakeSES,
+    'guardduty': FakeGuardDuty,
+    's3': FakeS3,
+    'cloudformation': FakeCloudFormation,
+}
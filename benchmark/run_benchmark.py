@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Measure the enable lambda and the org-wide script against the fake AWS in fake_aws.py.
+# Reports wall clock time, AWS calls per service, throttles and peak memory for each run.
+
+from contextlib import redirect_stderr, redirect_stdout
+import json
+import logging
+import os
+import resource
+import runpy
+import sys
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCHMARK_DIR, '..', 'lambda')
+SCRIPT = os.path.join(BENCHMARK_DIR, '..', 'scripts', 'enable_guardduty.py')
+sys.path.insert(0, LAMBDA_DIR)
+
+import guardduty_common
+from fake_aws import FakeAWS
+
+MODES = ['lambda', 'script', 'script-async']
+
+
+class FakeContext(object):
+    '''Just enough of a lambda context for the handler'''
+    function_name = "enable-guardduty-benchmark"
+
+
+def install(aws, rate_scale):
+    '''Point guardduty_common at aws, and forget everything cached by earlier runs'''
+    with guardduty_common._clients_lock:
+        guardduty_common._clients.clear()
+        guardduty_common._client_session = aws.session()
+    guardduty_common._creds_cache.clear()
+    guardduty_common._creds_locks.clear()
+    guardduty_common.region_catalog.load({})
+    limiter = guardduty_common.call_limiter
+    with limiter.lock:
+        limiter.buckets.clear()
+        limiter.retry_budgets.clear()
+        limiter.stats.clear()
+    guardduty_common.call_metrics.reset()
+    guardduty_common.SERVICE_RATES.update({s: r * rate_scale for s, r in BASE_SERVICE_RATES.items()})
+    guardduty_common.DEFAULT_SERVICE_RATE = BASE_DEFAULT_SERVICE_RATE * rate_scale
+
+
+BASE_SERVICE_RATES = dict(guardduty_common.SERVICE_RATES)
+BASE_DEFAULT_SERVICE_RATE = guardduty_common.DEFAULT_SERVICE_RATE
+
+
+def run_lambda(args, aws):
+    '''Invoke the handler --lambda_invocations times, each with --lambda_batch new accounts'''
+    os.environ.update({
+        'ACCEPT_ROLE': "GuardDutyAccept",
+        'AUDIT_ROLE': "GuardDutyAudit",
+        'EMAIL_TO': "benchmark@example.com",
+        'EMAIL_FROM': "benchmark@example.com",
+        'REGION_CONCURRENCY': str(args.region_concurrency),
+    })
+    import enable_guardduty
+
+    children = [a for a in aws.account_ids if a != aws.master_id]
+    for i in range(args.lambda_invocations):
+        batch = children[i * args.lambda_batch:(i + 1) * args.lambda_batch]
+        event = {'Records': [{'Sns': {'Message': json.dumps({'account_id': a})}} for a in batch]}
+        enable_guardduty.handler(event, FakeContext())
+    return(children[:args.lambda_invocations * args.lambda_batch])
+
+
+def run_script(args, aws, use_async):
+    '''Run an org-wide sweep with the script, as if from the command line'''
+    argv = [SCRIPT, "--payer_arn", f"arn:aws:iam::{aws.master_id}:role/GuardDutyAudit"]
+    if use_async:
+        argv += ["--async", "--concurrency", str(args.concurrency)]
+    saved_argv = sys.argv
+    sys.argv = argv
+    try:
+        runpy.run_path(SCRIPT, run_name='__main__')
+    finally:
+        sys.argv = saved_argv
+    return([a for a in aws.account_ids if a != aws.master_id])
+
+
+def enabled_count(aws, account_ids):
+    '''How many (account, region) pairs ended up as Enabled members of the Master'''
+    count = 0
+    for region in aws.regions:
+        members = aws.members.get(region, {})
+        count += sum(1 for a in account_ids if members.get(a, {}).get('RelationshipStatus') == 'Enabled')
+    return(count)
+
+
+def run_mode(args, mode):
+    aws = FakeAWS(args.accounts, args.regions, args.latency, args.propagation_delay, args.throttle_rate)
+    install(aws, args.rate_scale)
+
+    tracemalloc.start()
+    start = time.monotonic()
+    # The code under test is chatty, and prints a line per account
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        if mode == 'lambda':
+            account_ids = run_lambda(args, aws)
+        else:
+            account_ids = run_script(args, aws, mode == 'script-async')
+    wall_time = time.monotonic() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    active = [a for a in account_ids if aws.accounts[a]['Status'] == 'ACTIVE']
+    services = {}
+    for (service, operation), count in aws.calls.items():
+        services[service] = services.get(service, 0) + count
+    return({
+        'mode': mode,
+        'accounts': args.accounts,
+        'regions': args.regions,
+        'wall_time': round(wall_time, 2),
+        'calls': sum(aws.calls.values()),
+        'calls_per_service': services,
+        'calls_per_operation': {f"{s}:{o}": c for (s, o), c in sorted(aws.calls.items())},
+        'throttles': sum(aws.throttles.values()),
+        'enabled': enabled_count(aws, active),
+        'expected_enabled': len(active) * len(aws.regions),
+        'peak_traced_mb': round(peak / 1024 / 1024, 1),
+    })
+
+
+def print_result(result):
+    print(f"{result['mode']}: {result['accounts']} accounts x {result['regions']} regions")
+    print(f"    wall time      {result['wall_time']:.2f}s")
+    print(f"    peak memory    {result['peak_traced_mb']:.1f} MB traced")
+    print(f"    enabled        {result['enabled']} of {result['expected_enabled']} account/regions")
+    print(f"    throttles      {result['throttles']}")
+    print(f"    AWS calls      {result['calls']}")
+    for service, count in sorted(result['calls_per_service'].items()):
+        print(f"        {service:<15} {count}")
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the GuardDuty enable code against a simulated organization")
+    parser.add_argument("--mode", help="What to run", choices=MODES + ['all'], default='all')
+    parser.add_argument("--accounts", help="Number of child accounts in the organization", type=int, default=2000)
+    parser.add_argument("--regions", help="Number of regions", type=int, default=20)
+    parser.add_argument("--latency", help="Seconds each fake AWS call takes", type=float, default=0.02)
+    parser.add_argument("--propagation_delay", help="Seconds before an invitation reaches the child", type=float, default=1.0)
+    parser.add_argument("--throttle_rate", help="Calls per second each account may make per service and region before it is throttled", type=float)
+    parser.add_argument("--rate_scale", help="Multiply the client side rate limits by this, to shorten big runs", type=float, default=1.0)
+    parser.add_argument("--region_concurrency", help="REGION_CONCURRENCY for the lambda", type=int, default=8)
+    parser.add_argument("--lambda_invocations", help="Number of lambda invocations", type=int, default=1)
+    parser.add_argument("--lambda_batch", help="Accounts in each lambda invocation", type=int, default=10)
+    parser.add_argument("--concurrency", help="--concurrency for the script's --async mode", type=int, default=20)
+    parser.add_argument("--output", help="Also write the results to this file as JSON")
+    return(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = do_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    for mode in (MODES if args.mode == 'all' else [args.mode]):
+        result = run_mode(args, mode)
+        print_result(result)
+        results.append(result)
+    print(f"Max RSS of the benchmark process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
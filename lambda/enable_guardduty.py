@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 
-import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import itertools
 import json
 import logging
 import os
+import threading
 import time
-import io
+import uuid
+
+from guardduty_common import (CONNECTION_ERRORS, account_pages, call_limiter, call_metrics, chunks, get_cached_creds, get_client,
+    invite_members, lookup_members, region_catalog, wait_for_invitation)
 
 
 logger = logging.getLogger()
@@ -19,59 +25,537 @@ logging.getLogger('boto3').setLevel(logging.WARNING)
 # Process documented here:
 # https://docs.aws.amazon.com/guardduty/latest/ug/guardduty_accounts.html#guardduty_become_api
 
+# How many regions to process at once. 1 processes the regions serially.
+DEFAULT_REGION_CONCURRENCY = 1
+
+# CloudWatch namespace of the metrics each invocation emits in Embedded Metric Format
+DEFAULT_METRICS_NAMESPACE = "GuardDutyEnterprise"
+
+# Most bytes of log text captured for the email. Lines past it are counted, not kept.
+LOG_CAPTURE_MAX_BYTES = int(os.environ.get('LOG_CAPTURE_MAX_BYTES', 256 * 1024))
+
+# A sweep works through the organization this many accounts at a time, and hands the rest of
+# it to a new invocation when less than SWEEP_TIME_MARGIN_MS (or 1.5 times the slowest chunk
+# so far, if that's longer) is left
+SWEEP_CHUNK_SIZE = int(os.environ.get('SWEEP_CHUNK_SIZE', 50))
+SWEEP_TIME_MARGIN_MS = 60000
+# Where a new sweep starts in the organization's account listing, see organization_chunks()
+SWEEP_START = {'page_token': None, 'skip': 0, 'done': 0}
+
+# With REPORT_MODE=digest, each invocation saves its outcomes under s3://DIGEST_BUCKET/DIGEST_PREFIX
+# instead of emailing them, and a {"digest": true} invocation emails one summary of everything
+# saved since the last one. Accounts something failed for are still emailed about right away,
+# to URGENT_EMAIL_TO if it is set.
+REPORT_MODE = os.environ.get('REPORT_MODE', 'email')
+DIGEST_BUCKET = os.environ.get('DIGEST_BUCKET')
+DIGEST_PREFIX = os.environ.get('DIGEST_PREFIX', 'digest/')
+
+# Outcomes that need someone to look at the account
+FAILED_OUTCOMES = ("failed", "region failed", "unexpected state")
+
+# A digest lists the regions of an outcome by name up to this many, and counts them after that
+DIGEST_MAX_REGION_NAMES = 3
+
+# Set when running from the command line: sweep continuations are queued here instead of
+# invoking the lambda
+_local_sweep_queue = None
+
+# Each region worker records the region it is working on here so its log lines can be grouped
+_log_context = threading.local()
+
+
+class RegionLogFilter(logging.Filter):
+    '''Tag each log record with the region of the worker thread that emitted it'''
+
+    def filter(self, record):
+        record.region = getattr(_log_context, 'region', None)
+        return True
+
+
+class RegionLogCapture(logging.Handler):
+    '''
+    Capture formatted log lines for the email, grouped by region so the output
+    of concurrent region workers doesn't end up interleaved. Keeps at most
+    max_bytes of text; later lines are only counted.
+    '''
+
+    def __init__(self, max_bytes=LOG_CAPTURE_MAX_BYTES):
+        super().__init__()
+        self.addFilter(RegionLogFilter())
+        self.lines = {}
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            # Don't bother formatting lines that won't be kept
+            if self.size >= self.max_bytes:
+                self.dropped += 1
+                return
+            line = self.format(record)
+            self.size += len(line) + 1
+            self.lines.setdefault(record.region, []).append(line)
+        except Exception:
+            self.handleError(record)
+
+    def getvalue(self):
+        # Lines logged outside of a region worker go first, then each region in turn
+        output = self.lines.get(None, [])
+        for region in sorted(r for r in self.lines if r is not None):
+            output = output + self.lines[region]
+        if self.dropped:
+            output = output + [f"... {self.dropped} more log lines were left out, see CloudWatch Logs for the full log"]
+        return "\n".join(output) + "\n"
+
 
 def handler(event, context):
     '''
-    message = {
+    Every SNS record in the event carries a message = {
         'account_id': 'string',
         'dry_run': true|false,  // optional, if un-specified, dry_run=false
+        'accept_only': true|false,  // optional, if un-specified, accept_only=false
         'region': ['string'],  // optional, if un-specified, runs all regions
+        'region_concurrency': int,  // optional, number of regions to process at once.
+                                    // if un-specified, uses $REGION_CONCURRENCY (default 1)
     }
+    All the records are processed together: accounts are deduplicated and each region is
+    only visited once for all the accounts that need it. One email covers the whole event.
+
+    A message of {'sweep': true, ...} (via SNS, or as the event itself when invoked by a
+    schedule) enables every account in the organization instead of account_id. See sweep().
+    An event of {'digest': true} emails the digest of the saved outcomes. See send_digest().
     '''
     logger.debug("Received event: " + json.dumps(event, sort_keys=True))
-    message = json.loads(event['Records'][0]['Sns']['Message'])
+    call_limiter.reset_stats()
+    call_metrics.reset()
+    if event.get('digest'):
+        send_digest(context)
+        return
+    if 'Records' in event:
+        messages = [json.loads(record['Sns']['Message']) for record in event['Records']]
+    else:
+        # Invoked directly, by the sweep schedule or a sweep continuing itself
+        messages = [event]
 
     # Setup Logger to save for an email
     # Stolen from http://alanwsmith.com/capturing-python-log-output-in-a-variable
-    log_capture_string = io.StringIO()
-    ch = logging.StreamHandler(log_capture_string)
-    ch.setLevel(logging.INFO)
+    # The capture only lives for this invocation. Left attached, a warm container's later
+    # invocations would keep logging into it.
+    log_capture = RegionLogCapture()
+    log_capture.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    log_capture.setFormatter(formatter)
+    logger.addHandler(log_capture)
+    try:
+        for message in messages:
+            if message.get('sweep'):
+                sweep(message, log_capture, context)
+        messages = [message for message in messages if not message.get('sweep')]
+        if messages:
+            process_messages(messages, log_capture, context)
+    finally:
+        logger.removeHandler(log_capture)
+
+
+def process_messages(messages, log_capture, context):
+    '''Enable GuardDuty for the accounts in messages, and email what happened'''
+    valid = []
+    for message in messages:
+        logger.info("Received message: " + json.dumps(message, sort_keys=True))
+
+        # account_id to operate on must be specified. A bad record is skipped rather than failing
+        # the batch, which would have the async retries re-process every other account in it.
+        if "account_id" not in message:
+            logger.error("message['account_id'] must be specified, skipping the message")
+            continue
+
+        # add optional message attributes as necessary
+        process_message(message)
+        valid.append(message)
+    messages = valid
+    if not messages:
+        return
+
+    # The account we run in is the GuardDuty Master the children accept invites from
+    master_account_id = get_client('sts').get_caller_identity()['Account']
+
+    accounts = {}
+    results = {}
+    unknown = set()
+    for batch in group_messages(messages):
+        batch['master_account_id'] = master_account_id
+
+        for account_id in list(batch['account_regions']):
+            if account_id not in accounts:
+                try:
+                    # get parent organization's account_id
+                    payer_account_id = get_parent_organization_account_id(account_id)
+                    logger.info(f"Found payer account_id for {account_id}: {payer_account_id}")
+
+                    # describe account (from payer account)
+                    accounts[account_id] = describe_account(payer_account_id, account_id)
+                except Exception as e:
+                    logger.error(f"Unable to describe account {account_id}, skipping it: {e}")
+                    accounts[account_id] = {'Id': account_id, 'Name': "unknown"}
+                    unknown.add(account_id)
+            if account_id in unknown:
+                # Report the account as failed in every region it asked for, and carry on with the rest
+                for region in batch['account_regions'].pop(account_id):
+                    results.setdefault(account_id, {})[region] = "failed"
+        batch['accounts'] = {account_id: accounts[account_id] for account_id in batch['account_regions']}
+        if not batch['account_regions']:
+            continue
+        batch['region'] = sorted(set().union(*batch['account_regions'].values()))
+
+        # process each region in the request
+        process_batch(batch, results)
+
+    report(log_capture, accounts, results, context)
+
+
+def process_batch(batch, results):
+    '''Process every region of the batch, and add each account's outcome in each region to results'''
+    for region, outcomes in process_regions(batch, batch['region'], batch['region_concurrency']).items():
+        if outcomes is False:
+            logger.error(f"Failed to process region {region}")
+            # Every account that wanted this region gets an outcome, so the summary is complete
+            outcomes = {account_id: "region failed" for account_id, regions in batch['account_regions'].items()
+                        if region in regions}
+        for account_id, outcome in outcomes.items():
+            results.setdefault(account_id, {})[region] = outcome
+
+
+def report(log_capture, accounts, results, context):
+    '''
+    Log the invocation's AWS call stats, emit its metrics and email the results, or in digest
+    mode save them for the digest and only email the accounts something failed for
+    '''
+    call_limiter.log_stats()
+    call_metrics.log_summary()
+    emit_metrics(context.function_name)
+
+    log_body = log_capture.getvalue()
+    if digest_mode():
+        save_digest_entry(accounts, results)
+        failed = [account_id for account_id in results if failed_account(results[account_id])]
+        if failed:
+            send_email(log_body, {a: accounts[a] for a in failed}, {a: results[a] for a in failed},
+                       os.environ.get('URGENT_EMAIL_TO') or os.environ['EMAIL_TO'], os.environ['EMAIL_FROM'], context.function_name)
+        return
 
-    logger.info("Received message: " + json.dumps(message, sort_keys=True))
+    # Now send an email
+    send_email(log_body, accounts, results, os.environ['EMAIL_TO'], os.environ['EMAIL_FROM'], context.function_name)
 
-    # account_id to operate on must be specified
-    if "account_id" not in message:
-        error_message = "message['account_id'] must be specified"
-        logger.error(error_message)
-        raise KeyError(error_message)
 
-    # get parent organization's account_id
-    message['payer_account_id'] = get_parent_organization_account_id(message)
-    logger.info(f"Found payer account_id: {message['payer_account_id']}")
+def digest_mode():
+    if REPORT_MODE != "digest":
+        return(False)
+    # The template's parameters say None for unset
+    if DIGEST_BUCKET in (None, "", "None"):
+        logger.error("REPORT_MODE is digest but DIGEST_BUCKET isn't set, emailing the results instead")
+        return(False)
+    return(True)
 
-    # describe account (from payer account)
-    message["account_info"] = describe_account(message)
 
-    # add optional message attributes as necessary
+def failed_account(outcomes):
+    '''outcomes is a dict of region => outcome for one account'''
+    return(any(outcome in FAILED_OUTCOMES for outcome in outcomes.values()))
+
+
+def save_digest_entry(accounts, results):
+    '''Save the invocation's outcomes for the next digest, in an object of their own'''
+    entry = {
+        'accounts': {account_id: {'Id': account_id, 'Name': accounts[account_id]['Name']} for account_id in results},
+        'results': results,
+    }
+    # Keys sort oldest first
+    key = f"{DIGEST_PREFIX}{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}.json"
+    get_client('s3').put_object(Bucket=DIGEST_BUCKET, Key=key, Body=json.dumps(entry).encode('utf-8'))
+    logger.info(f"Saved the outcomes for {len(results)} accounts to s3://{DIGEST_BUCKET}/{key} for the digest")
+
+
+def send_digest(context):
+    '''
+    Email one summary of the outcomes saved since the last digest, then delete them. When an
+    account and region shows up in several of them, the latest outcome wins.
+    '''
+    if not digest_mode():
+        return
+    s3_client = get_client('s3')
+    keys = []
+    kwargs = {'Bucket': DIGEST_BUCKET, 'Prefix': DIGEST_PREFIX}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        keys.extend(o['Key'] for o in response.get('Contents', []))
+        if not response.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+    if not keys:
+        logger.info("Nothing happened since the last digest")
+        return
+
+    accounts = {}
+    results = {}
+    for key in sorted(keys):
+        entry = json.loads(s3_client.get_object(Bucket=DIGEST_BUCKET, Key=key)['Body'].read())
+        accounts.update(entry['accounts'])
+        for account_id, outcomes in entry['results'].items():
+            results.setdefault(account_id, {}).update(outcomes)
+    logger.info(f"Sending the digest of {len(keys)} invocations, covering {len(accounts)} accounts")
+
+    subject, summary = describe_results(accounts, results)
+    message_body = f"""
+{summary}
+
+{digest_body(accounts, results)}
+
+** This is an autogenerated digest from the lambda {context.function_name} **
+    """
+    deliver_email(f"Digest: {subject}", message_body, os.environ['EMAIL_TO'], os.environ['EMAIL_FROM'], context.function_name)
+
+    # Only what went into this digest. Entries saved since then wait for the next one.
+    for chunk in chunks(keys, 1000):
+        s3_client.delete_objects(Bucket=DIGEST_BUCKET, Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True})
+
+
+def digest_body(accounts, results):
+    '''
+    How many account/regions ended up with each outcome, then a line for each account, except
+    for the accounts that were already enabled everywhere, which are only counted
+    '''
+    totals = {}
+    for outcomes in results.values():
+        for outcome in outcomes.values():
+            totals[outcome] = totals.get(outcome, 0) + 1
+    lines = ["Account/regions by outcome:"]
+    for outcome, count in sorted(totals.items(), key=lambda t: -t[1]):
+        lines.append(f"    {outcome}: {count}")
+    lines.append("")
+
+    unchanged = 0
+    for account_id in sorted(results, key=lambda a: (not failed_account(results[a]), accounts[a]['Name'])):
+        by_outcome = {}
+        for region, outcome in results[account_id].items():
+            by_outcome.setdefault(outcome, []).append(region)
+        if list(by_outcome) == ["already enabled"]:
+            unchanged += 1
+            continue
+        parts = []
+        for outcome, regions in sorted(by_outcome.items()):
+            if len(regions) > DIGEST_MAX_REGION_NAMES:
+                parts.append(f"{outcome} in {len(regions)} regions")
+            else:
+                parts.append(f"{outcome} in {', '.join(sorted(regions))}")
+        lines.append(f"{accounts[account_id]['Name']} ({account_id}): {'; '.join(parts)}")
+    if unchanged:
+        lines.append(f"{unchanged} more {'account was' if unchanged == 1 else 'accounts were'} already enabled in every region")
+    return("\n".join(lines))
+
+
+def sweep(message, log_capture, context):
+    '''
+    Enable GuardDuty for every account in the organization but the Master, SWEEP_CHUNK_SIZE
+    accounts at a time in the order the organization lists them. Suspended accounts get the
+    "inactive" outcome. message takes the same optional elements as an account message, plus
+    the 'cursor' a continued sweep picks the listing up at. Before the lambda runs out of time
+    the rest of the sweep is handed to a new invocation, see continue_sweep(). Only accounts
+    something happened to are emailed about.
+    '''
+    logger.info("Received sweep: " + json.dumps(message, sort_keys=True))
     process_message(message)
+    master_account_id = get_client('sts').get_caller_identity()['Account']
+
+    cursor = message.get('cursor')
+    if not isinstance(cursor, dict):
+        if cursor is not None:
+            logger.warning(f"Starting the sweep over, its cursor {cursor} is from an older version")
+        cursor = SWEEP_START
+    logger.info("Sweeping the organization's active accounts" +
+                (f" after the first {cursor['done']}" if cursor['done'] else ""))
+
+    # Only the accounts this invocation swept are kept, not the whole organization
+    accounts = {}
+    results = {}
+    continuation = None
+    chunks_done = 0
+    slowest_chunk = 0
+    org_chunks = organization_chunks(payer_organizations_client(), cursor, SWEEP_CHUNK_SIZE)
+    while True:
+        # Always do at least one chunk, so every invocation makes progress. The time is checked
+        # before the next chunk is listed, so the continuation doesn't list it again.
+        if chunks_done and context.get_remaining_time_in_millis() < max(SWEEP_TIME_MARGIN_MS, 1.5 * slowest_chunk):
+            continuation = cursor
+            break
+        chunk, cursor = next(org_chunks, (None, None))
+        if chunk is None:
+            logger.info("Sweep complete")
+            break
+        start = time.monotonic()
+        # Suspended accounts stay in, process_region() gives them the "inactive" outcome. The
+        # Master is in the listing too, but it can't be a member of its own detector.
+        chunk = {account['Id']: account for account in chunk if account['Id'] != master_account_id}
+        if chunk:
+            batch = {
+                'dry_run': message['dry_run'],
+                'accept_only': bool(message.get('accept_only', False)),
+                'region_concurrency': message['region_concurrency'],
+                'master_account_id': master_account_id,
+                'region': sorted(message['region']),
+                'account_regions': {account_id: set(message['region']) for account_id in chunk},
+                'accounts': chunk,
+            }
+            process_batch(batch, results)
+            accounts.update(chunk)
+        chunks_done += 1
+        slowest_chunk = max(slowest_chunk, (time.monotonic() - start) * 1000)
+        if cursor is None:
+            logger.info("Sweep complete")
+            break
+
+    changed = [account_id for account_id in accounts
+               if any(outcome not in ("already enabled", "inactive") for outcome in results.get(account_id, {}).values())]
+    logger.info(f"Swept {len(accounts)} accounts, {len(changed)} needed attention")
+    if digest_mode():
+        # The digest counts the accounts that were already enabled or inactive too
+        report(log_capture, accounts, {a: results[a] for a in accounts if a in results}, context)
+    elif changed:
+        report(log_capture, {a: accounts[a] for a in changed}, {a: results[a] for a in changed}, context)
+    else:
+        call_limiter.log_stats()
+        emit_metrics(context.function_name)
+
+    # Only hand the sweep on once this invocation's work is reported. If the report fails, the
+    # retry of this invocation sweeps the same accounts again, rather than a second
+    # continuation forking the sweep.
+    if continuation is not None:
+        continue_sweep(message, continuation, context)
+
+
+def continue_sweep(message, cursor, context):
+    '''Hand the rest of a sweep, from cursor on, to a new invocation of this function'''
+    message = dict(message, cursor=cursor)
+    logger.info(f"Continuing the sweep after {cursor['done']} accounts in a new invocation")
+    if _local_sweep_queue is not None:
+        _local_sweep_queue.append(message)
+    else:
+        get_client('lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                                    Payload=json.dumps(message))
 
-    # process each region in the request
-    for region in message['region']:
-        process_region(message, region)
 
-    # Now send an email
-    log_body = log_capture_string.getvalue()
-    send_email(log_body, message["account_info"], os.environ['EMAIL_TO'], os.environ['EMAIL_FROM'], context.function_name)
+def payer_organizations_client():
+    '''An Organizations client in the payer account, with AUDIT_ROLE'''
+    payer_account_id = get_client('organizations').describe_organization()['Organization']['MasterAccountId']
+    role_arn = create_role_arn(payer_account_id, os.environ["AUDIT_ROLE"])
+    return(get_client('organizations', creds=get_creds(role_arn)))
+
+
+def organization_chunks(org_client, cursor, size):
+    '''
+    Yield (chunk, cursor) for the organization's accounts from cursor on, size accounts at a
+    time. Only the list_accounts page being worked on is held in memory. A cursor says where
+    the listing picks up after its chunk: {'page_token': the NextToken to list from, 'skip':
+    how many accounts listed from there are already done, 'done': how many accounts of the
+    whole listing are}, or None after the last chunk. If page_token has expired the listing
+    starts over and skips the first 'done' accounts, so a sweep always gets further.
+    '''
+    pages = account_pages(org_client, cursor['page_token'])
+    skip = cursor['skip']
+    try:
+        first_page = next(pages)
+    except ClientError as e:
+        if cursor['page_token'] is None or e.response['Error']['Code'] != "InvalidInputException":
+            raise
+        logger.warning(f"The sweep's place in the account listing has expired, listing from the start: {e}")
+        pages = account_pages(org_client)
+        first_page = next(pages)
+        skip = cursor['done']
+
+    done = cursor['done']
+    chunk = []
+    for token, page in itertools.chain([first_page], pages):
+        for i in range(skip, len(page)):
+            chunk.append(page[i])
+            if len(chunk) == size:
+                done += len(chunk)
+                yield (chunk, {'page_token': token, 'skip': i + 1, 'done': done})
+                chunk = []
+        skip = max(0, skip - len(page))
+    if chunk:
+        # The end of the listing
+        yield (chunk, None)
+
+
+def group_messages(messages):
+    '''
+    Merge the messages into one batch per distinct (dry_run, accept_only). Within a batch each
+    account appears once, with the union of the regions it was requested in.
+    '''
+    batches = {}
+    for message in messages:
+        accept_only = bool(message.get('accept_only', False))
+        key = (message['dry_run'], accept_only)
+        if key not in batches:
+            batches[key] = {
+                'dry_run': message['dry_run'],
+                'accept_only': accept_only,
+                'region_concurrency': message['region_concurrency'],
+                'account_regions': {},
+            }
+        batch = batches[key]
+        batch['region_concurrency'] = max(batch['region_concurrency'], message['region_concurrency'])
+        batch['account_regions'].setdefault(message['account_id'], set()).update(message['region'])
+
+    for batch in batches.values():
+        batch['region'] = sorted(set().union(*batch['account_regions'].values()))
+    return(list(batches.values()))
+
+
+def process_regions(event, regions, max_workers):
+    '''
+    Run process_region() for every region, with up to max_workers regions in flight at once.
+    Returns a dict of region => the return value of process_region(), or False if it raised.
+    '''
+    if max_workers <= 1 or len(regions) <= 1:
+        return {region: process_region_worker(event, region) for region in regions}
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(regions))) as executor:
+        futures = {executor.submit(process_region_worker, event, region): region for region in regions}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return(results)
+
+
+def process_region_worker(event, region):
+    '''
+    Entry point for a region worker thread. Tags the worker's log lines with its region, and
+    times the region. Returns False if process_region() raised, whether or not it ran in a
+    thread, so one region's error doesn't end the invocation.
+    '''
+    _log_context.region = region
+    try:
+        with call_metrics.time_region(region):
+            return process_region(event, region)
+    except Exception as e:
+        logger.error(f"Error processing region {region}: {e}")
+        return(False)
+    finally:
+        _log_context.region = None
 
 
 def process_region(event, region):
+    '''
+    Enable GuardDuty in region for every account in the batch that asked for this region.
+    Returns a dict of account_id => outcome, or False if the region couldn't be processed.
+    '''
     logger.info(f"Processing Region: {region}")
+    if not region_catalog.is_reachable(region):
+        logger.error(f"GuardDuty can't be reached in region {region}. Skipping this region.")
+        return(False)
 
     # Local client in the GD Master account
-    gd_client = boto3.client('guardduty', region_name=region)
+    gd_client = get_client('guardduty', region)
     try:
         response = gd_client.list_detectors()
         if len(response['DetectorIds']) == 0:
@@ -83,33 +567,59 @@ def process_region(event, region):
     except ClientError as e:
         logger.error("Unable to list detectors in region {}. Skipping this region.".format(region))
         return(False)
-    except EndpointConnectionError as e:
+    except CONNECTION_ERRORS as e:
         logger.error("Unable to connect to GuardDuty in region {}. Skipping this region.".format(region))
+        region_catalog.mark_unreachable(region)
         return(False)
 
-    gd_status = get_all_members(region, gd_client, detector_id)
-
-    account = event['account_info']
-    account_name = account['Name']
-    account_id = account['Id']
-    if account['Status'] != "ACTIVE":
-        logger.info(f"Account {account_name}({account_id}) is inactive. No action being taken.")
-        return
-
-    if account_id not in gd_status:
-        if event["dry_run"]:
-            logger.info(f"Need to enable GuardDuty for {account_name}({account_id})")
+    accounts = [event['accounts'][account_id] for account_id in sorted(event['account_regions'])
+                if region in event['account_regions'][account_id]]
+    gd_status = lookup_members(gd_client, detector_id, [account['Id'] for account in accounts])
+
+    outcomes = {}
+    to_enable = []
+    for account in accounts:
+        account_name = account['Name']
+        account_id = account['Id']
+        if account['Status'] != "ACTIVE":
+            logger.info(f"Account {account_name}({account_id}) is inactive. No action being taken.")
+            outcomes[account_id] = "inactive"
+        elif account_id not in gd_status:
+            if event["dry_run"]:
+                logger.info(f"Need to enable GuardDuty for {account_name}({account_id})")
+            else:
+                logger.info(f"Enabling GuardDuty for {account_name}({account_id})")
+            to_enable.append(account)
+        elif gd_status[account_id]['RelationshipStatus'] == "Enabled":
+            logger.info(f"{account_name}({account_id}) is already GuardDuty-enabled in {region}")
+            outcomes[account_id] = "already enabled"
         else:
-            logger.info(f"Enabling GuardDuty for {account_name}({account_id})")
-        if "accept_only" not in event or not event["accept_only"]:
-            invite_account(account, detector_id, gd_client, event, region)
-            time.sleep(1)
-        accept_invite(account, os.environ['ACCEPT_ROLE'], event, region)
-    elif gd_status[account_id]['RelationshipStatus'] == "Enabled":
-        logger.info(f"{account_name}({account_id}) is already GuardDuty-enabled in {region}")
-    else:
-        logger.error(f"{account_name}({account_id}) is in unexpected GuardDuty state "
-                     f"{gd_status[account_id]['RelationshipStatus']} in {region}")
+            logger.error(f"{account_name}({account_id}) is in unexpected GuardDuty state "
+                         f"{gd_status[account_id]['RelationshipStatus']} in {region}")
+            outcomes[account_id] = "unexpected state"
+
+    if not event["accept_only"]:
+        # All the missing accounts are invited at once
+        invited = invite_accounts(to_enable, detector_id, gd_client, event, region)
+        for account in to_enable:
+            if account not in invited:
+                outcomes[account['Id']] = "failed"
+        to_enable = invited
+
+    for account in to_enable:
+        # One account's failure only fails that account, not the rest of the batch
+        try:
+            accepted = accept_invite(account, os.environ['ACCEPT_ROLE'], event, region)
+        except (ClientError, BotoCoreError) as e:
+            logger.error(f"Unable to accept the invite in {account['Name']}({account['Id']}) in {region}: {e}")
+            accepted = False
+        if accepted is False:
+            outcomes[account['Id']] = "failed"
+        elif event["dry_run"]:
+            outcomes[account['Id']] = "needs enabling"
+        else:
+            outcomes[account['Id']] = "enabled"
+    return(outcomes)
 
 
 def create_masteraccount_detector(gd_client, event, region):
@@ -126,45 +636,23 @@ def create_masteraccount_detector(gd_client, event, region):
         raise
 
 
-def get_all_members(region, gd_client, detector_id):
-    output = {}
-    response = gd_client.list_members(DetectorId=detector_id, MaxResults=50)
-    while 'NextToken' in response:
-        for a in response['Members']:
-            # Convert to a lookup table
-            output[a['AccountId']] = a
-        response = gd_client.list_members(
-            DetectorId=detector_id,
-            MaxResults=50,
-            NextToken=response['NextToken'],
-        )
-    for a in response['Members']:
-        # Convert to a lookup table
-        output[a['AccountId']] = a
-
-    return(output)
+def invite_accounts(accounts, detector_id, gd_client, event, region):
+    '''Invite accounts to this GuardDuty Master in batches. Returns the accounts that were invited.'''
+    if not accounts:
+        return([])
 
-
-def invite_account(account, detector_id, gd_client, event, region):
     if event["dry_run"]:
-        logger.info(f"Need to Invite {account['Name']}({account['Id']}) to this GuardDuty Master")
-        return(None)
+        for account in accounts:
+            logger.info(f"Need to Invite {account['Name']}({account['Id']}) to this GuardDuty Master")
+        return(accounts)
 
-    logger.info(f"Inviting {account['Name']}({account['Id']}) to this GuardDuty Master")
-    gd_client.create_members(
-        AccountDetails=[
-            {
-                'AccountId': account['Id'],
-                'Email': account['Email'],
-            },
-        ],
-        DetectorId=detector_id,
-    )
-    gd_client.invite_members(
-        AccountIds=[account['Id']],
-        DetectorId=detector_id,
-        DisableEmailNotification=True,
-    )
+    for account in accounts:
+        logger.info(f"Inviting {account['Name']}({account['Id']}) to this GuardDuty Master")
+    invited, failed = invite_members(gd_client, detector_id, accounts)
+    for account in accounts:
+        if account['Id'] in failed:
+            logger.error(f"Unable to invite {account['Name']}({account['Id']}) in {region}: {failed[account['Id']]}")
+    return([account for account in accounts if account['Id'] in invited])
 
 
 def accept_invite(account, role_name, event, region):
@@ -177,13 +665,7 @@ def accept_invite(account, role_name, event, region):
     role_arn = create_role_arn(account['Id'], role_name)
     creds = get_creds(role_arn)
 
-    child_client = boto3.client(
-        'guardduty',
-        region_name=region,
-        aws_access_key_id=creds['AccessKeyId'],
-        aws_secret_access_key=creds['SecretAccessKey'],
-        aws_session_token=creds['SessionToken'],
-    )
+    child_client = get_client('guardduty', region, creds)
 
     response = child_client.list_detectors()
     if len(response['DetectorIds']) == 0:
@@ -192,13 +674,18 @@ def accept_invite(account, role_name, event, region):
     else:
         detector_id = response['DetectorIds'][0]
 
-    response = child_client.list_invitations()
-    for i in response['Invitations']:
-        child_client.accept_invitation(
-            DetectorId=detector_id,
-            InvitationId=i['InvitationId'],
-            MasterId=i['AccountId'],
-        )
+    # Wait for the invite from this GuardDuty Master to reach the child account
+    invitation = wait_for_invitation(child_client, event['master_account_id'])
+    if invitation is None:
+        logger.error(f"No invitation from {event['master_account_id']} arrived in "
+                     f"{account['Name']}({account['Id']}) in {region}")
+        return(False)
+
+    child_client.accept_invitation(
+        DetectorId=detector_id,
+        InvitationId=invitation['InvitationId'],
+        MasterId=invitation['AccountId'],
+    )
 
 
 def create_role_arn(account_id, role_name):
@@ -206,31 +693,23 @@ def create_role_arn(account_id, role_name):
 
 
 def get_creds(role_arn):
-    client = boto3.client('sts')
+    # Credentials are cached per role, so every region (and warm invocation) shares them
     try:
-        session = client.assume_role(
-            RoleArn=role_arn, RoleSessionName="EnableGuardDuty",
-        )
-        return(session['Credentials'])
+        return(get_cached_creds(role_arn))
     except Exception as e:
         logger.error(f"Failed to assume role {role_arn}: {e}")
         raise
 
 
-def get_parent_organization_account_id(event):
-    role_arn = create_role_arn(event['account_id'], os.environ['ACCEPT_ROLE'])
+def get_parent_organization_account_id(account_id):
+    role_arn = create_role_arn(account_id, os.environ['ACCEPT_ROLE'])
     creds = get_creds(role_arn)
-    org_client = boto3.client(
-        'organizations',
-        aws_access_key_id=creds['AccessKeyId'],
-        aws_secret_access_key=creds['SecretAccessKey'],
-        aws_session_token=creds['SessionToken'],
-    )
+    org_client = get_client('organizations', creds=creds)
     response = org_client.describe_organization()
     return response['Organization']['MasterAccountId']
 
 
-def describe_account(event):
+def describe_account(payer_account_id, account_id):
     '''
     Returns: {
         'Id': 'string',
@@ -242,20 +721,14 @@ def describe_account(event):
         'JoinedTimestamp': datetime(2015, 1, 1)
     }
     '''
-    role_arn = create_role_arn(event["payer_account_id"], os.environ["AUDIT_ROLE"])
+    role_arn = create_role_arn(payer_account_id, os.environ["AUDIT_ROLE"])
     creds = get_creds(role_arn)
-    org_client = boto3.client(
-        'organizations',
-        aws_access_key_id=creds['AccessKeyId'],
-        aws_secret_access_key=creds['SecretAccessKey'],
-        aws_session_token=creds['SessionToken']
-    )
+    org_client = get_client('organizations', creds=creds)
     try:
-        response = org_client.describe_account(AccountId=event["account_id"])
+        response = org_client.describe_account(AccountId=account_id)
         return response['Account']
     except ClientError as e:
-        logger.error(
-            f"Unable to get account details from Organizational Parent: {e}.\nAborting...")
+        logger.error(f"Unable to get account details from Organizational Parent: {e}")
         raise
 
 
@@ -268,29 +741,101 @@ def process_message(message):
 
     if "region" not in message or not message["region"]:
         logger.info("message['region'] not specified; default = all regions")
-        ec2 = boto3.client('ec2')
-        response = ec2.describe_regions()
-        message['region'] = [r['RegionName'] for r in response['Regions']]
+        message['region'] = region_catalog.all_regions()
 
+    if "region_concurrency" not in message:
+        message['region_concurrency'] = int(os.environ.get('REGION_CONCURRENCY', DEFAULT_REGION_CONCURRENCY))
 
-def send_email(log_body, account, to_addr, from_addr, function_name):
 
-    SENDER = f"{function_name} <{from_addr}>"
+class FakeContext(object):
+    '''Stands in for the lambda context when running from the command line'''
+
+    def __init__(self, timeout):
+        self.function_name = "enable-guardduty-local"
+        self.invoked_function_arn = None
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return(int(max(0, self.deadline - time.monotonic()) * 1000))
+
+
+def emit_metrics(function_name):
+    '''
+    Print the invocation's AWS call metrics in CloudWatch Embedded Metric Format. Lambda ships
+    stdout to CloudWatch Logs, which turns these lines into metrics.
+    '''
+    namespace = os.environ.get('METRICS_NAMESPACE', DEFAULT_METRICS_NAMESPACE)
+    for line in call_metrics.emf_lines(namespace, {'FunctionName': function_name}):
+        print(line)
+
+
+def send_email(log_body, accounts, results, to_addr, from_addr, function_name):
+    '''
+    accounts is a dict of account_id => account, results is a dict of
+    account_id => {region: outcome} from process_region()
+    '''
+
+    subject, summary = describe_results(accounts, results)
+
+    summary_lines = []
+    for account_id in sorted(accounts):
+        account = accounts[account_id]
+        summary_lines.append(f"{account['Name']} ({account_id}):")
+        for region, outcome in sorted(results.get(account_id, {}).items()):
+            summary_lines.append(f"    {region}: {outcome}")
+    summary_body = "\n".join(summary_lines)
+
     message_body = f"""
-GuardDuty was enabled for account {account['Name']} ({account['Id']}) in all regions.
+{summary}
+
+{summary_body}
 
 The Log Body follows:
 {log_body}
 
 ** This is an autogenerated email from the lambda {function_name} **
     """
+    deliver_email(subject, message_body, to_addr, from_addr, function_name)
+
+
+def describe_results(accounts, results):
+    '''Returns the subject and first line of an email about the results'''
+    failed = [a for a in sorted(accounts) if failed_account(results.get(a, {}))]
+    needed = [a for a in sorted(accounts) if "needs enabling" in results.get(a, {}).values()]
+    enabled = [a for a in sorted(accounts) if "enabled" in results.get(a, {}).values()]
+    if failed:
+        subject = f"GuardDuty failed to enable for {account_names(accounts, failed)}"
+        summary = f"Enabling GuardDuty failed for {account_names(accounts, failed)} in some regions."
+        if len(failed) < len(accounts):
+            subject += f" (of {len(accounts)})"
+    elif needed:
+        # Only dry runs leave accounts that need enabling
+        subject = f"GuardDuty Dry Run: {account_names(accounts, needed)} {'needs' if len(needed) == 1 else 'need'} enabling"
+        summary = f"This was a dry run. GuardDuty needs to be enabled for {account_names(accounts, needed)}."
+    elif enabled:
+        subject = f"GuardDuty Enabled for {account_names(accounts, enabled)}"
+        summary = f"GuardDuty was enabled for {account_names(accounts, enabled)} in every region it was missing from."
+    else:
+        subject = f"GuardDuty already enabled for {account_names(accounts, sorted(accounts))}"
+        summary = f"There was nothing to do for {account_names(accounts, sorted(accounts))}."
+    return(subject, summary)
+
 
-    client = boto3.client('ses', region_name="us-east-1") # SES only in a few regions
+def account_names(accounts, account_ids):
+    if len(account_ids) == 1:
+        account = accounts[account_ids[0]]
+        return(f"account {account['Name']} ({account['Id']})")
+    return(f"{len(account_ids)} accounts")
+
+
+def deliver_email(subject, message_body, to_addr, from_addr, function_name):
+    SENDER = f"{function_name} <{from_addr}>"
+    client = get_client('ses', "us-east-1") # SES only in a few regions
     response = client.send_email(
         Source=SENDER,
         Destination={'ToAddresses': [to_addr]},
         Message={
-            'Subject': {'Data': f"GuardDuty Enabled for {account['Name']} ({account['Id']})" },
+            'Subject': {'Data': subject },
             'Body': {'Text': {'Data': message_body } }
         }
     )
@@ -304,16 +849,22 @@ if __name__ == '__main__':
     #
     # Required
     #
-    parser.add_argument("--account_id", help="AWS Account ID", required=True)
+    parser.add_argument("--account_id", help="AWS Account ID")
     parser.add_argument("--audit_role", help="Name of role to assume in payer account", required=True)
     parser.add_argument("--accept_role", help="Name of the role to assume in child accounts", required=True)
-    parser.add_argument("--region", help="Only run in this region (list)")
+    parser.add_argument("--region", help="Only run in these regions", nargs='+')
     # parser.add_argument("--message", help="Custom Message sent to child as part of invite")
 
     parser.add_argument("--accept_only", help="Accept existing invite", action='store_true')
     parser.add_argument("--dry-run", help="Don't actually do it", action='store_true')
+    parser.add_argument("--region_concurrency", help="Number of regions to process at once", type=int)
+    parser.add_argument("--sweep", help="Enable every account in the organization instead of --account_id", action='store_true')
+    parser.add_argument("--timeout", help="Act as if each invocation times out after this many seconds", type=int, default=300)
+    parser.add_argument("--digest", help="Email the digest of the outcomes saved in $DIGEST_BUCKET instead", action='store_true')
 
     args = parser.parse_args()
+    if not args.account_id and not args.sweep and not args.digest:
+        parser.error("one of --account_id, --sweep or --digest is required")
 
     # Logging idea from: https://docs.python.org/3/howto/logging.html#configuring-logging
     # create console handler and set level to debug
@@ -340,20 +891,32 @@ if __name__ == '__main__':
     #     message['message'] = args.message
     if args.dry_run:
         message['dry_run'] = True
+    if args.accept_only:
+        message['accept_only'] = True
     if args.region:
         message['region'] = args.region
+    if args.region_concurrency:
+        message['region_concurrency'] = args.region_concurrency
 
     os.environ['ACCEPT_ROLE'] = args.accept_role
     os.environ['AUDIT_ROLE'] = args.audit_role
 
-    event = {
-        'Records': [
-            {
-                'Sns': {
-                    'Message': json.dumps(message),
+    if args.digest:
+        handler({'digest': True}, FakeContext(args.timeout))
+    elif args.sweep:
+        # Each continuation of the sweep runs as a new "invocation", one after the other
+        message['sweep'] = True
+        _local_sweep_queue = [message]
+        while _local_sweep_queue:
+            handler(_local_sweep_queue.pop(0), FakeContext(args.timeout))
+    else:
+        event = {
+            'Records': [
+                {
+                    'Sns': {
+                        'Message': json.dumps(message),
+                    }
                 }
-            }
-        ]
-    }
-    context = {}
-    handler(event, context)
+            ]
+        }
+        handler(event, FakeContext(args.timeout))
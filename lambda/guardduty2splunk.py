@@ -0,0 +1,789 @@
+#!/usr/bin/env python3
+
+import base64
+from collections import OrderedDict
+from datetime import datetime, timezone
+import gzip
+import itertools
+import json
+import os
+import time
+import uuid
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+import requests
+from requests.exceptions import RequestException
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+# Quiet Boto3
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+# Push GuardDuty CloudWatch Events to a Splunk HTTP Event Collector (HEC)
+
+# How long to reuse the HEC secret before fetching it again
+SECRET_TTL = int(os.environ.get('SECRET_TTL', 900))
+
+# Events are packed into HEC payloads of up to this many bytes (before compression)
+HEC_MAX_PAYLOAD_BYTES = int(os.environ.get('HEC_MAX_PAYLOAD_BYTES', 1024 * 1024))
+# gzip the payloads sent to the HEC
+HEC_GZIP = os.environ.get('HEC_GZIP', 'true').lower() == 'true'
+
+# Payloads the HEC doesn't accept are spooled to s3://SPOOL_BUCKET/SPOOL_PREFIX (or to the
+# SPOOL_DIR directory when running locally), and sent again by a {"replay": true} invocation.
+# Payloads the HEC rejects for good (a 4xx other than 401, 403 and 429) are moved to the
+# dead-letter/ folder of the spool instead, to be looked at by hand.
+SPOOL_BUCKET = os.environ.get('SPOOL_BUCKET')
+SPOOL_PREFIX = os.environ.get('SPOOL_PREFIX', 'spool/')
+SPOOL_DIR = os.environ.get('SPOOL_DIR')
+# A replay sends at most REPLAY_RATE spooled payloads per second, and REPLAY_MAX_SEGMENTS in total.
+# It stops when the invocation has less than REPLAY_TIME_MARGIN ms left.
+REPLAY_RATE = float(os.environ.get('REPLAY_RATE', 2))
+REPLAY_MAX_SEGMENTS = int(os.environ.get('REPLAY_MAX_SEGMENTS', 500))
+REPLAY_TIME_MARGIN = 10000
+
+# Findings are sent with the name, email and OU of their account, from a directory of the
+# organization that is listed again every ACCOUNT_DIRECTORY_TTL seconds. The organization is
+# listed with the AUDIT_ROLE role in the payer account, or with the lambda's own role if
+# AUDIT_ROLE isn't set. It is listed at most every ACCOUNT_DIRECTORY_RETRY seconds to look for
+# an account it doesn't know yet, or after a failed listing.
+ENRICH_ACCOUNTS = os.environ.get('ENRICH_ACCOUNTS', 'true').lower() == 'true'
+ACCOUNT_DIRECTORY_TTL = int(os.environ.get('ACCOUNT_DIRECTORY_TTL', 3600))
+ACCOUNT_DIRECTORY_RETRY = 300
+
+# GuardDuty sends a finding again every time its count goes up. After an update of a finding is
+# sent, the updates that follow within DEDUP_WINDOW seconds are held back, and only the newest of
+# them is sent when the window is over. Updates that change the severity are always sent at once.
+# A DEDUP_WINDOW of 0 sends every update. The findings are kept in the DEDUP_TABLE DynamoDB table,
+# which every container shares, until DEDUP_TTL_MARGIN seconds after their window. Without a table
+# (when running locally) the DEDUP_MAX_FINDINGS most recently updated findings are kept in memory.
+# A finding another container changed at the same time is merged up to DEDUP_WRITE_ATTEMPTS times.
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 3600))
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE')
+DEDUP_MAX_FINDINGS = int(os.environ.get('DEDUP_MAX_FINDINGS', 10000))
+DEDUP_TTL_MARGIN = 86400
+DEDUP_WRITE_ATTEMPTS = 3
+
+# HEC metadata of the events. The source is "<HEC_SOURCE>:<region of the finding>".
+HEC_SOURCETYPE = os.environ.get('HEC_SOURCETYPE', 'aws:cloudwatch:guardduty')
+HEC_SOURCE = os.environ.get('HEC_SOURCE', 'aws:guardduty')
+
+# Kept across warm invocations: the HEC secret (and when we fetched it), the Secrets
+# Manager client, a keep-alive HTTP session so each event doesn't pay for a new TLS handshake,
+# and the in-memory findings when there is no DEDUP_TABLE
+_hec_data = None
+_hec_data_fetched = 0
+_secrets_client = None
+_http = requests.Session()
+_spool = None
+_account_directory = None
+_dedup_store = None
+
+
+def handler(event, context):
+    '''
+    event is either a single GuardDuty CloudWatch Event (when invoked by the Events rule), a
+    list of them, or an SQS or Kinesis batch whose records carry them.
+    {"replay": true} sends the spooled payloads instead, and {"flush": true} only sends the
+    held back finding updates whose window is over. Every invocation sends those.
+    '''
+    logger.debug("Received event: " + json.dumps(event, sort_keys=True))
+    dedup = FindingDedup(DEDUP_WINDOW, get_dedup_store())
+    events = dedup.flush()
+    if isinstance(event, dict) and event.get('replay'):
+        replay_spool(context)
+    elif not (isinstance(event, dict) and event.get('flush')):
+        for e in get_events(event):
+            events.extend(dedup.add(e))
+    logger.debug(f"Forwarding {len(events)} events")
+    forward(events)
+    # Only now that the events are sent or spooled. If anything before failed, the retry of the
+    # invocation starts from the same state, so no held back or released update is lost.
+    dedup.commit()
+
+
+def forward(events):
+    '''
+    Send the events to the HEC, and spool the payloads it doesn't accept. Raises if a payload
+    could be neither sent nor spooled, so the batch is retried rather than deleted.
+    '''
+    undelivered = 0
+    for payload in build_payloads(events, HEC_MAX_PAYLOAD_BYTES):
+        status = send_payload(payload)
+        if status == 200:
+            continue
+        if permanent_failure(status):
+            dead_letter_payload(payload)
+        elif not spool_payload(payload):
+            undelivered += payload.count(b"\n") + 1
+    if undelivered:
+        raise Exception(f"No spool is configured, unable to deliver {undelivered} events")
+
+
+def permanent_failure(status):
+    '''True if the HEC will never accept a payload it answered with status'''
+    return(status is not None and 400 <= status < 500 and status not in (401, 403, 429))
+
+
+def send_payload(payload):
+    '''Send a payload to the HEC. Returns the HTTP status, or None if the HEC couldn't be reached.'''
+    hec_data = get_hec_data()
+    logger.debug(f"HEC Endpoint: {hec_data['HECEndpoint']}")
+    try:
+        r = post_to_hec(hec_data, payload)
+        if r.status_code in (401, 403):
+            # The token may have been rotated, get the secret again and retry once
+            logger.warning(f"HEC returned {r.status_code}, refreshing the secret")
+            hec_data = get_hec_data(force_refresh=True)
+            r = post_to_hec(hec_data, payload)
+        if r.status_code != 200:
+            logger.critical(f"Error: HEC returned {r.status_code}: {r.text}")
+        return(r.status_code)
+    except RequestException as e:
+        logger.critical(f"Error: {str(e)}")
+        return(None)
+
+
+def get_events(event):
+    '''Return the list of GuardDuty events carried by the lambda's event'''
+    if isinstance(event, list):
+        return(event)
+    if 'Records' not in event:
+        return([event])
+
+    events = []
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            events.append(json.loads(record['body']))
+        elif record.get('eventSource') == 'aws:kinesis':
+            events.append(json.loads(base64.b64decode(record['kinesis']['data'])))
+        else:
+            logger.error(f"Ignoring record from unsupported source {record.get('eventSource')}")
+    return(events)
+
+
+def build_payloads(events, max_bytes):
+    '''
+    Yield HEC payloads of newline separated hec_event() objects, each at most max_bytes long
+    (a single event bigger than that gets a payload to itself)
+    '''
+    lines = []
+    size = 0
+    for event in events:
+        line = json.dumps(hec_event(event)).encode('utf-8')
+        if lines and size + len(line) > max_bytes:
+            yield b"\n".join(lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line) + 1
+    if lines:
+        yield b"\n".join(lines)
+
+
+def get_dedup_store():
+    global _dedup_store
+    if _dedup_store is None:
+        if DEDUP_TABLE:
+            _dedup_store = DynamoDBDedupStore(DEDUP_TABLE, DEDUP_WINDOW + DEDUP_TTL_MARGIN)
+        else:
+            _dedup_store = MemoryDedupStore(DEDUP_MAX_FINDINGS)
+    return(_dedup_store)
+
+
+class FindingDedup(object):
+    '''
+    Collapse the repeated updates of each finding, keyed by finding id, for one invocation. An
+    update is sent, and the updates within window seconds of it are held back in the store. The
+    newest of those is sent when the window is over, with a dedup element saying how many updates
+    it stands for and the earliest service.eventFirstSeen and latest service.eventLastSeen among
+    them. Its service.count is already the latest. An update with a new severity is sent at once.
+
+    Nothing is saved to the store until commit(). A finding that another container saved in the
+    meantime gets this invocation's changes made again on top of the saved one.
+    '''
+
+    def __init__(self, window, store):
+        self.window = window
+        self.store = store
+        # finding id => the entry as read from the store (None if there was none), the entry as
+        # changed since (None once it is forgotten), and the operations that changed it
+        self.read = {}
+        self.entries = {}
+        self.operations = {}
+        self.new_findings = 0
+
+    def add(self, event, now=None):
+        '''Returns the events to send now because of event. An empty list if it is held back.'''
+        detail = event.get('detail') or {}
+        finding_id = detail.get('id')
+        if not self.window or finding_id is None:
+            return([event])
+        now = time.time() if now is None else now
+
+        entry = self.load(finding_id)
+        if entry is None:
+            output = self.make_room(now)
+            self.entries[finding_id] = new_dedup_entry()
+            self.apply(finding_id, ('sent', now, event))
+            return(output + [event])
+        if entry['severity'] != detail.get('severity'):
+            # What was held back at the old severity goes first
+            output = self.release(finding_id, now) + [event]
+            self.apply(finding_id, ('sent', now, event))
+            return(output)
+        if updated_at(event) in (entry['sent_update'], updated_at(entry['held'] or {})):
+            # The same update again, from a retried invocation or batch
+            return([])
+        self.apply(finding_id, ('hold', event))
+        if now - entry['sent'] < self.window:
+            return([])
+        return(self.release(finding_id, now))
+
+    def flush(self, now=None):
+        '''Returns the held back updates whose window is over'''
+        if not self.window:
+            return([])
+        now = time.time() if now is None else now
+        output = []
+        for finding_id, stored in self.store.due(now - self.window):
+            entry = self.load(finding_id, stored)
+            if entry is not None and entry['held'] is not None and now - entry['sent'] >= self.window:
+                output.extend(self.release(finding_id, now))
+        return(output)
+
+    def commit(self):
+        '''Save the changes to the store. Call it once the events add() and flush() returned are sent.'''
+        for finding_id, operations in self.operations.items():
+            entry = self.entries[finding_id]
+            if entry is None:
+                self.store.delete(finding_id)
+                continue
+            for attempt in range(DEDUP_WRITE_ATTEMPTS):
+                if self.store.put(finding_id, entry, self.read[finding_id]):
+                    break
+                # Another container saved the finding since we read it
+                self.read[finding_id] = self.store.get(finding_id)
+                entry = dict(self.read[finding_id] or new_dedup_entry())
+                for operation in operations:
+                    apply_dedup_operation(entry, operation)
+            else:
+                logger.error(f"Unable to save the held back updates of finding {finding_id}")
+        self.read, self.entries, self.operations = {}, {}, {}
+
+    def load(self, finding_id, stored=None):
+        '''The finding's entry as changed so far, read from the store the first time'''
+        if finding_id not in self.entries:
+            if stored is None:
+                stored = self.store.get(finding_id)
+            self.read[finding_id] = stored
+            self.entries[finding_id] = None if stored is None else dict(stored)
+            self.operations[finding_id] = []
+        return(self.entries[finding_id])
+
+    def apply(self, finding_id, operation):
+        apply_dedup_operation(self.entries[finding_id], operation)
+        self.operations[finding_id].append(operation)
+
+    def release(self, finding_id, now):
+        '''Returns the finding's held back update (as a list), and starts its next window'''
+        entry = self.entries[finding_id]
+        held = entry['held']
+        if held is None:
+            return([])
+        event = held
+        if entry['updates'] > 1:
+            # A copy, the event may also be in an SQS batch that gets retried
+            event = dict(held, dedup={
+                'updates': entry['updates'],
+                'firstSeen': entry['first_seen'],
+                'lastSeen': entry['last_seen'],
+            })
+        self.apply(finding_id, ('release', held))
+        self.apply(finding_id, ('sent', now, held))
+        return([event])
+
+    def make_room(self, now):
+        '''Forget the findings the store has no room for, and return their held back updates'''
+        self.new_findings += 1
+        output = []
+        for finding_id in self.store.overflow(self.new_findings):
+            if finding_id in self.entries:
+                # Already forgotten, or updated by this invocation
+                continue
+            if self.load(finding_id) is not None:
+                output.extend(self.release(finding_id, now))
+                self.entries[finding_id] = None
+        return(output)
+
+
+def new_dedup_entry():
+    return({'severity': None, 'sent': 0, 'sent_update': None, 'held': None, 'updates': 0,
+            'first_seen': None, 'last_seen': None, 'version': 0})
+
+
+def apply_dedup_operation(entry, operation):
+    '''
+    Make one change to a finding's entry: ('sent', time, event) when an update is sent,
+    ('hold', event) when one is held back, and ('release', event) when a held back one is sent
+    '''
+    kind, event = operation[0], operation[-1]
+    if kind == 'sent':
+        entry.update(sent=operation[1], severity=(event.get('detail') or {}).get('severity'), sent_update=updated_at(event))
+    elif kind == 'hold':
+        if entry['held'] is not None and updated_at(event) == updated_at(entry['held']):
+            return
+        entry['updates'] += 1
+        entry['first_seen'] = seen_bound(min, entry['first_seen'], service_seen(event, 'eventFirstSeen'))
+        entry['last_seen'] = seen_bound(max, entry['last_seen'], service_seen(event, 'eventLastSeen'))
+        if entry['held'] is None or updated_at(event) >= updated_at(entry['held']):
+            entry['held'] = event
+    elif kind == 'release':
+        # Another container may have held back a newer update since, that one stays held
+        if entry['held'] is not None and updated_at(entry['held']) == updated_at(event):
+            entry.update(held=None, updates=0, first_seen=None, last_seen=None)
+
+
+def updated_at(event):
+    # GuardDuty's timestamps sort as strings
+    return((event.get('detail') or {}).get('updatedAt', ""))
+
+
+def service_seen(event, key):
+    return(((event.get('detail') or {}).get('service') or {}).get(key))
+
+
+def seen_bound(bound, *times):
+    times = [t for t in times if t]
+    return(bound(times) if times else None)
+
+
+class MemoryDedupStore(object):
+    '''
+    FindingDedup's findings in the container's memory, for running locally. Only the max_findings
+    most recently updated findings are kept, the held back update of a forgotten one is sent.
+    '''
+
+    def __init__(self, max_findings):
+        self.max_findings = max_findings
+        self.findings = OrderedDict()
+
+    def get(self, finding_id):
+        entry = self.findings.get(finding_id)
+        return(None if entry is None else dict(entry))
+
+    def due(self, sent_before):
+        '''The (finding id, entry) of the held back findings last sent before sent_before'''
+        return([(finding_id, dict(entry)) for finding_id, entry in self.findings.items()
+                if entry['held'] is not None and entry['sent'] <= sent_before])
+
+    def put(self, finding_id, entry, read):
+        '''Save the entry unless the finding changed since it was read. Returns False if it had.'''
+        current = self.findings.get(finding_id)
+        if (current and current['version']) != (read and read['version']):
+            return(False)
+        self.findings[finding_id] = dict(entry, version=(read['version'] if read else 0) + 1)
+        self.findings.move_to_end(finding_id)
+        return(True)
+
+    def delete(self, finding_id):
+        self.findings.pop(finding_id, None)
+
+    def overflow(self, new_findings):
+        '''The least recently updated findings to forget to make room for new_findings more'''
+        return(list(itertools.islice(self.findings, max(0, len(self.findings) + new_findings - self.max_findings))))
+
+
+class DynamoDBDedupStore(object):
+    '''
+    FindingDedup's findings in a DynamoDB table keyed by finding id, shared by every container. The
+    held back findings are also in its sparse "held" index, keyed by heldShard and sent, so a flush
+    only reads those. Items expire (the table's "expires" TTL attribute) ttl seconds after the
+    finding's last update was sent.
+    '''
+
+    def __init__(self, table, ttl):
+        self.table = table
+        self.ttl = ttl
+        self.client = boto3.client('dynamodb')
+
+    def get(self, finding_id):
+        response = self.client.get_item(TableName=self.table, Key={'finding': {'S': finding_id}}, ConsistentRead=True)
+        return(self.entry(response['Item']) if 'Item' in response else None)
+
+    def due(self, sent_before):
+        '''Yield the (finding id, entry) of the held back findings last sent before sent_before'''
+        paginator = self.client.get_paginator('query')
+        for page in paginator.paginate(TableName=self.table, IndexName='held',
+                                       KeyConditionExpression="heldShard = :held AND sent <= :before",
+                                       ExpressionAttributeValues={':held': {'S': "held"}, ':before': {'N': repr(sent_before)}}):
+            for item in page['Items']:
+                yield (item['finding']['S'], self.entry(item))
+
+    def put(self, finding_id, entry, read):
+        '''Save the entry unless the finding changed since it was read. Returns False if it had.'''
+        kwargs = {'ConditionExpression': "attribute_not_exists(finding)"}
+        if read is not None:
+            kwargs = {'ConditionExpression': "version = :version",
+                      'ExpressionAttributeValues': {':version': {'N': str(read['version'])}}}
+        version = (read['version'] if read else 0) + 1
+        try:
+            self.client.put_item(TableName=self.table, Item=self.item(finding_id, entry, version), **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return(False)
+            raise
+        return(True)
+
+    def delete(self, finding_id):
+        self.client.delete_item(TableName=self.table, Key={'finding': {'S': finding_id}})
+
+    def overflow(self, new_findings):
+        # The table's TTL forgets the findings instead
+        return([])
+
+    def item(self, finding_id, entry, version):
+        item = {
+            'finding': {'S': finding_id},
+            'version': {'N': str(version)},
+            'sent': {'N': repr(entry['sent'])},
+            'severity': {'S': json.dumps(entry['severity'])},
+            'expires': {'N': str(int(entry['sent'] + self.ttl))},
+        }
+        if entry['sent_update'] is not None:
+            item['sentUpdate'] = {'S': entry['sent_update']}
+        if entry['held'] is not None:
+            item['heldShard'] = {'S': "held"}
+            item['held'] = {'S': json.dumps(entry['held'])}
+            item['updates'] = {'N': str(entry['updates'])}
+            if entry['first_seen'] is not None:
+                item['firstSeen'] = {'S': entry['first_seen']}
+            if entry['last_seen'] is not None:
+                item['lastSeen'] = {'S': entry['last_seen']}
+        return(item)
+
+    @staticmethod
+    def entry(item):
+        return({
+            'severity': json.loads(item['severity']['S']),
+            'sent': float(item['sent']['N']),
+            'sent_update': item['sentUpdate']['S'] if 'sentUpdate' in item else None,
+            'held': json.loads(item['held']['S']) if 'held' in item else None,
+            'updates': int(item['updates']['N']) if 'updates' in item else 0,
+            'first_seen': item['firstSeen']['S'] if 'firstSeen' in item else None,
+            'last_seen': item['lastSeen']['S'] if 'lastSeen' in item else None,
+            'version': int(item['version']['N']),
+        })
+
+
+def hec_event(event):
+    '''
+    Wrap a GuardDuty event for the HEC. The event's time, source and host are set from the
+    finding, and the finding gets an accountDetails element with its account's name, email
+    and OU, so searches don't have to look the account up.
+    '''
+    detail = event.get('detail') or {}
+    region = detail.get('region') or event.get('region', 'unknown')
+    output = {
+        'source': f"{HEC_SOURCE}:{region}",
+        'sourcetype': HEC_SOURCETYPE,
+        'host': finding_host(event),
+    }
+    timestamp = epoch(detail.get('updatedAt') or event.get('time'))
+    if timestamp is not None:
+        output['time'] = timestamp
+
+    account = get_account_directory().lookup(detail['accountId']) if ENRICH_ACCOUNTS and 'accountId' in detail else None
+    if account is not None:
+        # Leave the caller's event alone, it may be spooled or sent again
+        event = dict(event, detail=dict(detail, accountDetails=account))
+    output['event'] = event
+    return(output)
+
+
+def finding_host(event):
+    '''The instance the finding is about, or else its account'''
+    detail = event.get('detail') or {}
+    instance = (detail.get('resource') or {}).get('instanceDetails') or {}
+    return(instance.get('instanceId') or detail.get('accountId') or event.get('account', 'unknown'))
+
+
+def epoch(timestamp):
+    '''Seconds since the epoch of an ISO 8601 UTC timestamp like 2019-10-01T12:00:00.123Z, or None'''
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return(datetime.strptime(timestamp, fmt).replace(tzinfo=timezone.utc).timestamp())
+        except (TypeError, ValueError):
+            continue
+    return(None)
+
+
+def get_account_directory():
+    global _account_directory
+    if _account_directory is None:
+        _account_directory = AccountDirectory(ACCOUNT_DIRECTORY_TTL, os.environ.get('AUDIT_ROLE'))
+    return(_account_directory)
+
+
+class AccountDirectory(object):
+    '''
+    The organization's accounts, with the OU each is in, kept in memory for ttl seconds. It is
+    listed by walking the OU tree, which takes a few calls per OU rather than one per account.
+    '''
+
+    def __init__(self, ttl, audit_role=None):
+        self.ttl = ttl
+        self.audit_role = audit_role
+        self.accounts = {}
+        self.expires = 0
+        self.retry_after = 0
+
+    def lookup(self, account_id):
+        '''Returns {'name', 'email', 'ou', 'ouId', 'ouPath'} for the account, or None'''
+        now = time.time()
+        if now >= self.expires or (account_id not in self.accounts and now >= self.retry_after):
+            self.refresh()
+        return(self.accounts.get(account_id))
+
+    def refresh(self):
+        now = time.time()
+        self.retry_after = now + ACCOUNT_DIRECTORY_RETRY
+        try:
+            self.accounts = self.load()
+            self.expires = now + self.ttl
+            logger.info(f"Loaded {len(self.accounts)} accounts into the account directory")
+        except (BotoCoreError, ClientError) as e:
+            # Keep using what we had rather than calling Organizations for every event. Findings
+            # of accounts we don't know are sent without accountDetails.
+            logger.error(f"Unable to list the organization's accounts: {e}")
+            self.expires = self.retry_after
+
+    def client(self):
+        if not self.audit_role:
+            return(boto3.client('organizations'))
+        payer_account_id = boto3.client('organizations').describe_organization()['Organization']['MasterAccountId']
+        role_arn = f"arn:aws:iam::{payer_account_id}:role/{self.audit_role}"
+        creds = boto3.client('sts').assume_role(RoleArn=role_arn, RoleSessionName="guardduty2splunk")['Credentials']
+        return(boto3.client('organizations',
+                            aws_access_key_id=creds['AccessKeyId'],
+                            aws_secret_access_key=creds['SecretAccessKey'],
+                            aws_session_token=creds['SessionToken']))
+
+    def load(self):
+        org_client = self.client()
+        accounts = {}
+        # Each entry is (OU id, names of the OUs from the root down to it)
+        parents = [(r['Id'], [r['Name']]) for page in org_client.get_paginator('list_roots').paginate() for r in page['Roots']]
+        while parents:
+            parent_id, path = parents.pop()
+            for page in org_client.get_paginator('list_accounts_for_parent').paginate(ParentId=parent_id):
+                for a in page['Accounts']:
+                    accounts[a['Id']] = {
+                        'name': a['Name'],
+                        'email': a['Email'],
+                        'ou': path[-1],
+                        'ouId': parent_id,
+                        'ouPath': "/".join(path),
+                    }
+            for page in org_client.get_paginator('list_organizational_units_for_parent').paginate(ParentId=parent_id):
+                for ou in page['OrganizationalUnits']:
+                    parents.append((ou['Id'], path + [ou['Name']]))
+        return(accounts)
+
+
+def post_to_hec(hec_data, payload):
+    headers = {"Authorization": f"Splunk {hec_data['HECToken']}"}
+    if HEC_GZIP:
+        payload = gzip.compress(payload)
+        headers['Content-Encoding'] = 'gzip'
+    return _http.post(hec_data['HECEndpoint'], headers=headers, data=payload)
+
+
+def spool_payload(payload):
+    '''
+    Keep a payload the HEC didn't accept so replay_spool() can send it later. Returns False if
+    no spool is configured.
+    '''
+    event_count = payload.count(b"\n") + 1
+    spool = get_spool()
+    if spool is None:
+        logger.critical(f"No spool is configured for {event_count} undelivered events")
+        return(False)
+    segment = spool.write(payload)
+    logger.warning(f"Spooled {event_count} undelivered events to {segment}")
+    return(True)
+
+
+def dead_letter_payload(payload):
+    '''Keep a payload the HEC rejected for good. Sending it again wouldn't help.'''
+    event_count = payload.count(b"\n") + 1
+    spool = get_spool()
+    if spool is None:
+        logger.critical(f"No spool is configured, dropping {event_count} events the HEC rejected")
+        return
+    segment = spool.write(payload, dead_letter=True)
+    logger.error(f"Moved {event_count} events the HEC rejected to {segment}")
+
+
+def replay_spool(context):
+    '''
+    Send the spooled payloads to the HEC, oldest first and at most REPLAY_RATE per second, so a
+    recovering HEC isn't flooded. A payload the HEC rejects for good is moved to the dead
+    letters. Stops at the first payload the HEC still can't take (a 5xx, a 401, 403 or 429, or
+    no answer at all).
+    '''
+    spool = get_spool()
+    if spool is None:
+        logger.error("No spool is configured, nothing to replay")
+        return(0)
+
+    sent = 0
+    attempts = 0
+    for segment in spool.segments():
+        if attempts >= REPLAY_MAX_SEGMENTS:
+            break
+        if context is not None and context.get_remaining_time_in_millis() < REPLAY_TIME_MARGIN:
+            break
+        if attempts > 0:
+            time.sleep(1 / REPLAY_RATE)
+        attempts += 1
+        status = send_payload(spool.read(segment))
+        if status == 200:
+            spool.delete(segment)
+            sent += 1
+        elif permanent_failure(status):
+            logger.error(f"HEC rejected {segment} with {status}, moving it to the dead letters")
+            spool.dead_letter(segment)
+        else:
+            logger.warning(f"HEC is still not accepting events, stopping the replay at {segment}")
+            break
+    logger.info(f"Replayed {sent} spooled payloads")
+    return(sent)
+
+
+def get_spool():
+    global _spool
+    if _spool is None:
+        if SPOOL_BUCKET:
+            _spool = S3Spool(SPOOL_BUCKET, SPOOL_PREFIX)
+        elif SPOOL_DIR:
+            _spool = FileSpool(SPOOL_DIR)
+    return(_spool)
+
+
+# The folder of the spool that payloads the HEC rejected for good are moved to
+DEAD_LETTER_FOLDER = "dead-letter"
+
+
+def segment_name():
+    # Segment names sort oldest first
+    return(f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}.json.gz")
+
+
+class S3Spool(object):
+    '''Spooled payloads are gzipped objects under s3://bucket/prefix, dead letters under prefix/dead-letter/'''
+
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.dead_letter_prefix = prefix + DEAD_LETTER_FOLDER + "/"
+        self.client = boto3.client('s3')
+
+    def write(self, payload, dead_letter=False):
+        key = (self.dead_letter_prefix if dead_letter else self.prefix) + segment_name()
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=gzip.compress(payload))
+        return(key)
+
+    def segments(self):
+        # The delimiter leaves out the dead letters
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter='/'):
+            for o in page.get('Contents', []):
+                yield o['Key']
+
+    def read(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=key)
+        return(gzip.decompress(response['Body'].read()))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def dead_letter(self, key):
+        self.client.copy_object(Bucket=self.bucket, Key=self.dead_letter_prefix + key[len(self.prefix):],
+                                CopySource={'Bucket': self.bucket, 'Key': key})
+        self.delete(key)
+
+
+class FileSpool(object):
+    '''Spooled payloads are gzipped files in a local directory, dead letters in its dead-letter subdirectory'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.dead_letter_directory = os.path.join(directory, DEAD_LETTER_FOLDER)
+        os.makedirs(self.dead_letter_directory, exist_ok=True)
+
+    def write(self, payload, dead_letter=False):
+        path = os.path.join(self.dead_letter_directory if dead_letter else self.directory, segment_name())
+        # Write to a temp file and rename it, so a segment is never seen half written
+        with open(path + ".tmp", "wb") as f:
+            f.write(gzip.compress(payload))
+        os.replace(path + ".tmp", path)
+        return(path)
+
+    def segments(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".json.gz"):
+                yield os.path.join(self.directory, name)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return(gzip.decompress(f.read()))
+
+    def delete(self, path):
+        os.remove(path)
+
+    def dead_letter(self, path):
+        os.replace(path, os.path.join(self.dead_letter_directory, os.path.basename(path)))
+
+
+def get_hec_data(force_refresh=False):
+    global _hec_data, _hec_data_fetched
+    if force_refresh or _hec_data is None or time.time() - _hec_data_fetched > SECRET_TTL:
+        hec_data = get_secret(os.environ['HEC_DATA'], os.environ['SECRET_REGION'])
+        if hec_data is None:
+            logger.critical(f"Unable to fetch secret {os.environ['HEC_DATA']}")
+            raise Exception
+        _hec_data = hec_data
+        _hec_data_fetched = time.time()
+    return _hec_data
+
+
+def get_secret(secret_name, region):
+    # Create a Secrets Manager client, once per container
+    global _secrets_client
+    if _secrets_client is None:
+        session = boto3.session.Session()
+        _secrets_client = session.client(service_name='secretsmanager', region_name=region)
+    client = _secrets_client
+
+    try:
+        get_secret_value_response = client.get_secret_value(
+            SecretId=secret_name
+        )
+    except ClientError as e:
+        logger.critical(f"Client error {e} getting secret")
+        raise e
+
+    else:
+        # Decrypts secret using the associated KMS CMK.
+        # Depending on whether the secret is a string or binary, one of these
+        # fields will be populated.
+        if 'SecretString' in get_secret_value_response:
+            secret = get_secret_value_response['SecretString']
+            return json.loads(secret)
+        else:
+            decoded_binary_secret = base64.b64decode(get_secret_value_response['SecretBinary'])
+            return(decoded_binary_secret)
+    return None
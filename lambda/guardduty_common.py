@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+
+# Helpers shared by the enable lambda and scripts/enable_guardduty.py
+
+import bisect
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger()
+
+# create_members and invite_members accept at most 50 accounts per call
+MEMBER_BATCH_SIZE = 50
+# How many times to send accounts that came back in UnprocessedAccounts
+MEMBER_BATCH_ATTEMPTS = 3
+
+# How long to wait for an invitation to reach a child account, and the bounds of the backoff
+# between list_invitations polls
+INVITATION_WAIT_TIMEOUT = 60
+INVITATION_POLL_MIN_DELAY = 0.5
+INVITATION_POLL_MAX_DELAY = 8
+
+# Above this many accounts, paging through every member is as cheap as get_members
+MEMBER_LOOKUP_MAX = 500
+
+# The most accounts list_accounts returns in one page
+LIST_ACCOUNTS_MAX_RESULTS = 20
+
+# Error codes AWS uses to tell us to slow down
+THROTTLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException', 'SlowDown',
+}
+# Starting (and maximum) calls per second for each service. Services not listed get DEFAULT_SERVICE_RATE.
+SERVICE_RATES = {'guardduty': 10, 'sts': 10, 'organizations': 2, 'ses': 1, 'ec2': 10}
+DEFAULT_SERVICE_RATE = 5
+# A throttle halves a service's rate, down to MIN_SERVICE_RATE. Each success wins back this
+# fraction of the starting rate.
+MIN_SERVICE_RATE = 0.2
+SERVICE_RATE_RECOVERY = 0.05
+# Throttled calls are retried up to MAX_CALL_ATTEMPTS times with jittered exponential backoff
+MAX_CALL_ATTEMPTS = 8
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20
+# Each service may retry at most RETRY_BUDGET times in a row; every success earns back a
+# tenth of a retry. This stops a hard throttled service from retrying forever.
+RETRY_BUDGET = 100
+
+# Upper bounds, in milliseconds, of the latency histogram kept for each AWS operation
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Config for every client from get_client(). Throttles are retried by call_limiter, so botocore
+# itself only gets one quick retry.
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'mode': 'standard', 'max_attempts': 2},
+)
+# How many clients get_client() keeps. Clients for the Master account are few; the rest are
+# per child account and region, and are only reused while that account is being worked on.
+CLIENT_CACHE_SIZE = 256
+
+# region_catalog re-reads the account's regions after REGION_CATALOG_TTL seconds. A region where
+# GuardDuty couldn't be reached is skipped for UNREACHABLE_REGION_TTL seconds, then probed again
+# with PROBE_CONFIG's short timeouts before it is used.
+REGION_CATALOG_TTL = 3600
+UNREACHABLE_REGION_TTL = 900
+PROBE_CONFIG = Config(
+    connect_timeout=2,
+    read_timeout=5,
+    retries={'mode': 'standard', 'max_attempts': 1},
+)
+# Errors that mean a region's endpoint can't be reached at all, or hangs
+CONNECTION_ERRORS = (EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError)
+
+# Cached role credentials are refreshed once they are this close to their Expiration
+CREDS_REFRESH_MARGIN = timedelta(minutes=5)
+
+# role_arn => sts:AssumeRole Credentials. Module level, so it survives warm lambda invocations.
+_creds_cache = {}
+_creds_locks = {}
+_creds_cache_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    '''
+    Client side rate limit of `rate` calls per second, with bursts of up to `burst` calls.
+    The rate adapts: throttled() halves it and succeeded() slowly raises it back to max_rate.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Block until a call is allowed'''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(MIN_SERVICE_RATE, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * SERVICE_RATE_RECOVERY)
+
+
+class CallMetrics(object):
+    '''
+    Call and error counts and a latency histogram for each AWS operation, and the wall time
+    spent in each region. Safe to use from multiple threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # (service, operation) => {'calls', 'errors', 'total_ms', 'max_ms', 'histogram'}
+            self.operations = {}
+            # region => milliseconds
+            self.regions = {}
+
+    def record_call(self, service, operation, seconds, error=False):
+        ms = seconds * 1000
+        with self.lock:
+            op = self.operations.get((service, operation))
+            if op is None:
+                op = {'calls': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+                self.operations[(service, operation)] = op
+            op['calls'] += 1
+            if error:
+                op['errors'] += 1
+            op['total_ms'] += ms
+            op['max_ms'] = max(op['max_ms'], ms)
+            op['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    @contextmanager
+    def time_region(self, region):
+        '''Add the wall time of the with block to region's total'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = (time.monotonic() - start) * 1000
+            with self.lock:
+                self.regions[region] = self.regions.get(region, 0) + elapsed
+
+    @staticmethod
+    def percentile(op, fraction):
+        '''Estimate a latency percentile of an operation from its histogram (the bucket's upper bound)'''
+        seen = 0
+        for i, count in enumerate(op['histogram']):
+            seen += count
+            if seen >= fraction * op['calls']:
+                if i < len(LATENCY_BUCKETS_MS):
+                    return(min(op['max_ms'], LATENCY_BUCKETS_MS[i]))
+                break
+        return(op['max_ms'])
+
+    def emf_lines(self, namespace, dimensions=None):
+        '''
+        Return the metrics as CloudWatch Embedded Metric Format JSON lines: one per operation,
+        and one per region. Each is tagged with the extra dimensions given as a dict.
+        '''
+        dimensions = dimensions or {}
+        timestamp = int(time.time() * 1000)
+
+        def emf(keys, metrics, values):
+            record = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [list(dimensions) + keys],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics],
+                    }],
+                },
+            }
+            record.update(dimensions)
+            record.update(values)
+            return(json.dumps(record))
+
+        lines = []
+        with self.lock:
+            for (service, operation), op in sorted(self.operations.items()):
+                lines.append(emf(['Service', 'Operation'], [
+                    ('Calls', 'Count'), ('Errors', 'Count'), ('LatencyAvg', 'Milliseconds'),
+                    ('LatencyP90', 'Milliseconds'), ('LatencyMax', 'Milliseconds'),
+                ], {
+                    'Service': service,
+                    'Operation': operation,
+                    'Calls': op['calls'],
+                    'Errors': op['errors'],
+                    'LatencyAvg': round(op['total_ms'] / op['calls'], 1),
+                    'LatencyP90': round(self.percentile(op, 0.9), 1),
+                    'LatencyMax': round(op['max_ms'], 1),
+                }))
+            for region, ms in sorted(self.regions.items()):
+                lines.append(emf(['Region'], [('RegionWallTime', 'Milliseconds')], {'Region': region, 'RegionWallTime': round(ms, 1)}))
+        return(lines)
+
+    def summary_table(self):
+        '''Return the metrics as lines of a text table, slowest operations first'''
+        lines = [f"{'Operation':<40} {'Calls':>6} {'Errors':>6} {'Avg ms':>8} {'p50 ms':>8} {'p90 ms':>8} {'Max ms':>8}"]
+        with self.lock:
+            by_time = sorted(self.operations.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+            for (service, operation), op in by_time:
+                lines.append(f"{service + ':' + operation:<40} {op['calls']:>6} {op['errors']:>6} "
+                             f"{op['total_ms'] / op['calls']:>8.1f} {self.percentile(op, 0.5):>8.1f} "
+                             f"{self.percentile(op, 0.9):>8.1f} {op['max_ms']:>8.1f}")
+            if self.regions:
+                lines.append(f"{'Region':<40} {'Wall time s':>15}")
+                for region, ms in sorted(self.regions.items(), key=lambda item: item[1], reverse=True):
+                    lines.append(f"{region:<40} {ms / 1000:>15.1f}")
+        return(lines)
+
+    def log_summary(self):
+        for line in self.summary_table():
+            logger.info(line)
+
+
+# Module level, like call_limiter, which records every call it makes here
+call_metrics = CallMetrics()
+
+
+class CallLimiter(object):
+    '''
+    Shared by every client wrapped with limit_client(): a TokenBucket for each service in each
+    region (AWS rate limits are per region), a retry budget for each service, and counters of
+    the calls, retries and throttles per service. The latency of every attempt is recorded in
+    metrics, a CallMetrics, if one is given.
+    '''
+
+    def __init__(self, metrics=None):
+        # (service, region) => TokenBucket. Until the clients were shared across regions there was
+        # one bucket per service, which held a sweep of N regions to 1/N of each region's own limit.
+        # Retry budgets and stats are still per service.
+        self.buckets = {}
+        self.retry_budgets = {}
+        self.stats = {}
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    def _bucket(self, service, region):
+        # Called with self.lock held
+        if service not in self.stats:
+            self.retry_budgets[service] = RETRY_BUDGET
+            self.stats[service] = {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0}
+        if (service, region) not in self.buckets:
+            self.buckets[(service, region)] = TokenBucket(SERVICE_RATES.get(service, DEFAULT_SERVICE_RATE))
+        return(self.buckets[(service, region)])
+
+    def _count(self, service, counter):
+        with self.lock:
+            self.stats[service][counter] += 1
+
+    def _spend_retry(self, service):
+        with self.lock:
+            if self.retry_budgets[service] < 1:
+                return(False)
+            self.retry_budgets[service] -= 1
+            return(True)
+
+    def call(self, service, region, fn, *args, **kwargs):
+        '''Make an AWS API call under the service's rate limit, retrying it if it is throttled'''
+        with self.lock:
+            bucket = self._bucket(service, region)
+
+        for attempt in range(MAX_CALL_ATTEMPTS):
+            bucket.acquire()
+            self._count(service, 'calls')
+            start = time.monotonic()
+            try:
+                response = fn(*args, **kwargs)
+            except ClientError as e:
+                self._record(service, fn, start, error=True)
+                if e.response.get('Error', {}).get('Code') not in THROTTLE_ERROR_CODES:
+                    self._count(service, 'errors')
+                    raise
+                self._count(service, 'throttles')
+                bucket.throttled()
+                if attempt + 1 == MAX_CALL_ATTEMPTS or not self._spend_retry(service):
+                    logger.error(f"Giving up on throttled {service}:{fn.__name__} after {attempt + 1} attempts")
+                    self._count(service, 'errors')
+                    raise
+                self._count(service, 'retries')
+                time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+                continue
+            except Exception:
+                # Connection errors and the like
+                self._record(service, fn, start, error=True)
+                raise
+
+            self._record(service, fn, start)
+            bucket.succeeded()
+            with self.lock:
+                self.retry_budgets[service] = min(RETRY_BUDGET, self.retry_budgets[service] + 0.1)
+            return(response)
+
+    def _record(self, service, fn, start, error=False):
+        if self.metrics is not None:
+            self.metrics.record_call(service, fn.__name__, time.monotonic() - start, error)
+
+    def reset_stats(self):
+        '''Zero the counters. The adaptive rates are kept.'''
+        with self.lock:
+            for counters in self.stats.values():
+                for counter in counters:
+                    counters[counter] = 0
+
+    def log_stats(self):
+        with self.lock:
+            for service in sorted(self.stats):
+                counters = self.stats[service]
+                rate = min(bucket.rate for (s, region), bucket in self.buckets.items() if s == service)
+                logger.info(f"AWS calls to {service}: {counters['calls']} calls, {counters['retries']} retries, "
+                            f"{counters['throttles']} throttles, {counters['errors']} errors, "
+                            f"slowest region limited to {rate:.1f} calls/sec")
+
+
+# Module level, so the learned rates survive warm lambda invocations
+call_limiter = CallLimiter(call_metrics)
+
+
+class LimitedClient(object):
+    '''A boto3 client whose API calls all go through call_limiter'''
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+        self._service = client.meta.service_model.service_name
+        self._region = client.meta.region_name
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name not in self._client.meta.method_to_api_mapping:
+            return(attr)
+
+        @functools.wraps(attr)
+        def limited_call(*args, **kwargs):
+            return(self._limiter.call(self._service, self._region, attr, *args, **kwargs))
+        return(limited_call)
+
+
+def limit_client(client):
+    '''Wrap a boto3 client so its calls are rate limited and throttles are retried'''
+    if isinstance(client, LimitedClient):
+        return(client)
+    return(LimitedClient(client, call_limiter))
+
+
+# (service, region, access key id) => client, least recently used first. Module level, so
+# clients and their connection pools are reused across warm lambda invocations.
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+_client_session = None
+
+
+def get_client(service, region=None, creds=None):
+    '''
+    Return a rate limited (see limit_client()) boto3 client for service in region, using creds
+    from get_cached_creds() or the default credentials. Clients are cached per service, region
+    and credentials, so each keeps its connection pool. Safe to call from multiple threads.
+    '''
+    key = (service, region, creds['AccessKeyId'] if creds else None)
+    with _clients_lock:
+        if key in _clients:
+            _clients.move_to_end(key)
+            return(_clients[key])
+
+        client = _new_client(service, region, creds, CLIENT_CONFIG)
+        _clients[key] = client
+        if len(_clients) > CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+        return(client)
+
+
+def _get_session():
+    # Called with _clients_lock held: boto3's default session isn't thread safe, so clients
+    # come from our own session, and only one at a time
+    global _client_session
+    if _client_session is None:
+        _client_session = boto3.session.Session()
+    return(_client_session)
+
+
+def _new_client(service, region, creds, config):
+    # Called with _clients_lock held
+    kwargs = {}
+    if creds:
+        kwargs = {
+            'aws_access_key_id': creds['AccessKeyId'],
+            'aws_secret_access_key': creds['SecretAccessKey'],
+            'aws_session_token': creds['SessionToken'],
+        }
+    return(limit_client(_get_session().client(service, region_name=region, config=config, **kwargs)))
+
+
+class RegionCatalog(object):
+    '''
+    The regions enabled in this account, and whether GuardDuty could be reached in each.
+    Lets a run skip a dead or opt-in region quickly instead of waiting out connection timeouts
+    in it every time. Safe to use from multiple threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.regions = None
+        self.fetched = 0
+        # region => {'reachable': bool, 'checked': time.time() of the last check}
+        self.status = {}
+
+    def all_regions(self):
+        '''The regions enabled in this account, from ec2:DescribeRegions at most every REGION_CATALOG_TTL seconds'''
+        with self.lock:
+            if self.regions is None or time.time() - self.fetched > REGION_CATALOG_TTL:
+                response = get_client('ec2').describe_regions()
+                self.regions = sorted(r['RegionName'] for r in response['Regions'])
+                self.fetched = time.time()
+            return(list(self.regions))
+
+    def is_reachable(self, region):
+        '''
+        False if GuardDuty was recently unreachable in region. Regions botocore doesn't list
+        GuardDuty in, and unreachable regions whose status has expired, are probed first.
+        '''
+        with self.lock:
+            status = self.status.get(region)
+        if status is None:
+            if region in self._guardduty_regions():
+                return(True)
+        elif status['reachable'] or time.time() - status['checked'] < UNREACHABLE_REGION_TTL:
+            return(status['reachable'])
+        return(self.probe(region))
+
+    def probe(self, region):
+        '''Try a cheap GuardDuty call in region with short timeouts, and record whether it got through'''
+        with _clients_lock:
+            client = _new_client('guardduty', region, None, PROBE_CONFIG)
+        try:
+            client.list_detectors(MaxResults=1)
+            reachable = True
+        except CONNECTION_ERRORS as e:
+            logger.warning(f"GuardDuty is unreachable in {region}: {e}")
+            reachable = False
+        except ClientError:
+            # An error from GuardDuty itself still means the region answers
+            reachable = True
+        self._record(region, reachable)
+        return(reachable)
+
+    def mark_unreachable(self, region):
+        '''Record that a call to GuardDuty in region couldn't connect'''
+        self._record(region, False)
+
+    def _record(self, region, reachable):
+        with self.lock:
+            self.status[region] = {'reachable': reachable, 'checked': time.time()}
+
+    def _guardduty_regions(self):
+        with _clients_lock:
+            return(_get_session().get_available_regions('guardduty'))
+
+    def to_dict(self):
+        with self.lock:
+            return({'regions': self.regions, 'fetched': self.fetched, 'status': dict(self.status)})
+
+    def load(self, data):
+        '''Restore a catalog saved with to_dict()'''
+        with self.lock:
+            self.regions = data.get('regions')
+            self.fetched = data.get('fetched', 0)
+            self.status = data.get('status', {})
+
+
+region_catalog = RegionCatalog()
+
+
+def get_cached_creds(role_arn, session_name="EnableGuardDuty"):
+    '''
+    Return sts:AssumeRole credentials for role_arn, reusing the last ones issued for it until
+    they are within CREDS_REFRESH_MARGIN of expiring. Safe to call from multiple threads;
+    concurrent callers for the same role wait for a single AssumeRole call.
+    '''
+    with _creds_cache_lock:
+        role_lock = _creds_locks.setdefault(role_arn, threading.Lock())
+
+    with role_lock:
+        creds = _creds_cache.get(role_arn)
+        if creds is not None and creds['Expiration'] - CREDS_REFRESH_MARGIN > datetime.now(timezone.utc):
+            return(creds)
+
+        client = get_client('sts')
+        response = client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)
+        _creds_cache[role_arn] = response['Credentials']
+        return(response['Credentials'])
+
+
+def lookup_members(gd_client, detector_id, account_ids=None):
+    '''
+    Return a dict of account_id => member for the Master's detector. With account_ids, only
+    those accounts are looked up (with get_members) so the cost doesn't grow with the number of
+    members. Falls back to a full scan of the members when account_ids isn't given, is too long
+    to be worth it, or get_members isn't allowed.
+    '''
+    if detector_id is None:
+        # Dry run in a region where the Master has no detector yet. There are no members.
+        return({})
+    if account_ids is None or len(account_ids) > MEMBER_LOOKUP_MAX:
+        return(get_all_members(gd_client, detector_id))
+
+    output = {}
+    try:
+        for chunk in chunks(list(account_ids), MEMBER_BATCH_SIZE):
+            # Accounts that aren't members come back in UnprocessedAccounts
+            response = gd_client.get_members(DetectorId=detector_id, AccountIds=chunk)
+            for a in response['Members']:
+                output[a['AccountId']] = a
+    except ClientError as e:
+        logger.warning(f"Unable to get_members ({e}), listing all members instead")
+        return(get_all_members(gd_client, detector_id))
+    return(output)
+
+
+def get_all_members(gd_client, detector_id):
+    output = {}
+    response = gd_client.list_members(DetectorId=detector_id, MaxResults=50)
+    while 'NextToken' in response:
+        for a in response['Members']:
+            # Convert to a lookup table
+            output[a['AccountId']] = a
+        response = gd_client.list_members(
+            DetectorId=detector_id,
+            MaxResults=50,
+            NextToken=response['NextToken'],
+        )
+    for a in response['Members']:
+        # Convert to a lookup table
+        output[a['AccountId']] = a
+
+    return(output)
+
+
+def account_pages(org_client, next_token=None):
+    '''
+    Yield (token, accounts) for each list_accounts page of the organization, so callers can
+    start on the first page while the rest are still being listed. token is the NextToken the
+    page was listed with (None for the first page), so the listing can be picked up again at
+    that page. Suspended accounts are included.
+    '''
+    kwargs = {'MaxResults': LIST_ACCOUNTS_MAX_RESULTS}
+    while True:
+        if next_token is not None:
+            kwargs['NextToken'] = next_token
+        response = org_client.list_accounts(**kwargs)
+        yield (next_token, response['Accounts'])
+        next_token = response.get('NextToken')
+        if next_token is None:
+            return
+
+
+def rebatch(pages, size):
+    '''Regroup an iterable of lists into lists of size items (the last may be shorter)'''
+    batch = []
+    for page in pages:
+        batch.extend(page)
+        while len(batch) >= size:
+            yield batch[:size]
+            batch = batch[size:]
+    if batch:
+        yield batch
+
+
+def chunks(items, size):
+    '''Yield successive lists of up to size items'''
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def batch_member_call(call, account_ids, make_kwargs):
+    '''
+    Call a GuardDuty member API (create_members/invite_members) for account_ids in chunks of
+    MEMBER_BATCH_SIZE. Only the accounts returned in UnprocessedAccounts are retried.
+    make_kwargs(ids) returns the call's keyword arguments for a list of account ids.
+
+    Returns a dict of account_id => reason for the accounts that could not be processed.
+    '''
+    failed = {}
+    for chunk in chunks(account_ids, MEMBER_BATCH_SIZE):
+        pending = chunk
+        unprocessed = {}
+        for attempt in range(MEMBER_BATCH_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(2 ** attempt)
+            try:
+                response = call(**make_kwargs(pending))
+            except ClientError as e:
+                unprocessed = {account_id: str(e) for account_id in pending}
+                break
+            unprocessed = {u['AccountId']: u['Result'] for u in response.get('UnprocessedAccounts', [])}
+            pending = [account_id for account_id in pending if account_id in unprocessed]
+            if not pending:
+                break
+            logger.warning(f"{len(pending)} accounts were unprocessed by {call.__name__} "
+                           f"(attempt {attempt + 1} of {MEMBER_BATCH_ATTEMPTS})")
+        failed.update(unprocessed)
+    return(failed)
+
+
+def invite_members(gd_client, detector_id, accounts):
+    '''
+    Create and invite accounts as members of the GuardDuty Master's detector, in batches.
+    accounts is a list of Organizations account dicts (needs 'Id' and 'Email').
+
+    Returns (invited, failed): the list of account ids that were invited, and a dict of
+    account_id => reason for the ones that were not.
+    '''
+    emails = {a['Id']: a['Email'] for a in accounts}
+
+    failed = batch_member_call(
+        gd_client.create_members,
+        list(emails),
+        lambda ids: {
+            'AccountDetails': [{'AccountId': i, 'Email': emails[i]} for i in ids],
+            'DetectorId': detector_id,
+        },
+    )
+    created = [i for i in emails if i not in failed]
+
+    failed.update(batch_member_call(
+        gd_client.invite_members,
+        created,
+        lambda ids: {
+            'AccountIds': ids,
+            'DetectorId': detector_id,
+            'DisableEmailNotification': True,
+        },
+    ))
+    invited = [i for i in created if i not in failed]
+    return(invited, failed)
+
+
+def wait_for_invitation(child_client, master_id, timeout=INVITATION_WAIT_TIMEOUT):
+    '''
+    Poll list_invitations with a child account's GuardDuty client until an invitation from
+    master_id arrives. Polls back off exponentially (with jitter) up to INVITATION_POLL_MAX_DELAY.
+
+    Returns the invitation, or None if none arrived from master_id within timeout seconds.
+    '''
+    invitation = find_invitation(child_client, master_id)
+    for delay in invitation_poll_delays(timeout):
+        if invitation is not None:
+            break
+        time.sleep(delay)
+        invitation = find_invitation(child_client, master_id)
+    return(invitation)
+
+
+def invitation_poll_delays(timeout=INVITATION_WAIT_TIMEOUT):
+    '''Yield the jittered, exponentially growing delays between invitation polls until timeout'''
+    deadline = time.monotonic() + timeout
+    delay = INVITATION_POLL_MIN_DELAY
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay / 2 + random.uniform(0, delay / 2), remaining)
+        delay = min(delay * 2, INVITATION_POLL_MAX_DELAY)
+
+
+def find_invitation(child_client, master_id):
+    '''Return the child account's pending invitation from master_id, or None'''
+    for i in list_all_invitations(child_client):
+        if i['AccountId'] == master_id:
+            return(i)
+    return(None)
+
+
+def list_all_invitations(child_client):
+    output = []
+    response = child_client.list_invitations(MaxResults=50)
+    while 'NextToken' in response:
+        output = output + response['Invitations']
+        response = child_client.list_invitations(MaxResults=50, NextToken=response['NextToken'])
+    output = output + response['Invitations']
+    return(output)
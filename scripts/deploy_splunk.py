@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import os
+import logging
+import random
+import sys
+import threading
+import time
+
+# Helpers shared with the enable lambda
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+from guardduty_common import get_client, region_catalog
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+# Quiet Boto3
+logging.getLogger('botocore').setLevel(logging.WARNING)
+logging.getLogger('boto3').setLevel(logging.WARNING)
+
+# Deploy, update or delete the GuardDuty2Splunk stack in every region at once.
+# Each region gets a stack named "<stack prefix>-<region>", which loads the lambda zip from the
+# bucket "<deploy bucket prefix>-<region>" (Lambda can only load code from its own region).
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFAULT_TEMPLATE = os.path.join(REPO_DIR, 'cloudformation', 'GuardDuty2Splunk-Template.yaml')
+DEFAULT_STACK_PREFIX = "GuardDuty2Splunk"
+CAPABILITIES = ['CAPABILITY_IAM']
+
+# The HEC secret of a new stack, unless --secret_name/--secret_region say otherwise. An existing
+# stack keeps its secret unless they are passed.
+DEFAULT_SECRET_NAME = "GuardDutyHEC"
+DEFAULT_SECRET_REGION = "us-east-1"
+
+# A change set can only be made for a stack in one of these
+UPDATABLE_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_COMPLETE')
+
+# Stack and change set polls back off from POLL_MIN_DELAY to POLL_MAX_DELAY seconds
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+
+# How CloudFormation says a change set wouldn't change anything
+NO_CHANGES_REASONS = ("didn't contain changes", "No updates are to be performed")
+
+# Regions print from their own threads, one whole line at a time
+print_lock = threading.Lock()
+
+
+def say(region, message):
+    with print_lock:
+        print("{}: {}".format(region, message))
+
+
+def deploy_region(args, region, template, template_params):
+    # Create the region's stack, or update it with a change set. Returns (action, outcome, ok).
+    stack_name = "{}-{}".format(args.stack_prefix, region)
+    bucket = "{}-{}".format(args.deploy_bucket_prefix, region)
+    object_key = "deploy-packages/{}".format(os.path.basename(args.lambda_package))
+
+    say(region, "Uploading {} to s3://{}/{}".format(args.lambda_package, bucket, object_key))
+    with open(args.lambda_package, "rb") as f:
+        get_client('s3', region).put_object(Bucket=bucket, Key=object_key, Body=f.read())
+
+    parameters = {
+        'pDeployBucket': bucket,
+        'pLambdaZipFile': object_key,
+    }
+    if args.secret_name is not None:
+        parameters['pHECSecretName'] = args.secret_name
+    if args.secret_region is not None:
+        parameters['pHECSecretRegion'] = args.secret_region
+    for p in args.parameter:
+        key, value = p.split("=", 1)
+        parameters[key] = value
+
+    cfn = get_client('cloudformation', region)
+    stack = describe_stack(cfn, stack_name)
+    if stack is None:
+        parameters.setdefault('pHECSecretName', DEFAULT_SECRET_NAME)
+        parameters.setdefault('pHECSecretRegion', DEFAULT_SECRET_REGION)
+        return(create_stack(cfn, region, stack_name, template, parameters))
+    if stack['StackStatus'] == 'ROLLBACK_COMPLETE':
+        # A stack whose creation failed can only be deleted
+        return("update", "stack is in ROLLBACK_COMPLETE, delete it first", False)
+    if stack['StackStatus'] not in UPDATABLE_STATUSES:
+        # A change set would only fail, with a reason that doesn't say why
+        return("update", "stack is in {}, it can't be updated until that is sorted out".format(stack['StackStatus']), False)
+
+    # Parameters we weren't given keep the stack's current values
+    for p in stack.get('Parameters', []):
+        if p['ParameterKey'] in template_params and p['ParameterKey'] not in parameters:
+            parameters[p['ParameterKey']] = None
+    return(update_stack(cfn, region, stack['StackId'], template, parameters))
+
+
+def create_stack(cfn, region, stack_name, template, parameters):
+    say(region, "Creating stack {}".format(stack_name))
+    since = datetime.now(timezone.utc) - timedelta(seconds=5)
+    response = cfn.create_stack(
+        StackName=stack_name,
+        TemplateBody=template,
+        Parameters=cfn_parameters(parameters),
+        Capabilities=CAPABILITIES,
+        EnableTerminationProtection=True,
+    )
+    status = wait_for_stack(cfn, region, response['StackId'], since)
+    return("create", status, status == 'CREATE_COMPLETE')
+
+
+def update_stack(cfn, region, stack_id, template, parameters):
+    change_set_name = "deploy-{}".format(datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S'))
+    say(region, "Creating change set {}".format(change_set_name))
+    cfn.create_change_set(
+        StackName=stack_id,
+        ChangeSetName=change_set_name,
+        ChangeSetType='UPDATE',
+        TemplateBody=template,
+        Parameters=cfn_parameters(parameters),
+        Capabilities=CAPABILITIES,
+    )
+    change_set = wait_for_change_set(cfn, stack_id, change_set_name)
+    if change_set['Status'] == 'FAILED':
+        reason = change_set.get('StatusReason', "")
+        cfn.delete_change_set(StackName=stack_id, ChangeSetName=change_set_name)
+        if any(r in reason for r in NO_CHANGES_REASONS):
+            say(region, "No changes")
+            return("update", "no changes", True)
+        return("update", "change set failed: {}".format(reason), False)
+
+    for c in change_set.get('Changes', []):
+        rc = c['ResourceChange']
+        say(region, "Will {} {} ({})".format(rc['Action'].lower(), rc['LogicalResourceId'], rc['ResourceType']))
+    since = datetime.now(timezone.utc) - timedelta(seconds=5)
+    cfn.execute_change_set(StackName=stack_id, ChangeSetName=change_set_name)
+    status = wait_for_stack(cfn, region, stack_id, since)
+    return("update", status, status == 'UPDATE_COMPLETE')
+
+
+def delete_region(args, region):
+    # Delete the region's stack. Returns (action, outcome, ok).
+    stack_name = "{}-{}".format(args.stack_prefix, region)
+    cfn = get_client('cloudformation', region)
+    stack = describe_stack(cfn, stack_name)
+    if stack is None:
+        return("delete", "no stack", True)
+
+    say(region, "Deleting stack {}".format(stack_name))
+    since = datetime.now(timezone.utc) - timedelta(seconds=5)
+    cfn.update_termination_protection(StackName=stack['StackId'], EnableTerminationProtection=False)
+    cfn.delete_stack(StackName=stack['StackId'])
+    status = wait_for_stack(cfn, region, stack['StackId'], since)
+    return("delete", status, status == 'DELETE_COMPLETE')
+
+
+def describe_stack(cfn, stack_name):
+    # Returns the stack, or None if there isn't one
+    try:
+        return(cfn.describe_stacks(StackName=stack_name)['Stacks'][0])
+    except ClientError as e:
+        if "does not exist" in e.response.get('Error', {}).get('Message', ""):
+            return(None)
+        raise
+
+
+def cfn_parameters(parameters):
+    # A value of None keeps the stack's current value
+    output = []
+    for key, value in sorted(parameters.items()):
+        if value is None:
+            output.append({'ParameterKey': key, 'UsePreviousValue': True})
+        else:
+            output.append({'ParameterKey': key, 'ParameterValue': value})
+    return(output)
+
+
+def poll_delays():
+    # Exponential backoff with jitter, so concurrent regions don't poll in lock step
+    delay = POLL_MIN_DELAY
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(POLL_MAX_DELAY, delay * 2)
+
+
+def wait_for_change_set(cfn, stack_id, change_set_name):
+    for delay in poll_delays():
+        change_set = cfn.describe_change_set(StackName=stack_id, ChangeSetName=change_set_name)
+        if change_set['Status'] in ('CREATE_COMPLETE', 'FAILED'):
+            return(change_set)
+        time.sleep(delay)
+
+
+def wait_for_stack(cfn, region, stack_id, since):
+    # Print the stack's events as they happen until it stops being *_IN_PROGRESS, and return its status
+    seen = set()
+    for delay in poll_delays():
+        print_new_events(cfn, region, stack_id, since, seen)
+        status = cfn.describe_stacks(StackName=stack_id)['Stacks'][0]['StackStatus']
+        if not status.endswith('_IN_PROGRESS'):
+            return(status)
+        time.sleep(delay)
+
+
+def print_new_events(cfn, region, stack_id, since, seen):
+    # describe_stack_events is newest first, so stop at the first event we've already printed
+    new_events = []
+    for event in stack_events(cfn, stack_id):
+        if event['EventId'] in seen or event['Timestamp'] < since:
+            break
+        new_events.append(event)
+    for event in reversed(new_events):
+        seen.add(event['EventId'])
+        line = "{} {} {}".format(event['LogicalResourceId'], event['ResourceType'], event['ResourceStatus'])
+        if event.get('ResourceStatusReason'):
+            line += " ({})".format(event['ResourceStatusReason'])
+        say(region, line)
+
+
+def stack_events(cfn, stack_id):
+    # Yields the stack's events newest first, only listing as many pages as the caller reads
+    kwargs = {'StackName': stack_id}
+    while True:
+        response = cfn.describe_stack_events(**kwargs)
+        yield from response['StackEvents']
+        if 'NextToken' not in response:
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+def run_region(args, region, template, template_params):
+    # Entry point of a region's worker thread. Returns (action, outcome, ok, seconds).
+    start = time.monotonic()
+    try:
+        if args.action == "delete":
+            action, outcome, ok = delete_region(args, region)
+        else:
+            action, outcome, ok = deploy_region(args, region, template, template_params)
+    except (ClientError, OSError) as e:
+        action, outcome, ok = args.action, "error: {}".format(e), False
+    return(action, outcome, ok, time.monotonic() - start)
+
+
+def print_summary(results):
+    print("")
+    print("{:<16} {:<8} {:>8}  {}".format("Region", "Action", "Seconds", "Outcome"))
+    for region in sorted(results):
+        action, outcome, ok, seconds = results[region]
+        print("{:<16} {:<8} {:>8.0f}  {}{}".format(region, action, seconds, outcome, "" if ok else "  <== FAILED"))
+
+
+def do_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="Deploy, update or delete the GuardDuty2Splunk stack in every region at once")
+    parser.add_argument("action", help="deploy creates the stacks that don't exist and updates the rest", choices=["deploy", "delete"])
+    parser.add_argument("--debug", help="print debugging info", action='store_true')
+    parser.add_argument("--region", help="Only these regions (default: every region)", nargs='+')
+    parser.add_argument("--stack_prefix", help="Stacks are named <prefix>-<region>", default=DEFAULT_STACK_PREFIX)
+    parser.add_argument("--template", help="CloudFormation template", default=DEFAULT_TEMPLATE)
+    parser.add_argument("--deploy_bucket_prefix", help="The lambda zip is copied to the bucket <prefix>-<region>")
+    parser.add_argument("--lambda_package", help="The lambda zip, built with make package")
+    parser.add_argument("--secret_name", help="Name of the Secrets Manager secret with the HEC details (default: {} for new stacks, the current one for existing stacks)".format(DEFAULT_SECRET_NAME))
+    parser.add_argument("--secret_region", help="Region of the secret (default: {} for new stacks, the current one for existing stacks)".format(DEFAULT_SECRET_REGION))
+    parser.add_argument("--parameter", help="Other stack parameters, as Key=Value", nargs='*', default=[])
+    parser.add_argument("--concurrency", help="Number of regions to work on at once (default: all of them)", type=int)
+
+    args = parser.parse_args()
+    if args.action == "deploy" and (not args.deploy_bucket_prefix or not args.lambda_package):
+        parser.error("deploy needs --deploy_bucket_prefix and --lambda_package")
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    ch.setFormatter(logging.Formatter('%(name)s - %(levelname)s - %(message)s'))
+    logger.addHandler(ch)
+    return(args)
+
+
+if __name__ == '__main__':
+    args = do_args()
+
+    regions = args.region or region_catalog.all_regions()
+
+    template = None
+    template_params = set()
+    if args.action == "deploy":
+        with open(args.template) as f:
+            template = f.read()
+        response = get_client('cloudformation', regions[0]).validate_template(TemplateBody=template)
+        template_params = {p['ParameterKey'] for p in response['Parameters']}
+
+    with ThreadPoolExecutor(max_workers=args.concurrency or len(regions)) as executor:
+        futures = {r: executor.submit(run_region, args, r, template, template_params) for r in regions}
+        results = {r: f.result() for r, f in futures.items()}
+
+    print_summary(results)
+    if not all(ok for action, outcome, ok, seconds in results.values()):
+        exit(1)
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
-import boto3
-from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import base64
+import functools
+import hashlib
+import json
 import time
 import os
 import logging
 import time
+import sys
+import threading
+
+# Helpers shared with the enable lambda
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+from guardduty_common import (CONNECTION_ERRORS, MEMBER_BATCH_SIZE, account_pages, call_limiter, call_metrics, find_invitation,
+    get_cached_creds, get_client, invitation_poll_delays, invite_members, lookup_members, rebatch, region_catalog, wait_for_invitation)
 
 
 logger = logging.getLogger()
@@ -22,7 +33,29 @@ DEFAULT_MESSAGE='Parent Account is enabling GuardDuty. No Action Required.'
 
 DRY_RUN=False
 
+# The --journal of finished work, a ProgressJournal
+JOURNAL=None
+
+# Default limits on concurrent AWS calls per service for --async
+DEFAULT_CONCURRENCY=20
+DEFAULT_SERVICE_CONCURRENCY={'guardduty': 10, 'sts': 5, 'organizations': 1}
+
+# What --plan finds for each account in each region
+MISSING_DETECTOR="missing detector"
+NEEDS_INVITE="needs invite"
+NEEDS_ACCEPT="needs accept"
+ENABLED="enabled"
+UNEXPECTED_STATE="unexpected state"
+
+# Previously enabled accounts re-checked by each --plan that has a --state snapshot
+DEFAULT_RECHECK_SAMPLE=50
+
+# A sweep starts on the accounts as the organization is listed, MEMBER_BATCH_SIZE at a time.
+# --async works on at most this many batches at once, so the listing can't run far ahead.
+SWEEP_BATCHES_IN_FLIGHT=4
+
 def create_parent_detector(gd_client, region):
+    # Returns the new detector (None in a DryRun), or False if it couldn't be created
     if DRY_RUN:
         logger.info("Need to create a Detector in {} for the GuardDuty Master account".format(region))
         return(None)
@@ -32,27 +65,17 @@ def create_parent_detector(gd_client, region):
         response = gd_client.create_detector(Enable=True)
         return(response['DetectorId'])
     except ClientError as e:
-        logger.error("Failed to create detector in {}. Aborting...".format(region))
-        exit(1)
+        logger.error("Failed to create detector in {}: {}. Skipping this region.".format(region, e))
+        return(False)
 
-def get_all_members(region, gd_client, detector_id):
-    output = {}
-    response = gd_client.list_members(DetectorId=detector_id, MaxResults=50)
-    while 'NextToken' in response:
-        for a in response['Members']:
-            # Convert to a lookup table
-            output[a['AccountId']] = a
-        response = gd_client.list_members(DetectorId=detector_id, MaxResults=50, NextToken=response['NextToken'])
-    for a in response['Members']:
-        # Convert to a lookup table
-        output[a['AccountId']] = a
-
-    return(output)
-
-def process_region(args, region):
+def region_detector(region):
+    # Returns the Master's detector in region (None in a DryRun before it exists), or False if
+    # the region can't be processed
     print("Processing Region {}".format(region))
-    gd_client = boto3.client('guardduty', region_name=region)
-    org_client = boto3.client('organizations')
+    if not region_catalog.is_reachable(region):
+        logger.error("GuardDuty can't be reached in region {}. Skipping this region.".format(region))
+        return(False)
+    gd_client = get_client('guardduty', region)
 
     # An account can only have one detector per region
     try:
@@ -65,56 +88,92 @@ def process_region(args, region):
     except ClientError as e:
         logger.error("Unable to list detectors in region {}. Skipping this region.".format(region))
         return(False)
-    except EndpointConnectionError as e:
-        logger.error("Unable to list detectors in region {}. Skipping this region.".format(region))
+    except CONNECTION_ERRORS as e:
+        logger.error("Unable to connect to GuardDuty in region {}. Skipping this region.".format(region))
+        region_catalog.mark_unreachable(region)
         return(False)
-
-
-    gd_status = get_all_members(region, gd_client, detector_id)
-
-    payer_account_list = get_consolidated_billing_subaccounts(args)
-    for a in payer_account_list:
-        if a['Status'] != "ACTIVE":
+    return(detector_id)
+
+def process_region(args, region, detector_id, accounts):
+    # Enable GuardDuty in region for the batch of accounts. Returns True if they all are now.
+    gd_client = get_client('guardduty', region)
+    gd_status = lookup_members(gd_client, detector_id, [a['Id'] for a in accounts])
+
+    to_invite, to_accept = accounts_to_enable(args, accounts, gd_status, region)
+    if args.accept_only:
+        to_accept = to_accept + to_invite
+    elif to_invite:
+        to_accept = to_accept + invite_accounts(to_invite, detector_id, gd_client, region)
+    for a in to_accept:
+        accept_invite(a, args.assume_role, region, args.master_account_id)
+    return(batch_enabled(args, accounts, gd_status, region))
+
+def batch_enabled(args, accounts, gd_status, region):
+    # True if every active account of the batch was already enabled in region, or was by this run.
+    # The Master can't be a member of its own detector.
+    for a in accounts:
+        if a['Status'] != "ACTIVE" or a['Id'] == args.master_account_id:
+            continue
+        if a['Id'] in gd_status and gd_status[a['Id']]['RelationshipStatus'] == "Enabled":
+            continue
+        if JOURNAL is None or not JOURNAL.is_done(a['Id'], region):
+            return(False)
+    return(True)
+
+def accounts_to_enable(args, accounts, gd_status, region):
+    # Returns (to_invite, to_accept): the active accounts that need inviting to this region's
+    # detector first, and the ones already invited that only need to accept. The Master can't be
+    # a member of its own detector.
+    to_invite = []
+    to_accept = []
+    for a in accounts:
+        if a['Status'] != "ACTIVE" or a['Id'] == args.master_account_id:
+            continue
+        if JOURNAL is not None and JOURNAL.is_done(a['Id'], region):
+            # Enabled by the run being resumed
             continue
         if a['Id'] not in gd_status:
             if DRY_RUN:
                 print("Need to enable GuardDuty for {}({})".format(a['Name'], a['Id']))
             else:
                 print("Enabling GuardDuty for {}({})".format(a['Name'], a['Id']))
-            if not args.accept_only:
-                invite_account(a, detector_id, region, args.message)
-                time.sleep(3)
-            accept_invite(a, args.assume_role, region)
-            # exit(1)
+            to_invite.append(a)
             continue
-        if gd_status[a['Id']]['RelationshipStatus'] == "Enabled":
+        status = gd_status[a['Id']]['RelationshipStatus']
+        if status == "Enabled":
             # print("{}({}) is already enabled for GuardDuty in {}".format(a['Name'], a['Id'], region))
             continue
-        print("{}({}) is in unexpected state {} for GuardDuty in {}".format(a['Name'], a['Id'], gd_status[a['Id']]['RelationshipStatus'], region))
-        return()
+        if status == "Created":
+            # A member that was never invited, like member_state() says for --plan
+            print("Finishing enabling GuardDuty for {}({}) in {}".format(a['Name'], a['Id'], region))
+            to_invite.append(a)
+            continue
+        if status == "Invited":
+            # A run that was stopped between the invite and the accept. The invite is still
+            # pending, so only the accept is left.
+            print("Finishing enabling GuardDuty for {}({}) in {}".format(a['Name'], a['Id'], region))
+            to_accept.append(a)
+            continue
+        # Only this account is skipped, the rest of the batch carries on
+        print("{}({}) is in unexpected state {} for GuardDuty in {}".format(a['Name'], a['Id'], status, region))
+        record_progress(a, region, "unexpected state")
+    return(to_invite, to_accept)
 
-def invite_account(account, detector_id, region, message):
+def invite_accounts(accounts, detector_id, gd_client, region):
+    # Returns the accounts that were successfully invited
     if DRY_RUN:
-        print("Need to Invite {}({}) to this GuardDuty Master".format(account['Name'], account['Id']))
-        return(None)
-    client = boto3.client('guardduty', region_name=region)
-    print("Inviting {}({}) to this GuardDuty Master".format(account['Name'], account['Id']))
-    response = client.create_members(
-        AccountDetails=[
-            {
-                'AccountId': account['Id'],
-                'Email': account['Email']
-            },
-        ],
-        DetectorId=detector_id
-    )
-    response = client.invite_members(
-        AccountIds=[ account['Id'] ],
-        DetectorId=detector_id,
-        DisableEmailNotification=True
-    )
-
-def accept_invite(account, role_name, region):
+        for a in accounts:
+            print("Need to Invite {}({}) to this GuardDuty Master".format(a['Name'], a['Id']))
+        return(accounts)
+    for a in accounts:
+        print("Inviting {}({}) to this GuardDuty Master".format(a['Name'], a['Id']))
+    invited, failed = invite_members(gd_client, detector_id, accounts)
+    for a in accounts:
+        if a['Id'] in failed:
+            print("Unable to invite {}({}) in {}: {}".format(a['Name'], a['Id'], region, failed[a['Id']]))
+    return([a for a in accounts if a['Id'] in invited])
+
+def accept_invite(account, role_name, region, master_id):
     if DRY_RUN:
         print("Need to accept invite in {}({})".format(account['Name'], account['Id']))
         return(None)
@@ -123,38 +182,534 @@ def accept_invite(account, role_name, region):
     session_creds = get_creds(organization_role_arn.format(account['Id'], role_name))
     if session_creds is False:
         print("Unable to assume role into {}({}) to accept the invite".format(account['Name'], account['Id']))
+        record_progress(account, region, "failed to assume role")
         return(False)
-    child_client = boto3.client('guardduty', region_name=region,
-        aws_access_key_id = session_creds['AccessKeyId'],
-        aws_secret_access_key = session_creds['SecretAccessKey'],
-        aws_session_token = session_creds['SessionToken']
-        )
+    child_client = get_client('guardduty', region, session_creds)
     response = child_client.list_detectors()
     if len(response['DetectorIds']) == 0:
         response = child_client.create_detector(Enable=True)
         detector_id = response['DetectorId']
     else:
         detector_id = response['DetectorIds'][0]
-    response = child_client.list_invitations()
-    for i in response['Invitations']:
-        response = child_client.accept_invitation(
-            DetectorId=detector_id,
-            InvitationId=i['InvitationId'],
-            MasterId=i['AccountId']
-            )
+    # Wait for the invite from this GuardDuty Master to reach the child account
+    invitation = wait_for_invitation(child_client, master_id)
+    if invitation is None:
+        print("No invitation from {} arrived in {}({}) in {}".format(master_id, account['Name'], account['Id'], region))
+        record_progress(account, region, "no invitation")
+        return(False)
+    response = child_client.accept_invitation(
+        DetectorId=detector_id,
+        InvitationId=invitation['InvitationId'],
+        MasterId=invitation['AccountId']
+        )
+    record_progress(account, region, "enabled")
+
+def record_progress(account, region, outcome):
+    # Note an accept's outcome in the --journal, if there is one. Dry runs don't change anything to note.
+    if JOURNAL is not None and not DRY_RUN:
+        JOURNAL.record(account['Id'], region, outcome)
+
+def record_finished(region, batch=None):
+    # Note in the --journal that every account of the batch, or of the whole sweep, is enabled in region
+    if JOURNAL is not None and not DRY_RUN:
+        JOURNAL.record_finished(region, batch)
+
+def is_finished(region, batch=None):
+    return(JOURNAL is not None and JOURNAL.is_finished(region, batch))
+
+class ProgressJournal(object):
+    # Append-only --journal of the outcome of each (account, region) accept, one JSON line each,
+    # and of each batch and region the sweep finished. Every line is flushed as it is written,
+    # so a run that is killed loses at most the line it was writing. --resume replays the
+    # journal: the regions it shows as finished are skipped, then the batches finished in a
+    # region, before any AWS call is made for them, and then the accounts enabled in a region.
+
+    FSYNC_INTERVAL = 5
+
+    def __init__(self, path, scope, resume):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        # (region, batch key) of finished batches, and (region, None) of finished regions
+        self.finished = set()
+        self.synced = time.monotonic()
+        if resume and os.path.exists(path):
+            self.replay(scope)
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+            self.write({'scope': scope, 'started': time.time()})
+
+    def replay(self, scope):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The line a killed run was in the middle of writing
+                    continue
+                if 'scope' in entry:
+                    if entry['scope'] != scope:
+                        print("Journal {} is from a run for a different payer, account or master. Aborting...".format(self.path))
+                        exit(1)
+                elif entry['outcome'] == "finished":
+                    self.finished.add((entry['region'], entry.get('batch')))
+                elif entry['outcome'] == "enabled":
+                    self.done.add((entry['account'], entry['region']))
+        logger.info("Resuming from {}: {} regions finished, {} account/regions already enabled".format(
+            self.path, sum(1 for region, batch in self.finished if batch is None), len(self.done)))
+
+    def is_done(self, account_id, region):
+        return((account_id, region) in self.done)
+
+    @staticmethod
+    def batch_key(batch):
+        # The organization is listed in the same order every time, so a batch of a resumed run
+        # has the same accounts, and the same key, as the one it finished before
+        return(hashlib.sha1(",".join(sorted(a['Id'] for a in batch)).encode('utf-8')).hexdigest())
+
+    def is_finished(self, region, batch=None):
+        return((region, None) in self.finished or
+               (batch is not None and (region, self.batch_key(batch)) in self.finished))
+
+    def record_finished(self, region, batch=None):
+        key = None if batch is None else self.batch_key(batch)
+        with self.lock:
+            self.finished.add((region, key))
+            entry = {'region': region, 'outcome': "finished", 'time': time.time()}
+            if key is not None:
+                entry['batch'] = key
+            self.write(entry)
+
+    def record(self, account_id, region, outcome):
+        with self.lock:
+            if outcome == "enabled":
+                self.done.add((account_id, region))
+            self.write({'account': account_id, 'region': region, 'outcome': outcome, 'time': time.time()})
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        # fsync() is what makes a line survive a crash of the machine rather than just this
+        # process, but it is slow, so only do it every few seconds
+        if time.monotonic() - self.synced > self.FSYNC_INTERVAL:
+            os.fsync(self.file.fileno())
+            self.synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+class AsyncEngine(object):
+    # Runs the blocking boto3 calls of the --async mode on a thread pool. At most `concurrency`
+    # calls are in flight at once, and at most service_concurrency[service] to any one service.
+
+    def __init__(self, concurrency, service_concurrency):
+        self.concurrency = concurrency
+        self.service_concurrency = service_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.limits = {}
+
+    async def run(self, service, fn, *args):
+        # Run fn(*args) on the thread pool while holding one of the service's call slots
+        if service not in self.limits:
+            self.limits[service] = asyncio.Semaphore(self.service_concurrency.get(service, self.concurrency))
+        async with self.limits[service]:
+            return(await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(fn, *args)))
+
+async def region_detector_async(engine, region):
+    # The --async version of region_detector()
+    print("Processing Region {}".format(region))
+    if not await engine.run('guardduty', region_catalog.is_reachable, region):
+        logger.error("GuardDuty can't be reached in region {}. Skipping this region.".format(region))
+        return(False)
+    gd_client = get_client('guardduty', region)
+
+    # An account can only have one detector per region
+    try:
+        response = await engine.run('guardduty', gd_client.list_detectors)
+        if len(response['DetectorIds']) == 0:
+            # We better create one
+            detector_id = await engine.run('guardduty', create_parent_detector, gd_client, region)
+        else:
+            detector_id = response['DetectorIds'][0]
+    except ClientError as e:
+        logger.error("Unable to list detectors in region {}. Skipping this region.".format(region))
+        return(False)
+    except CONNECTION_ERRORS as e:
+        logger.error("Unable to connect to GuardDuty in region {}. Skipping this region.".format(region))
+        region_catalog.mark_unreachable(region)
+        return(False)
+    return(detector_id)
+
+async def process_region_async(engine, args, region, detector_id, accounts):
+    # The --async version of process_region(). Same output, but every account's accept runs concurrently.
+    gd_client = get_client('guardduty', region)
+    gd_status = await engine.run('guardduty', lookup_members, gd_client, detector_id, [a['Id'] for a in accounts])
+
+    to_invite, to_accept = accounts_to_enable(args, accounts, gd_status, region)
+    if args.accept_only:
+        to_accept = to_accept + to_invite
+    elif to_invite:
+        to_accept = to_accept + await engine.run('guardduty', invite_accounts, to_invite, detector_id, gd_client, region)
+    await asyncio.gather(*[accept_invite_async(engine, a, args.assume_role, region, args.master_account_id) for a in to_accept])
+    return(batch_enabled(args, accounts, gd_status, region))
+
+async def accept_invite_async(engine, account, role_name, region, master_id):
+    # The --async version of accept_invite()
+    if DRY_RUN:
+        print("Need to accept invite in {}({})".format(account['Name'], account['Id']))
+        return(None)
+    print("Accepting invite in {}({})".format(account['Name'], account['Id']))
+    organization_role_arn = "arn:aws:iam::{}:role/{}"
+    session_creds = await engine.run('sts', get_creds, organization_role_arn.format(account['Id'], role_name))
+    if session_creds is False:
+        print("Unable to assume role into {}({}) to accept the invite".format(account['Name'], account['Id']))
+        record_progress(account, region, "failed to assume role")
+        return(False)
+    child_client = get_client('guardduty', region, session_creds)
+    response = await engine.run('guardduty', child_client.list_detectors)
+    if len(response['DetectorIds']) == 0:
+        response = await engine.run('guardduty', functools.partial(child_client.create_detector, Enable=True))
+        detector_id = response['DetectorId']
+    else:
+        detector_id = response['DetectorIds'][0]
+    # Wait for the invite from this GuardDuty Master to reach the child account. Only hold a
+    # GuardDuty slot while polling, not while waiting between polls.
+    invitation = await engine.run('guardduty', find_invitation, child_client, master_id)
+    for delay in invitation_poll_delays():
+        if invitation is not None:
+            break
+        await asyncio.sleep(delay)
+        invitation = await engine.run('guardduty', find_invitation, child_client, master_id)
+    if invitation is None:
+        print("No invitation from {} arrived in {}({}) in {}".format(master_id, account['Name'], account['Id'], region))
+        record_progress(account, region, "no invitation")
+        return(False)
+    response = await engine.run('guardduty', functools.partial(child_client.accept_invitation,
+        DetectorId=detector_id,
+        InvitationId=invitation['InvitationId'],
+        MasterId=invitation['AccountId']
+        ))
+    record_progress(account, region, "enabled")
+
+def sweep(args, regions, batches):
+    # Enable each batch of accounts in every region as it arrives, so the first accounts are
+    # enabled while the organization is still being listed
+    regions = unfinished_regions(regions)
+    if not regions:
+        return
+    detectors = {}
+    unfinished = set()
+    for batch in batches:
+        for r in regions:
+            if is_finished(r, batch):
+                continue
+            with call_metrics.time_region(r):
+                if r not in detectors:
+                    detectors[r] = region_detector(r)
+                if detectors[r] is False:
+                    unfinished.add(r)
+                    continue
+                try:
+                    if process_region(args, r, detectors[r], batch):
+                        record_finished(r, batch)
+                    else:
+                        unfinished.add(r)
+                except Exception as e:
+                    # One region's failure mustn't stop the others
+                    logger.error("Failed to process region {}: {}".format(r, e))
+                    unfinished.add(r)
+    for r in regions:
+        if r not in unfinished:
+            record_finished(r)
+
+def unfinished_regions(regions):
+    # The regions a resumed sweep still has work in. If there are none, the organization isn't even listed.
+    todo = [r for r in regions if not is_finished(r)]
+    if len(todo) < len(regions):
+        print("Skipping {} regions the journal shows as finished".format(len(regions) - len(todo)))
+    return(todo)
+
+async def sweep_async(engine, args, regions, batches):
+    # The --async version of sweep(). Batches and regions are worked on concurrently.
+    regions = unfinished_regions(regions)
+    if not regions:
+        return
+    # A region's detector is only looked up once a batch needs it
+    detectors = {}
+    in_flight = asyncio.Semaphore(SWEEP_BATCHES_IN_FLIGHT)
+    tasks = []
+    while True:
+        await in_flight.acquire()
+        # The next batch comes from the paginated organization listing, so fetch it on the thread pool
+        batch = await engine.run('organizations', next, batches, None)
+        if batch is None:
+            break
+        todo = [r for r in regions if not is_finished(r, batch)]
+        for r in todo:
+            if r not in detectors:
+                detectors[r] = asyncio.ensure_future(region_detector_async(engine, r))
+        tasks.append(asyncio.ensure_future(sweep_batch_async(engine, args, todo, detectors, batch, in_flight)))
+    finished = await asyncio.gather(*tasks)
+    for r in regions:
+        if all(f.get(r, True) for f in finished):
+            record_finished(r)
+
+async def sweep_batch_async(engine, args, regions, detectors, batch, in_flight):
+    # Returns region => True if every account of the batch is enabled there
+    try:
+        finished = await asyncio.gather(*[timed_region_async(engine, args, r, detectors[r], batch) for r in regions])
+    finally:
+        in_flight.release()
+    for r, done in zip(regions, finished):
+        if done:
+            record_finished(r, batch)
+    return(dict(zip(regions, finished)))
+
+async def timed_region_async(engine, args, region, detector, accounts):
+    # One region's failure mustn't abort the gather() the other regions are running in
+    try:
+        detector_id = await detector
+        if detector_id is False:
+            return(False)
+        with call_metrics.time_region(region):
+            return(await process_region_async(engine, args, region, detector_id, accounts))
+    except Exception as e:
+        logger.error("Failed to process region {}: {}".format(region, e))
+        return(False)
+
+def run_async(args, work):
+    # Runs the coroutine work(engine) to completion
+    service_concurrency = dict(DEFAULT_SERVICE_CONCURRENCY)
+    for limit in args.service_concurrency:
+        service, count = limit.split("=")
+        service_concurrency[service] = int(count)
+    engine = AsyncEngine(args.concurrency, service_concurrency)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(work(engine))
+    finally:
+        loop.close()
+        engine.executor.shutdown()
+
+def member_state(member):
+    # The plan state of an account, from its GuardDuty member details in the master's detector
+    if member is None:
+        return(NEEDS_INVITE)
+    status = member['RelationshipStatus']
+    if status == "Enabled":
+        return(ENABLED)
+    if status == "Invited":
+        return(NEEDS_ACCEPT)
+    if status == "Created":
+        # A member that was never invited
+        return(NEEDS_INVITE)
+    return(UNEXPECTED_STATE)
+
+def plan_region(region, accounts, check_ids, previous):
+    # Returns {'detector_id': ..., 'accounts': {account_id: state}} for this region, or None if
+    # the region can't be read. Only the accounts in check_ids are looked up, the rest keep
+    # their state from the previous snapshot.
+    if not region_catalog.is_reachable(region):
+        logger.error("GuardDuty can't be reached in region {}. Leaving it out of the plan.".format(region))
+        return(None)
+    gd_client = get_client('guardduty', region)
+    try:
+        response = gd_client.list_detectors()
+    except ClientError as e:
+        logger.error("Unable to list detectors in region {}. Leaving it out of the plan.".format(region))
+        return(None)
+    except CONNECTION_ERRORS as e:
+        logger.error("Unable to connect to GuardDuty in region {}. Leaving it out of the plan.".format(region))
+        region_catalog.mark_unreachable(region)
+        return(None)
+    if len(response['DetectorIds']) == 0:
+        return({'detector_id': None, 'accounts': {a: MISSING_DETECTOR for a in accounts}})
+    detector_id = response['DetectorIds'][0]
+
+    if previous is None:
+        previous = {}
+    ids = [a for a in accounts if a in check_ids or a not in previous]
+    gd_status = lookup_members(gd_client, detector_id, ids if len(ids) < len(accounts) else None)
+    states = {}
+    for a in accounts:
+        if a in ids:
+            states[a] = member_state(gd_status.get(a))
+        else:
+            states[a] = previous[a]
+    return({'detector_id': detector_id, 'accounts': states})
+
+def accounts_to_check(args, accounts, state):
+    # The accounts --plan looks up: every account that joined since the last snapshot or wasn't
+    # enabled everywhere in it, plus the --recheck_sample enabled accounts checked longest ago,
+    # so the whole organization is re-checked every few runs.
+    if state is None:
+        return(set(accounts))
+    checked = state['checked']
+    check_ids = set()
+    rest = []
+    for a in accounts:
+        if a not in checked or any(r.get(a) != ENABLED for r in state['regions'].values()):
+            check_ids.add(a)
+        else:
+            rest.append(a)
+    rest.sort(key=lambda a: checked[a])
+    check_ids.update(rest[:args.recheck_sample])
+    return(check_ids)
+
+def build_plan(args, regions, accounts, state):
+    # Returns the plan: every active account's state in every region, and what was re-checked.
+    # The Master can't be a member of its own detector, so it has nothing to plan.
+    active = {a['Id']: a for a in accounts.values() if a['Status'] == "ACTIVE" and a['Id'] != args.master_account_id}
+    check_ids = accounts_to_check(args, active, state)
+    logger.info("Checking {} of {} active accounts".format(len(check_ids), len(active)))
+
+    plan = {
+        'created': time.time(),
+        'master_account_id': args.master_account_id,
+        'accounts': {a['Id']: {'Id': a['Id'], 'Name': a['Name'], 'Email': a['Email']} for a in active.values()},
+        'checked': sorted(check_ids),
+        'regions': {},
+    }
+    for r in regions:
+        previous = state['regions'].get(r) if state is not None else None
+        entry = plan_region(r, active, check_ids, previous)
+        if entry is not None:
+            plan['regions'][r] = entry
+    return(plan)
+
+def print_plan_summary(plan):
+    for region in sorted(plan['regions']):
+        counts = {}
+        for s in plan['regions'][region]['accounts'].values():
+            counts[s] = counts.get(s, 0) + 1
+        print("{}: {}".format(region, ", ".join("{} {}".format(counts[s], s) for s in sorted(counts))))
+
+def apply_region(args, region, entry, accounts):
+    # Makes the region's master detector and invites as the plan says, and returns the accounts
+    # that still need to accept an invite
+    states = entry['accounts']
+    todo = {}
+    for a in sorted(states):
+        if JOURNAL is not None and JOURNAL.is_done(a, region):
+            continue
+        todo.setdefault(states[a], []).append(accounts[a])
+    for a in todo.get(UNEXPECTED_STATE, []):
+        print("{}({}) is in an unexpected state for GuardDuty in {}, skipping it".format(a['Name'], a['Id'], region))
+
+    to_invite = todo.get(MISSING_DETECTOR, []) + todo.get(NEEDS_INVITE, [])
+    to_accept = todo.get(NEEDS_ACCEPT, [])
+    if not to_invite and not to_accept:
+        return([])
+
+    print("Applying plan in Region {}".format(region))
+    gd_client = get_client('guardduty', region)
+    detector_id = entry['detector_id']
+    if detector_id is None:
+        detector_id = create_parent_detector(gd_client, region)
+        if detector_id is False:
+            return([])
+    if to_invite and not args.accept_only:
+        to_accept = to_accept + invite_accounts(to_invite, detector_id, gd_client, region)
+    return(to_accept)
+
+def apply_plan(args, plan):
+    for r in sorted(plan['regions']):
+        try:
+            for a in apply_region(args, r, plan['regions'][r], plan['accounts']):
+                accept_invite(a, args.assume_role, r, args.master_account_id)
+        except Exception as e:
+            logger.error("Failed to apply the plan in region {}: {}".format(r, e))
+
+async def apply_region_async(engine, args, region, entry, accounts):
+    try:
+        to_accept = await engine.run('guardduty', apply_region, args, region, entry, accounts)
+        await asyncio.gather(*[accept_invite_async(engine, a, args.assume_role, region, args.master_account_id) for a in to_accept])
+    except Exception as e:
+        logger.error("Failed to apply the plan in region {}: {}".format(region, e))
+
+async def apply_plan_async(engine, args, plan):
+    await asyncio.gather(*[apply_region_async(engine, args, r, plan['regions'][r], plan['accounts']) for r in sorted(plan['regions'])])
+
+def load_plan(plan_file):
+    try:
+        with open(plan_file) as f:
+            return(json.load(f))
+    except (OSError, ValueError) as e:
+        print("Unable to read plan {}: {}".format(plan_file, e))
+        exit(1)
+
+def state_scope(args):
+    # A state snapshot is only valid for the organization and master it was taken with
+    scope = inventory_snapshot_scope(args)
+    scope['master_account_id'] = args.master_account_id
+    return(scope)
+
+def load_state(args):
+    try:
+        with open(args.state) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return(None)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable state snapshot {}: {}".format(args.state, e))
+        return(None)
+    if state.get('scope') != state_scope(args):
+        logger.info("State snapshot {} was taken for a different payer, account or master".format(args.state))
+        return(None)
+    return(state)
+
+def save_state(args, state, plan):
+    # The new snapshot is the plan's states, on top of the old snapshot's for regions the plan
+    # couldn't read
+    regions = dict(state['regions']) if state is not None else {}
+    checked = dict(state['checked']) if state is not None else {}
+    for r, entry in plan['regions'].items():
+        regions[r] = entry['accounts']
+    for a in plan['checked']:
+        checked[a] = plan['created']
+    save_json(args.state, {
+        'created': plan['created'],
+        'scope': state_scope(args),
+        'regions': regions,
+        'checked': checked,
+    })
+
+def load_region_cache(region_cache):
+    # The catalog keeps its own timestamps, so a stale cache is refreshed as it is used
+    try:
+        with open(region_cache) as f:
+            region_catalog.load(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable region cache {}: {}".format(region_cache, e))
+
+def save_json(path, data):
+    # Write to a temp file and rename it so a crashed run never leaves a truncated file behind
+    tmp_file = "{}.tmp".format(path)
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_file, path)
+    except OSError as e:
+        logger.warning("Unable to save {}: {}".format(path, e))
 
 def get_creds(role_arn):
-    client = boto3.client('sts')
+    # Credentials are cached per role, so each account's role is only assumed once per run
     try:
-        session = client.assume_role(RoleArn=role_arn, RoleSessionName="EnableGuardDuty")
-        return(session['Credentials'])
+        return(get_cached_creds(role_arn))
     except Exception as e:
         print(u"Failed to assume role {}: {}".format(role_arn, e))
         return(False)
 # end get_payer_creds()
 
 def get_consolidated_billing_subaccounts(args):
-    # Returns: [
+    # Yields the accounts a page at a time, as the payer lists them, suspended ones included: [
     #         {
     #             'Id': 'string',
     #             'Arn': 'string',
@@ -171,35 +726,84 @@ def get_consolidated_billing_subaccounts(args):
             print("Unable to assume role in payer {}".format(args.payer_arn))
             exit(1)
 
-        org_client = boto3.client('organizations',
-            aws_access_key_id = payer_creds['AccessKeyId'],
-            aws_secret_access_key = payer_creds['SecretAccessKey'],
-            aws_session_token = payer_creds['SessionToken']
-        )
+        org_client = get_client('organizations', creds=payer_creds)
     else:
-        org_client = boto3.client('organizations')
-
-    output = []
+        org_client = get_client('organizations')
 
     try:
-        # If we're only supposed to do one account, just get that from the payer and returnn
+        # If we're only supposed to do one account, just get that from the payer and return
         if args.account_id:
             response = org_client.describe_account( AccountId=args.account_id )
-            output.append(response['Account'])
-            return(output)
+            yield [response['Account']]
+            return
 
         # Otherwise, gotta catch 'em all
-        response = org_client.list_accounts( MaxResults=20 )
-        while 'NextToken' in response :
-            output = output + response['Accounts']
-            response = org_client.list_accounts( MaxResults=20, NextToken=response['NextToken'] )
-
-        output = output + response['Accounts']
-        return(output)
+        for token, page in account_pages(org_client):
+            yield page
     except ClientError as e:
         print("Unable to get account details from Organizational Parent: {}.\nAborting...".format(e))
         exit(1)
 
+def get_account_inventory(args):
+    # Returns all the accounts from get_consolidated_billing_subaccounts() as a dict keyed by account Id.
+    # If --inventory_cache is set, a snapshot younger than --inventory_ttl is used instead of walking
+    # the organization, and a fresh walk is saved there for the next run.
+    if args.inventory_cache:
+        accounts = load_inventory_snapshot(args)
+        if accounts is not None:
+            logger.info("Loaded {} accounts from inventory snapshot {}".format(len(accounts), args.inventory_cache))
+            return(accounts)
+
+    accounts = {}
+    for page in get_consolidated_billing_subaccounts(args):
+        for a in page:
+            accounts[a['Id']] = a
+
+    if args.inventory_cache:
+        save_inventory_snapshot(args, accounts)
+    return(accounts)
+
+def account_batches(args):
+    # Yields the active accounts MEMBER_BATCH_SIZE at a time. Without an --inventory_cache they are
+    # streamed from the organization, so the sweep doesn't wait for the whole of it to be listed.
+    # Only the sweep drops the suspended accounts, the inventory and --plan keep them.
+    if args.inventory_cache:
+        pages = [list(get_account_inventory(args).values())]
+    else:
+        pages = get_consolidated_billing_subaccounts(args)
+    yield from rebatch(([a for a in page if a['Status'] == "ACTIVE"] for page in pages), MEMBER_BATCH_SIZE)
+
+def inventory_snapshot_scope(args):
+    # A snapshot is only valid for the payer and account it was taken with
+    return({'payer_arn': args.payer_arn, 'account_id': args.account_id})
+
+def load_inventory_snapshot(args):
+    try:
+        with open(args.inventory_cache) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return(None)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable inventory snapshot {}: {}".format(args.inventory_cache, e))
+        return(None)
+
+    if snapshot.get('scope') != inventory_snapshot_scope(args):
+        logger.info("Inventory snapshot {} was taken for a different payer or account".format(args.inventory_cache))
+        return(None)
+    age = time.time() - snapshot.get('created', 0)
+    if age > args.inventory_ttl:
+        logger.info("Inventory snapshot {} is {:.0f}s old, refreshing it".format(args.inventory_cache, age))
+        return(None)
+    return(snapshot['accounts'])
+
+def save_inventory_snapshot(args, accounts):
+    snapshot = {
+        'created': time.time(),
+        'scope': inventory_snapshot_scope(args),
+        'accounts': accounts,
+    }
+    save_json(args.inventory_cache, snapshot)
+
 def do_args():
     import argparse
     parser = argparse.ArgumentParser()
@@ -218,10 +822,27 @@ def do_args():
     parser.add_argument("--message", help="Custom Message sent to child as part of invite", default=DEFAULT_MESSAGE)
     parser.add_argument("--accept_only", help="Accept existing invite again", action='store_true')
     parser.add_argument("--dry-run", help="Only print what needs to happen", action='store_true')
+    parser.add_argument("--inventory_cache", help="Save the list of accounts to this file and reuse it on the next run")
+    parser.add_argument("--inventory_ttl", help="Max age in seconds of a reusable --inventory_cache", type=int, default=3600)
+    parser.add_argument("--region_cache", help="Save the list of regions, and which ones GuardDuty was unreachable in, to this file and reuse it on the next run")
+    parser.add_argument("--async", help="Process all accounts and regions concurrently", dest='use_async', action='store_true')
+    parser.add_argument("--concurrency", help="Max concurrent AWS calls with --async", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--service_concurrency", help="Max concurrent calls to a service with --async, as service=N", nargs='*', default=[])
+    parser.add_argument("--journal", help="Note each account and region finished in this file")
+    parser.add_argument("--resume", help="Skip the accounts and regions the --journal shows as finished, and add to it", action='store_true')
+    parser.add_argument("--plan", help="Write the state of every account in every region to this file instead of making changes")
+    parser.add_argument("--apply", help="Only make the changes listed in this file, written by --plan")
+    parser.add_argument("--state", help="With --plan, only re-check the accounts that changed since the snapshot in this file, and update it")
+    parser.add_argument("--recheck_sample", help="Number of enabled accounts --state re-checks anyway on each --plan", type=int, default=DEFAULT_RECHECK_SAMPLE)
 
 
 
     args = parser.parse_args()
+    if args.resume and not args.journal:
+        parser.error("--resume needs a --journal")
+    if args.plan and args.use_async:
+        # --plan only reads, one region at a time. Only --apply and the sweep run concurrently.
+        parser.error("--plan can't be used with --async, use --async with --apply instead")
 
     # Logging idea stolen from: https://docs.python.org/3/howto/logging.html#configuring-logging
     # create console handler and set level to debug
@@ -255,16 +876,53 @@ if __name__ == '__main__':
         print("Only doing a DryRun...")
         DRY_RUN = True
 
+    # The account we run in is the GuardDuty Master the children accept invites from
+    args.master_account_id = get_client('sts').get_caller_identity()['Account']
+
+    if args.journal:
+        JOURNAL = ProgressJournal(args.journal, state_scope(args), args.resume)
+
+    if args.apply:
+        plan = load_plan(args.apply)
+        if plan['master_account_id'] != args.master_account_id:
+            print("Plan {} was made for GuardDuty Master {}, not {}. Aborting...".format(args.apply, plan['master_account_id'], args.master_account_id))
+            exit(1)
+        if args.use_async:
+            run_async(args, lambda engine: apply_plan_async(engine, args, plan))
+        else:
+            apply_plan(args, plan)
+        call_limiter.log_stats()
+        call_metrics.log_summary()
+        if JOURNAL is not None:
+            JOURNAL.close()
+        exit(0)
+
+    if args.region_cache:
+        load_region_cache(args.region_cache)
+
     regions = []
     if args.region == "ALL":
-        ec2 = boto3.client('ec2')
-        response = ec2.describe_regions()
-        for r in response['Regions']:
-            regions.append(r['RegionName'])
+        regions = region_catalog.all_regions()
     else:
         regions.append(args.region)
 
-    for r in regions:
-        process_region(args, r)
-
-
+    if args.plan:
+        # Only walk the organization once, no matter how many regions we process
+        accounts = get_account_inventory(args)
+        state = load_state(args) if args.state else None
+        plan = build_plan(args, regions, accounts, state)
+        save_json(args.plan, plan)
+        if args.state:
+            save_state(args, state, plan)
+        print_plan_summary(plan)
+    elif args.use_async:
+        run_async(args, lambda engine: sweep_async(engine, args, regions, account_batches(args)))
+    else:
+        sweep(args, regions, account_batches(args))
+
+    if args.region_cache:
+        save_json(args.region_cache, region_catalog.to_dict())
+    call_limiter.log_stats()
+    call_metrics.log_summary()
+    if JOURNAL is not None:
+        JOURNAL.close()
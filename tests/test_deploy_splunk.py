@@ -0,0 +1,106 @@
+# scripts/deploy_splunk.py against the fake CloudFormation in benchmark/fake_aws.py
+
+from contextlib import redirect_stdout
+import io
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(TESTS_DIR, '..', 'scripts', 'deploy_splunk.py')
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'lambda'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+import fake_aws
+from fake_aws import FakeAWS
+from run_benchmark import install
+
+
+class DeployTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS(accounts=1, regions=2)
+        install(self.aws, 1000)
+        self.directory = tempfile.mkdtemp()
+        self.package = os.path.join(self.directory, "GuardDuty-Enable-lambda-test.zip")
+        with open(self.package, "wb") as f:
+            f.write(b"zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *argv):
+        '''Run the deployer, returns (exit status, output)'''
+        saved_argv = sys.argv
+        sys.argv = [SCRIPT] + list(argv) + ["--region"] + self.aws.regions
+        output = io.StringIO()
+        status = 0
+        try:
+            with redirect_stdout(output):
+                runpy.run_path(SCRIPT, run_name='__main__')
+        except SystemExit as e:
+            status = e.code
+        finally:
+            sys.argv = saved_argv
+        return(status, output.getvalue())
+
+    def deploy(self, *argv):
+        return(self.run_script("deploy", "--deploy_bucket_prefix", "deploy", "--lambda_package", self.package, *argv))
+
+    def stack(self, region):
+        stack_id = self.aws.stack_ids[(region, f"GuardDuty2Splunk-{region}")]
+        return(self.aws.stacks[(region, stack_id)])
+
+    def parameters(self, region):
+        return({p['ParameterKey']: p['ParameterValue'] for p in self.stack(region)['Parameters']})
+
+    def test_deploy_update_and_delete(self):
+        status, output = self.deploy()
+        self.assertEqual(status, 0, output)
+        for region in self.aws.regions:
+            self.assertEqual(self.stack(region)['StackStatus'], 'CREATE_COMPLETE')
+            self.assertEqual(self.parameters(region)['pHECSecretName'], "GuardDutyHEC")
+
+        status, output = self.deploy()
+        self.assertEqual(status, 0, output)
+        self.assertIn("no changes", output)
+
+        status, output = self.run_script("delete")
+        self.assertEqual(status, 0, output)
+        self.assertEqual(self.aws.stack_ids, {})
+
+    def test_update_keeps_the_stack_secret(self):
+        self.deploy("--secret_name", "OtherHEC", "--secret_region", "eu-west-1")
+        status, output = self.deploy("--parameter", "pDedupWindow=600")
+        self.assertEqual(status, 0, output)
+        for region in self.aws.regions:
+            self.assertEqual(self.parameters(region)['pHECSecretName'], "OtherHEC")
+            self.assertEqual(self.parameters(region)['pHECSecretRegion'], "eu-west-1")
+            self.assertEqual(self.parameters(region)['pDedupWindow'], "600")
+
+    def test_stack_that_cant_be_updated_is_reported(self):
+        self.deploy()
+        self.stack(self.aws.regions[0])['StackStatus'] = 'UPDATE_ROLLBACK_FAILED'
+        status, output = self.deploy("--parameter", "pDedupWindow=600")
+        self.assertEqual(status, 1)
+        self.assertIn("stack is in UPDATE_ROLLBACK_FAILED", output)
+        self.assertEqual(self.parameters(self.aws.regions[1])['pDedupWindow'], "600")
+
+    def test_events_past_the_first_page_are_printed(self):
+        saved_page_size = fake_aws.STACK_EVENTS_PAGE_SIZE
+        fake_aws.STACK_EVENTS_PAGE_SIZE = 1
+        try:
+            status, output = self.deploy()
+        finally:
+            fake_aws.STACK_EVENTS_PAGE_SIZE = saved_page_size
+        self.assertEqual(status, 0, output)
+        for region in self.aws.regions:
+            self.assertIn(f"{region}: GuardDuty2Splunk-{region} AWS::CloudFormation::Stack CREATE_IN_PROGRESS", output)
+            self.assertIn(f"{region}: GuardDuty2Splunk-{region} AWS::CloudFormation::Stack CREATE_COMPLETE", output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# The enable lambda's batches of account messages, against benchmark/fake_aws.py
+
+import json
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'lambda'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+os.environ.update({
+    'ACCEPT_ROLE': "GuardDutyAccept",
+    'AUDIT_ROLE': "GuardDutyAudit",
+    'EMAIL_TO': "test@example.com",
+    'EMAIL_FROM': "test@example.com",
+})
+
+import enable_guardduty
+from fake_aws import FakeAWS
+from run_benchmark import FakeContext, enabled_count, install
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS(accounts=6, regions=3)
+        install(self.aws, 1000)
+        self.children = [a for a in self.aws.account_ids if a != self.aws.master_id]
+        self.reports = []
+        self.saved_report = enable_guardduty.report
+        enable_guardduty.report = lambda log_capture, accounts, results, context: self.reports.append(results)
+
+    def tearDown(self):
+        enable_guardduty.report = self.saved_report
+
+    def run_batch(self, region_concurrency):
+        '''Invoke the handler with an SNS batch of every child account, returns the reported outcomes'''
+        event = {'Records': [{'Sns': {'Message': json.dumps({'account_id': a, 'region_concurrency': region_concurrency})}}
+                             for a in self.children]}
+        enable_guardduty.handler(event, FakeContext())
+        self.assertEqual(len(self.reports), 1)
+        return(self.reports[0])
+
+    def assert_one_account_fails_alone(self, region_concurrency):
+        denied = self.children[2]
+        self.aws.denied_accounts.add(denied)
+        results = self.run_batch(region_concurrency)
+        self.assertEqual(set(results[denied].values()), {"failed"})
+        others = [a for a in self.children if a != denied]
+        for account_id in others:
+            self.assertEqual(set(results[account_id].values()), {"enabled"})
+        self.assertEqual(enabled_count(self.aws, others), len(others) * len(self.aws.regions))
+
+    def test_failed_account_does_not_fail_the_batch(self):
+        self.assert_one_account_fails_alone(1)
+
+    def test_failed_account_does_not_fail_the_batch_concurrently(self):
+        self.assert_one_account_fails_alone(8)
+
+    def assert_region_error_fails_that_region(self, region_concurrency):
+        broken = self.aws.regions[1]
+        lookup_members = enable_guardduty.lookup_members
+
+        def failing_lookup(gd_client, detector_id, account_ids=None):
+            if gd_client.meta.region_name == broken:
+                raise Exception("Unexpected response")
+            return(lookup_members(gd_client, detector_id, account_ids))
+        enable_guardduty.lookup_members = failing_lookup
+        try:
+            results = self.run_batch(region_concurrency)
+        finally:
+            enable_guardduty.lookup_members = lookup_members
+        for account_id in self.children:
+            self.assertEqual(results[account_id][broken], "region failed")
+            self.assertEqual({results[account_id][r] for r in self.aws.regions if r != broken}, {"enabled"})
+
+    def test_region_error_fails_that_region(self):
+        self.assert_region_error_fails_that_region(1)
+
+    def test_region_error_fails_that_region_concurrently(self):
+        self.assert_region_error_fails_that_region(8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# --journal and --resume of scripts/enable_guardduty.py against benchmark/fake_aws.py
+
+from contextlib import redirect_stdout
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(TESTS_DIR, '..', 'scripts', 'enable_guardduty.py')
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'lambda'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+import guardduty_common
+from fake_aws import FakeAWS
+from run_benchmark import install
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS(accounts=120, regions=3)
+        install(self.aws, 1000)
+        self.saved_poll_delay = guardduty_common.INVITATION_POLL_MIN_DELAY
+        guardduty_common.INVITATION_POLL_MIN_DELAY = 0.01
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, "journal")
+
+    def tearDown(self):
+        guardduty_common.INVITATION_POLL_MIN_DELAY = self.saved_poll_delay
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *options):
+        '''Run the script with options, returns the AWS calls it made per (service, operation)'''
+        before = self.aws.calls.copy()
+        saved_argv = sys.argv
+        sys.argv = [SCRIPT, "--payer_arn", f"arn:aws:iam::{self.aws.master_id}:role/GuardDutyAudit",
+                    "--journal", self.journal] + list(options)
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                runpy.run_path(SCRIPT, run_name='__main__')
+        finally:
+            sys.argv = saved_argv
+        return(self.aws.calls - before)
+
+    def assert_resume_skips_finished_work(self, *options):
+        self.run_script(*options)
+        calls = self.run_script("--resume", *options)
+        self.assertEqual(calls[('organizations', 'list_accounts')], 0)
+        self.assertEqual(sum(c for (service, operation), c in calls.items() if service == 'guardduty'), 0)
+
+    def test_resume_of_a_finished_sweep_makes_no_calls(self):
+        self.assert_resume_skips_finished_work()
+
+    def test_resume_of_a_finished_async_sweep_makes_no_calls(self):
+        self.assert_resume_skips_finished_work("--async")
+
+    def test_resume_only_redoes_the_unfinished_region(self):
+        failing = self.aws.regions[1]
+        guardduty_common.region_catalog.mark_unreachable(failing)
+        self.run_script()
+        self.assertEqual(self.aws.members.get(failing, {}), {})
+        guardduty_common.region_catalog.load({})
+        calls = self.run_script("--resume")
+        # Only the unfinished region's detector is looked up again
+        self.assertEqual(calls[('guardduty', 'list_detectors')] - calls[('guardduty', 'accept_invitation')], 1)
+        members = self.aws.members[failing]
+        active = [a for a in self.aws.account_ids if a != self.aws.master_id and self.aws.accounts[a]['Status'] == "ACTIVE"]
+        self.assertTrue(all(members.get(a, {}).get('RelationshipStatus') == "Enabled" for a in active))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# Sweeps and plans of scripts/enable_guardduty.py, against benchmark/fake_aws.py
+
+from contextlib import redirect_stderr, redirect_stdout
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(TESTS_DIR, '..', 'scripts', 'enable_guardduty.py')
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'lambda'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+import guardduty_common
+from fake_aws import FakeAWS
+from run_benchmark import enabled_count, install
+
+
+class ScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS(accounts=10, regions=1)
+        install(self.aws, 1000)
+        self.region = self.aws.regions[0]
+        self.children = [a for a in self.aws.account_ids if a != self.aws.master_id and self.aws.accounts[a]['Status'] == "ACTIVE"]
+        self.master_client = self.aws.session().client('guardduty', region_name=self.region)
+        self.detector_id = self.master_client.create_detector(Enable=True)['DetectorId']
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *options):
+        '''Run the script with options, returns the AWS calls it made per (service, operation)'''
+        before = self.aws.calls.copy()
+        saved_argv = sys.argv
+        sys.argv = [SCRIPT, "--payer_arn", f"arn:aws:iam::{self.aws.master_id}:role/GuardDutyAudit",
+                    "--region", self.region, "--journal", self.journal] + list(options)
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                runpy.run_path(SCRIPT, run_name='__main__')
+        except SystemExit as e:
+            # --apply exits when it is done
+            if e.code:
+                raise
+        finally:
+            sys.argv = saved_argv
+        return(self.aws.calls - before)
+
+    def invite(self, account_ids):
+        accounts = [self.aws.accounts[a] for a in account_ids]
+        guardduty_common.invite_members(self.master_client, self.detector_id, accounts)
+
+    def journal_outcomes(self):
+        with open(self.journal) as f:
+            entries = [json.loads(line) for line in f]
+        return({e['account']: e['outcome'] for e in entries if 'account' in e})
+
+    def test_invited_members_are_only_accepted(self):
+        self.invite(self.children)
+        calls = self.run_script()
+        self.assertEqual(calls[('guardduty', 'create_members')], 0)
+        self.assertEqual(calls[('guardduty', 'invite_members')], 0)
+        self.assertEqual(enabled_count(self.aws, self.children), len(self.children))
+
+    def test_unexpected_state_only_skips_that_account(self):
+        odd = self.children[0]
+        self.invite([odd])
+        self.aws.members[self.region][odd]['RelationshipStatus'] = "Removed"
+        self.run_script()
+        others = self.children[1:]
+        self.assertEqual(enabled_count(self.aws, others), len(others))
+        self.assertEqual(self.journal_outcomes()[odd], "unexpected state")
+
+    def test_plan_leaves_out_the_master(self):
+        plan_file = os.path.join(self.directory, "plan.json")
+        self.run_script("--plan", plan_file)
+        with open(plan_file) as f:
+            plan = json.load(f)
+        self.assertNotIn(self.aws.master_id, plan['accounts'])
+        self.assertNotIn(self.aws.master_id, plan['regions'][self.region]['accounts'])
+        calls = self.run_script("--apply", plan_file)
+        self.assertEqual(calls[('guardduty', 'create_members')], 1)
+        self.assertEqual(enabled_count(self.aws, self.children), len(self.children))
+
+    def test_plan_rejects_async(self):
+        with self.assertRaises(SystemExit), open(os.devnull, "w") as devnull, redirect_stderr(devnull):
+            self.run_script("--plan", os.path.join(self.directory, "plan.json"), "--async")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+# The enable lambda's sweep, handed from invocation to invocation, against benchmark/fake_aws.py
+
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'lambda'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+os.environ.update({
+    'ACCEPT_ROLE': "GuardDutyAccept",
+    'AUDIT_ROLE': "GuardDutyAudit",
+    'EMAIL_TO': "test@example.com",
+    'EMAIL_FROM': "test@example.com",
+})
+
+import enable_guardduty
+from fake_aws import FakeAWS
+from run_benchmark import enabled_count, install
+
+
+class ChunkContext(object):
+    '''A lambda context that runs out of time after `chunks` chunks of a sweep'''
+    function_name = "enable-guardduty-test"
+    invoked_function_arn = None
+
+    def __init__(self, chunks):
+        self.checks_left = chunks - 1
+
+    def get_remaining_time_in_millis(self):
+        # sweep() checks the time before every chunk but the first
+        self.checks_left -= 1
+        return(900000 if self.checks_left >= 0 else 0)
+
+
+class SweepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS(accounts=120, regions=2)
+        install(self.aws, 1000)
+        self.saved_chunk_size = enable_guardduty.SWEEP_CHUNK_SIZE
+        enable_guardduty.SWEEP_CHUNK_SIZE = 25
+        enable_guardduty._local_sweep_queue = []
+
+    def tearDown(self):
+        enable_guardduty.SWEEP_CHUNK_SIZE = self.saved_chunk_size
+        enable_guardduty._local_sweep_queue = None
+
+    def run_sweep(self, chunks_per_invocation, between=None):
+        '''Run a sweep to the end, returns how many invocations it took'''
+        queue = enable_guardduty._local_sweep_queue
+        queue.append({'sweep': True})
+        invocations = 0
+        while queue:
+            if invocations and between:
+                between()
+            enable_guardduty.handler(queue.pop(0), ChunkContext(chunks_per_invocation))
+            invocations += 1
+        return(invocations)
+
+    def active_children(self):
+        return([a for a in self.aws.account_ids if a != self.aws.master_id and self.aws.accounts[a]['Status'] == "ACTIVE"])
+
+    def test_sweep_is_handed_on_until_every_account_is_enabled(self):
+        # 121 accounts in chunks of 25, two chunks per invocation
+        self.assertEqual(self.run_sweep(2), 3)
+        children = self.active_children()
+        self.assertEqual(enabled_count(self.aws, children), len(children) * len(self.aws.regions))
+
+    def test_continuations_pick_up_the_listing_where_it_was(self):
+        self.run_sweep(1)
+        pages = -(-len(self.aws.account_ids) // 20)
+        # Each of the 4 continuations lists the page its place is in again, no more
+        self.assertLessEqual(self.aws.calls[('organizations', 'list_accounts')], pages + 4)
+
+    def test_expired_page_token_skips_the_accounts_already_done(self):
+        self.assertEqual(self.run_sweep(2, between=self.aws.expire_page_tokens), 3)
+        children = self.active_children()
+        self.assertEqual(enabled_count(self.aws, children), len(children) * len(self.aws.regions))
+        # No account was done twice
+        self.assertEqual(self.aws.calls[('guardduty', 'accept_invitation')], len(children) * len(self.aws.regions))
+
+    def test_failed_report_does_not_fork_the_sweep(self):
+        report = enable_guardduty.report
+
+        def failing_report(*args):
+            raise Exception("SES is throttling")
+        enable_guardduty.report = failing_report
+        try:
+            with self.assertRaises(Exception):
+                enable_guardduty.handler({'sweep': True}, ChunkContext(2))
+        finally:
+            enable_guardduty.report = report
+        self.assertEqual(enable_guardduty._local_sweep_queue, [])
+
+    def test_suspended_accounts_are_reported_inactive(self):
+        reports = []
+        report = enable_guardduty.report
+        enable_guardduty.report = lambda log_capture, accounts, results, context: reports.append(results)
+        saved = enable_guardduty.REPORT_MODE, enable_guardduty.DIGEST_BUCKET
+        enable_guardduty.REPORT_MODE, enable_guardduty.DIGEST_BUCKET = "digest", "digest-bucket"
+        try:
+            self.run_sweep(10)
+        finally:
+            enable_guardduty.report = report
+            enable_guardduty.REPORT_MODE, enable_guardduty.DIGEST_BUCKET = saved
+        suspended = [a for a in self.aws.account_ids if self.aws.accounts[a]['Status'] != "ACTIVE"]
+        self.assertTrue(suspended)
+        for account_id in suspended:
+            self.assertEqual(set(reports[0][account_id].values()), {"inactive"})
+
+    def test_digest_needs_a_bucket(self):
+        saved = enable_guardduty.REPORT_MODE, enable_guardduty.DIGEST_BUCKET
+        try:
+            enable_guardduty.REPORT_MODE = "digest"
+            for bucket in (None, "", "None"):
+                enable_guardduty.DIGEST_BUCKET = bucket
+                self.assertFalse(enable_guardduty.digest_mode())
+            enable_guardduty.DIGEST_BUCKET = "digest-bucket"
+            self.assertTrue(enable_guardduty.digest_mode())
+        finally:
+            enable_guardduty.REPORT_MODE, enable_guardduty.DIGEST_BUCKET = saved
+
+    def run_reported_sweep(self):
+        '''Run a sweep in one invocation, returns the outcomes it reported'''
+        reports = []
+        report = enable_guardduty.report
+        enable_guardduty.report = lambda log_capture, accounts, results, context: reports.append(results)
+        try:
+            self.run_sweep(10)
+        finally:
+            enable_guardduty.report = report
+        return(reports[0] if reports else {})
+
+    def test_master_is_left_out(self):
+        results = self.run_reported_sweep()
+        self.assertNotIn(self.aws.master_id, results)
+        self.assertFalse(any(o == "failed" for outcomes in results.values() for o in outcomes.values()))
+
+    def test_failed_account_does_not_fail_its_chunk(self):
+        children = self.active_children()
+        denied = children[3]
+        self.aws.denied_accounts.add(denied)
+        results = self.run_reported_sweep()
+        self.assertEqual(set(results[denied].values()), {"failed"})
+        others = [a for a in children if a != denied]
+        self.assertEqual(enabled_count(self.aws, others), len(others) * len(self.aws.regions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# Holding back the repeated updates of a finding in guardduty2splunk.py
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from botocore.exceptions import ClientError
+import guardduty2splunk
+from guardduty2splunk import DynamoDBDedupStore, FindingDedup, MemoryDedupStore
+
+WINDOW = 3600
+
+
+def update(finding_id, count, severity=5):
+    '''The count-th update of a finding, seen at minute count'''
+    return({'id': f"{finding_id}-{count}", 'detail-type': "GuardDuty Finding", 'detail': {
+        'id': finding_id,
+        'severity': severity,
+        'updatedAt': f"2020-01-01T00:{count:02d}:00Z",
+        'service': {
+            'count': count,
+            'eventFirstSeen': f"2020-01-01T00:{count:02d}:00Z",
+            'eventLastSeen': f"2020-01-01T00:{count:02d}:30Z",
+        },
+    }})
+
+
+def counts(events):
+    return([e['detail']['service']['count'] for e in events])
+
+
+class FakeDynamoDB(object):
+    '''The get_item, put_item, delete_item and query of a DynamoDB table with DedupTable's "held" index'''
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get(Key['finding']['S'])
+        return({'Item': dict(item)} if item else {})
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeValues=None):
+        current = self.items.get(Item['finding']['S'])
+        if ConditionExpression == "attribute_not_exists(finding)":
+            ok = current is None
+        else:
+            ok = current is not None and current['version'] == ExpressionAttributeValues[':version']
+        if not ok:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': "The conditional request failed"}}, 'PutItem')
+        self.items[Item['finding']['S']] = dict(Item)
+
+    def delete_item(self, TableName, Key):
+        self.items.pop(Key['finding']['S'], None)
+
+    def get_paginator(self, operation):
+        return(self)
+
+    def paginate(self, TableName, IndexName, KeyConditionExpression, ExpressionAttributeValues):
+        before = float(ExpressionAttributeValues[':before']['N'])
+        items = [dict(i) for i in self.items.values() if 'heldShard' in i and float(i['sent']['N']) <= before]
+        yield {'Items': sorted(items, key=lambda i: float(i['sent']['N']))}
+
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryDedupStore(10)
+
+    def dedup(self, store=None):
+        return(FindingDedup(WINDOW, store or self.store))
+
+    def add(self, event, now, store=None):
+        '''One invocation with one event, returns what it sends'''
+        dedup = self.dedup(store)
+        events = dedup.flush(now) + dedup.add(event, now)
+        dedup.commit()
+        return(events)
+
+    def flush(self, now, store=None):
+        dedup = self.dedup(store)
+        events = dedup.flush(now)
+        dedup.commit()
+        return(events)
+
+    def test_updates_within_the_window_are_held_back(self):
+        self.assertEqual(counts(self.add(update("a", 1), 0)), [1])
+        self.assertEqual(self.add(update("a", 2), 10), [])
+        self.assertEqual(self.add(update("a", 3), 20), [])
+        self.assertEqual(self.flush(WINDOW - 1), [])
+        events = self.flush(WINDOW)
+        self.assertEqual(counts(events), [3])
+        self.assertEqual(events[0]['dedup'], {
+            'updates': 2,
+            'firstSeen': "2020-01-01T00:02:00Z",
+            'lastSeen': "2020-01-01T00:03:30Z",
+        })
+        # The release starts a new window
+        self.assertEqual(self.flush(WINDOW * 2 - 1), [])
+        self.assertEqual(self.add(update("a", 4), WINDOW + 10), [])
+        self.assertEqual(counts(self.flush(WINDOW * 2)), [4])
+
+    def test_update_after_the_window_is_sent(self):
+        self.add(update("a", 1), 0)
+        self.add(update("a", 2), 10)
+        dedup = self.dedup()
+        events = dedup.add(update("a", 3), WINDOW)
+        dedup.commit()
+        self.assertEqual(counts(events), [3])
+        self.assertEqual(events[0]['dedup']['updates'], 2)
+        self.assertEqual(self.flush(WINDOW * 3), [])
+
+    def test_severity_change_is_sent_at_once(self):
+        self.add(update("a", 1), 0)
+        self.add(update("a", 2), 10)
+        events = self.add(update("a", 3, severity=8), 20)
+        self.assertEqual(counts(events), [2, 3])
+        self.assertEqual(events[1]['detail']['severity'], 8)
+        self.assertEqual(self.flush(WINDOW * 2), [])
+
+    def test_forgotten_findings_send_their_held_update(self):
+        self.store = MemoryDedupStore(2)
+        self.add(update("a", 1), 0)
+        self.add(update("a", 2), 10)
+        self.add(update("b", 1), 20)
+        self.assertEqual(counts(self.add(update("c", 1), 30)), [2, 1])
+        self.assertEqual(list(self.store.findings), ["b", "c"])
+        # "a" is new again
+        self.assertEqual(counts(self.add(update("a", 3), 40)), [3])
+
+    def test_failed_invocation_keeps_the_state(self):
+        self.add(update("a", 1), 0)
+        self.add(update("a", 2), 10)
+        dedup = self.dedup()
+        self.assertEqual(counts(dedup.flush(WINDOW)), [2])
+        # The events couldn't be sent, nothing is committed
+        self.assertEqual(counts(self.flush(WINDOW)), [2])
+        self.assertEqual(self.flush(WINDOW), [])
+
+    def test_retried_update_is_ignored(self):
+        self.add(update("a", 1), 0)
+        self.assertEqual(self.add(update("a", 1), 5), [])
+        self.add(update("a", 2), 10)
+        self.assertEqual(self.add(update("a", 2), 15), [])
+        self.assertEqual(self.flush(WINDOW)[0].get('dedup'), None)
+
+    def test_concurrent_invocations_are_merged(self):
+        self.add(update("a", 1), 0)
+        first, second = self.dedup(), self.dedup()
+        self.assertEqual(first.add(update("a", 3), 20), [])
+        self.assertEqual(second.add(update("a", 2), 10), [])
+        first.commit()
+        second.commit()
+        events = self.flush(WINDOW)
+        self.assertEqual(counts(events), [3])
+        self.assertEqual(events[0]['dedup']['updates'], 2)
+        self.assertEqual(events[0]['dedup']['firstSeen'], "2020-01-01T00:02:00Z")
+
+    def test_window_of_zero_sends_everything(self):
+        dedup = FindingDedup(0, self.store)
+        self.assertEqual(counts(dedup.add(update("a", 1), 0) + dedup.add(update("a", 2), 1)), [1, 2])
+
+    def test_dynamodb_store(self):
+        client = FakeDynamoDB()
+        with mock.patch.object(guardduty2splunk.boto3, 'client', return_value=client):
+            store = DynamoDBDedupStore("dedup", WINDOW + guardduty2splunk.DEDUP_TTL_MARGIN)
+        self.assertEqual(counts(self.add(update("a", 1), 0, store)), [1])
+        self.add(update("a", 2), 10, store)
+        self.add(update("a", 3), 20, store)
+        self.add(update("b", 1), 30, store)
+        self.assertEqual(client.items["a"]['heldShard'], {'S': "held"})
+        self.assertNotIn('heldShard', client.items["b"])
+        self.assertEqual(client.items["a"]['expires'], {'N': str(WINDOW + guardduty2splunk.DEDUP_TTL_MARGIN)})
+        events = self.flush(WINDOW, store)
+        self.assertEqual(counts(events), [3])
+        self.assertEqual(events[0]['dedup']['updates'], 2)
+        self.assertNotIn('heldShard', client.items["a"])
+        self.assertEqual(client.items["a"]['version'], {'N': "4"})
+        self.assertEqual(self.flush(WINDOW * 2, store), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# Account enrichment of guardduty2splunk.py when the organization can't be listed
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from botocore.exceptions import EndpointConnectionError
+import guardduty2splunk
+
+
+class UnreachableDirectory(guardduty2splunk.AccountDirectory):
+    '''An account directory whose Organizations endpoint can't be reached'''
+    loads = 0
+
+    def load(self):
+        UnreachableDirectory.loads += 1
+        raise EndpointConnectionError(endpoint_url="https://organizations.us-east-1.amazonaws.com")
+
+
+class EnrichTest(unittest.TestCase):
+
+    def setUp(self):
+        UnreachableDirectory.loads = 0
+        guardduty2splunk.ENRICH_ACCOUNTS = True
+        guardduty2splunk._account_directory = UnreachableDirectory(3600)
+
+    def tearDown(self):
+        guardduty2splunk._account_directory = None
+
+    def test_finding_is_sent_without_account_details(self):
+        event = {'region': "us-east-1", 'detail': {'accountId': "111111111111", 'updatedAt': "2020-01-02T03:04:05Z"}}
+        output = guardduty2splunk.hec_event(event)
+        self.assertEqual(output['event'], event)
+        self.assertNotIn('accountDetails', output['event']['detail'])
+        # The failed listing isn't retried for every finding
+        guardduty2splunk.hec_event(event)
+        self.assertEqual(UnreachableDirectory.loads, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
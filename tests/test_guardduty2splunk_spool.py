@@ -0,0 +1,132 @@
+# Spool and replay of guardduty2splunk.py against a fake HEC on localhost
+
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import guardduty2splunk
+
+
+class FakeHEC(BaseHTTPRequestHandler):
+    '''Answers each POST with the next status of `statuses` (200 once they run out), and keeps the events'''
+    statuses = []
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        status = FakeHEC.statuses.pop(0) if FakeHEC.statuses else 200
+        if status == 200:
+            FakeHEC.received.extend(json.loads(line)['event'] for line in body.split(b"\n"))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'code': 0 if status == 200 else 6}).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def finding(n):
+    return({'id': f"event-{n}", 'detail-type': "GuardDuty Finding", 'region': "us-east-1", 'detail': {'severity': 5}})
+
+
+class SpoolTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeHEC)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakeHEC.statuses = []
+        FakeHEC.received = []
+        self.endpoint = f"http://127.0.0.1:{self.server.server_port}/services/collector/event"
+        guardduty2splunk._hec_data = {'HECEndpoint': self.endpoint, 'HECToken': "token"}
+        guardduty2splunk._hec_data_fetched = time.time()
+        guardduty2splunk.ENRICH_ACCOUNTS = False
+        guardduty2splunk.REPLAY_RATE = 1000
+        self.directory = tempfile.mkdtemp()
+        guardduty2splunk._spool = guardduty2splunk.FileSpool(self.directory)
+
+    def tearDown(self):
+        guardduty2splunk._spool = None
+        shutil.rmtree(self.directory)
+
+    def spooled(self):
+        return(list(guardduty2splunk._spool.segments()))
+
+    def dead_letters(self):
+        return(os.listdir(os.path.join(self.directory, guardduty2splunk.DEAD_LETTER_FOLDER)))
+
+    def test_accepted_events_are_not_spooled(self):
+        guardduty2splunk.forward([finding(1), finding(2)])
+        self.assertEqual([e['id'] for e in FakeHEC.received], ["event-1", "event-2"])
+        self.assertEqual(self.spooled(), [])
+
+    def test_spooled_events_are_replayed_once_the_hec_recovers(self):
+        FakeHEC.statuses = [503]
+        guardduty2splunk.forward([finding(1)])
+        self.assertEqual(len(self.spooled()), 1)
+
+        FakeHEC.statuses = [503]
+        self.assertEqual(guardduty2splunk.replay_spool(None), 0)
+        self.assertEqual(len(self.spooled()), 1)
+
+        self.assertEqual(guardduty2splunk.replay_spool(None), 1)
+        self.assertEqual(self.spooled(), [])
+        self.assertEqual([e['id'] for e in FakeHEC.received], ["event-1"])
+
+    def test_unreachable_hec_spools(self):
+        guardduty2splunk._hec_data = {'HECEndpoint': "http://127.0.0.1:1/services/collector/event", 'HECToken': "token"}
+        guardduty2splunk.forward([finding(1)])
+        self.assertEqual(len(self.spooled()), 1)
+
+    def test_rejected_segment_does_not_block_the_replay(self):
+        for n in range(3):
+            guardduty2splunk._spool.write(json.dumps(guardduty2splunk.hec_event(finding(n))).encode('utf-8'))
+        FakeHEC.statuses = [400]
+        self.assertEqual(guardduty2splunk.replay_spool(None), 2)
+        self.assertEqual(self.spooled(), [])
+        self.assertEqual(len(self.dead_letters()), 1)
+        self.assertEqual([e['id'] for e in FakeHEC.received], ["event-1", "event-2"])
+
+    def test_throttled_segment_stops_the_replay(self):
+        for n in range(2):
+            guardduty2splunk._spool.write(json.dumps(guardduty2splunk.hec_event(finding(n))).encode('utf-8'))
+        FakeHEC.statuses = [429]
+        self.assertEqual(guardduty2splunk.replay_spool(None), 0)
+        self.assertEqual(len(self.spooled()), 2)
+        self.assertEqual(self.dead_letters(), [])
+
+    def test_rejected_events_go_to_the_dead_letters(self):
+        FakeHEC.statuses = [400]
+        guardduty2splunk.forward([finding(1)])
+        self.assertEqual(self.spooled(), [])
+        self.assertEqual(len(self.dead_letters()), 1)
+
+    def test_undeliverable_events_fail_the_invocation_without_a_spool(self):
+        guardduty2splunk._spool = None
+        FakeHEC.statuses = [503]
+        with self.assertRaises(Exception):
+            guardduty2splunk.forward([finding(1)])
+
+
+if __name__ == '__main__':
+    unittest.main()